@@ -0,0 +1,167 @@
+#!/usr/bin/python
+"""
+Benchmark of the full run.main flow (reading the data, generating and publishing every country) against the local
+CKAN simulator in simulator.py.
+
+Each mode runs in a fresh working folder against an empty simulator:
+  serial       run.main()
+  pipelined    run.main(pipelined=True)
+  parallel     run.main(pipelined=True, workers=4)
+  incremental  run.main(prefetch=True) to fill the simulator, then a second run.main(prefetch=True) is measured
+
+For each mode the datasets per minute and the CKAN calls per dataset of the measured run are reported, e.g.
+  python benchmark.py --latency 0.05 --error-rate 0.01 --rate-limit 50 --modes serial,pipelined,incremental
+"""
+
+import argparse
+import logging
+from os import chdir, environ, getcwd, makedirs, symlink
+from os.path import abspath, exists, join
+from tempfile import TemporaryDirectory
+from time import perf_counter
+
+from hdx.api.configuration import Configuration
+from hdx.api.locations import Locations
+from hdx.data.resource import Resource
+from hdx.data.vocabulary import Vocabulary
+from hdx.location.country import Country
+from hdx.utilities.easy_logging import setup_logging
+from hdx.utilities.useragent import UserAgent
+
+import run
+from simulator import CKANSimulator
+
+logger = logging.getLogger(__name__)
+
+repo_folder = abspath(".")
+
+modes = {
+    "serial": (None, {}),
+    "pipelined": (None, {"pipelined": True}),
+    "parallel": (None, {"pipelined": True, "workers": 4}),
+    "incremental": ({"prefetch": True}, {"prefetch": True}),
+}
+
+
+def setup_configuration(simulator):
+    """HDX configuration pointing to the simulator, with the caches of hdx-python-api cleared"""
+    UserAgent.set_global("UNHCR_POPULATION_BENCHMARK")
+    Configuration._create(
+        user_agent="UNHCR_POPULATION_BENCHMARK",
+        hdx_url=simulator.url,
+        hdx_key="simulated",
+        hdx_config_dict=simulator.hdx_config(),
+        project_config_yaml=join(repo_folder, "config", "project_configuration.yml"),
+    )
+    Locations._validlocations = None
+    Vocabulary._approved_vocabulary = None
+    Vocabulary._tags_dict = None
+    Resource._formats_dict = None
+
+
+def run_mode(name, data_folder, simulator_options):
+    """Run one mode, returns dictionary of results"""
+    warmup, options = modes[name]
+    cwd = getcwd()
+    with TemporaryDirectory() as folder, CKANSimulator(
+        **simulator_options
+    ) as simulator:
+        symlink(data_folder, join(folder, "data"))
+        symlink(join(repo_folder, "config"), join(folder, "config"))
+        makedirs(join(folder, "tmp"))
+        environ["TEMP_DIR"] = join(folder, "tmp")
+        chdir(folder)
+        try:
+            setup_configuration(simulator)
+            if warmup is not None:
+                run.main(**warmup)
+                simulator.reset_counters()
+            start = perf_counter()
+            run.main(**options)
+            seconds = perf_counter() - start
+        finally:
+            chdir(cwd)
+            del environ["TEMP_DIR"]
+        datasets = sum(
+            1 for package in simulator.packages.values() if package["type"] == "dataset"
+        )
+        calls = sum(simulator.calls.values())
+        return {
+            "mode": name,
+            "datasets": datasets,
+            "seconds": seconds,
+            "datasets_per_minute": 60 * datasets / seconds if seconds else 0,
+            "calls": calls,
+            "calls_per_dataset": calls / datasets if datasets else 0,
+            "errors": simulator.errors,
+            "rate_limited": simulator.rate_limited,
+            "uploaded_mb": simulator.uploaded_bytes / 1e6,
+            "calls_by_action": dict(simulator.calls.most_common()),
+        }
+
+
+def print_results(results):
+    print(
+        f"{'mode':<12} {'datasets':>8} {'seconds':>8} {'ds/min':>8} {'calls':>7} {'calls/ds':>8} "
+        f"{'errors':>6} {'429s':>6} {'MB':>7}"
+    )
+    for r in results:
+        print(
+            f"{r['mode']:<12} {r['datasets']:>8} {r['seconds']:>8.1f} {r['datasets_per_minute']:>8.1f} "
+            f"{r['calls']:>7} {r['calls_per_dataset']:>8.2f} {r['errors']:>6} {r['rate_limited']:>6} "
+            f"{r['uploaded_mb']:>7.1f}"
+        )
+    for r in results:
+        print(f"{r['mode']}: {r['calls_by_action']}")
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.split("\n\n")[0])
+    parser.add_argument(
+        "--data", help="Data folder (defaults to data or tests/fixtures)"
+    )
+    parser.add_argument("--modes", default=",".join(modes), help="Modes to run")
+    parser.add_argument("--latency", type=float, default=0.0, help="Seconds per call")
+    parser.add_argument("--jitter", type=float, default=0.0, help="Seconds +/-")
+    parser.add_argument(
+        "--error-rate", type=float, default=0.0, help="Share of calls failing with 500"
+    )
+    parser.add_argument(
+        "--rate-limit",
+        type=float,
+        default=0.0,
+        help="Calls per second (0 for no limit)",
+    )
+    parser.add_argument(
+        "--burst", type=int, default=10, help="Burst allowed by the rate limit"
+    )
+    parser.add_argument(
+        "--seed", type=int, default=1, help="Seed of the injected errors"
+    )
+    args = parser.parse_args()
+
+    data_folder = args.data
+    if not data_folder:
+        data_folder = "data" if exists("data") else join("tests", "fixtures")
+    data_folder = abspath(data_folder)
+    simulator_options = {
+        "latency": args.latency,
+        "jitter": args.jitter,
+        "error_rate": args.error_rate,
+        "rate_limit": args.rate_limit,
+        "burst": args.burst,
+        "seed": args.seed,
+    }
+    # Use the country data packaged with hdx-python-country instead of downloading it
+    Country.countriesdata(use_live=False)
+    # Don't wait for the 5 seconds given to check the resources configuration
+    run.sleep = lambda seconds: None
+    results = [
+        run_mode(name, data_folder, simulator_options) for name in args.modes.split(",")
+    ]
+    print_results(results)
+
+
+if __name__ == "__main__":
+    setup_logging(console_log_level="WARNING")
+    main()
@@ -0,0 +1,202 @@
+"""
+In-memory buffers for the generated resource files.
+
+HDX uploads the resources from file paths (create_in_hdx opens the file to hash and upload it), so the buffers are
+files in a memory backed folder (/dev/shm on Linux) rather than file objects. Each country gets its own buffer
+folder. The files spill to the temporary folder on disk as they are generated, so that large files (e.g. those of the
+world) never sit whole in memory:
+
+- a file written through open_resource_file moves to disk as soon as it grows above the spill threshold,
+- a file written by HDX (generate_resource) moves to disk right after it is written if above the threshold,
+- a file is written to disk from the start when the memory backed folder has less than the threshold free, and
+  moves (or is written again) to disk if the memory runs out while writing it.
+
+The buffers of a country are freed as soon as it is published.
+"""
+
+import logging
+import os
+from errno import ENOSPC
+from os import W_OK, access, makedirs
+from os.path import basename, getsize, isdir, join
+from shutil import move, rmtree
+from tempfile import mkdtemp
+
+logger = logging.getLogger(__name__)
+
+memory_root = "/dev/shm"
+
+
+class BufferFolder(str):
+    """Memory backed folder *path* of a country, whose files spill to *spill_folder* when larger than *threshold*
+    bytes. As a str it can be used as the folder path wherever a folder is expected.
+    """
+
+    def __new__(cls, path, spill_folder, threshold):
+        folder = super().__new__(cls, path)
+        folder.spill_folder = spill_folder
+        folder.threshold = threshold
+        return folder
+
+    def __reduce__(self):
+        # Sent to the processes generating the countries
+        return BufferFolder, (str(self), self.spill_folder, self.threshold)
+
+    def has_room(self):
+        """True if there is room in memory for a file up to the threshold"""
+        stat = os.statvfs(self)
+        return stat.f_bavail * stat.f_frsize >= self.threshold
+
+    def disk_folder(self):
+        makedirs(self.spill_folder, exist_ok=True)
+        return self.spill_folder
+
+    def spill(self, resource):
+        """Move the file of *resource* to disk if it is above the threshold"""
+        path = resource.get_file_to_upload()
+        if not path or not path.startswith(self) or getsize(path) <= self.threshold:
+            return
+        new_path = join(self.disk_folder(), basename(path))
+        move(path, new_path)
+        resource.set_file_to_upload(new_path)
+        logger.info(f"Spilled {basename(path)} to disk")
+
+
+class SpillingFile:
+    """Text file *filename* written (utf-8) into the BufferFolder *folder*, moved to disk and written there from
+    then on once larger than the threshold or when the memory runs out. *name* is the current path of the file.
+    """
+
+    def __init__(self, folder, filename, buffer_size=1 << 20):
+        self.folder = folder
+        self.filename = filename
+        self.buffer_size = buffer_size
+        self.in_memory = folder.has_room()
+        if self.in_memory:
+            self.name = join(folder, filename)
+        else:
+            self.name = join(folder.disk_folder(), filename)
+        # Unbuffered, so that the bytes in the file are known if the memory runs out
+        self.file = open(self.name, "wb", buffering=0)
+        self.size = 0
+        self.pending = []
+        self.pending_size = 0
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *args):
+        self.close()
+
+    def write(self, s):
+        self.pending.append(s)
+        self.pending_size += len(s)
+        if self.pending_size >= self.buffer_size:
+            self.flush()
+        return len(s)
+
+    def flush(self):
+        view = memoryview("".join(self.pending).encode("utf-8"))
+        self.pending = []
+        self.pending_size = 0
+        while view:
+            try:
+                written = self.file.write(view)
+            except OSError as e:
+                if e.errno != ENOSPC or not self.in_memory:
+                    raise
+                logger.warning(f"Out of memory writing {self.filename}")
+                self.move_to_disk()
+                continue
+            view = view[written:]
+            self.size += written
+        if self.in_memory and self.size > self.folder.threshold:
+            self.move_to_disk()
+
+    def move_to_disk(self):
+        self.file.close()
+        path = join(self.folder.disk_folder(), self.filename)
+        move(self.name, path)
+        self.name = path
+        self.in_memory = False
+        self.file = open(path, "ab", buffering=0)
+        logger.info(f"Spilled {self.filename} to disk")
+
+    def close(self):
+        if not self.file.closed:
+            self.flush()
+            self.file.close()
+
+
+def open_resource_file(folder, filename):
+    """Text file to write the resource file *filename* of *folder* into, spilling to disk if *folder* is a
+    BufferFolder. Its path once written is its name.
+    """
+    if isinstance(folder, BufferFolder):
+        return SpillingFile(folder, filename)
+    return open(join(folder, filename), "w", encoding="utf-8", newline="")
+
+
+def generate_resource(folder, filename, generate):
+    """Call *generate* with the folder to write the resource file *filename* into, i.e. *folder* or the disk folder
+    of a BufferFolder short of memory. *generate* returns the (success, results) of the HDX
+    generate_resource_from_iterable, which are returned with the file moved to disk if above the threshold.
+    """
+    if not isinstance(folder, BufferFolder):
+        return generate(folder)
+    if not folder.has_room():
+        return generate(folder.disk_folder())
+    try:
+        success, results = generate(str(folder))
+    except OSError as e:
+        if e.errno != ENOSPC:
+            raise
+        logger.warning(f"Out of memory writing {filename}, writing it to disk")
+        if os.path.exists(join(folder, filename)):
+            os.remove(join(folder, filename))
+        return generate(folder.disk_folder())
+    if success:
+        folder.spill(results["resource"])
+    return success, results
+
+
+class ResourceBuffers:
+    """Buffers for the resource files of the countries, kept in a folder under *root* and spilled to *spill_folder*
+    when larger than *threshold* bytes. Falls back to *spill_folder* if there is no memory backed folder.
+    """
+
+    def __init__(self, spill_folder, threshold=64 << 20, root=memory_root):
+        self.spill_folder = spill_folder
+        self.threshold = threshold
+        if root and isdir(root) and access(root, W_OK):
+            self.memory_folder = mkdtemp(prefix="UNHCR_population_", dir=root)
+        else:
+            logger.warning(f"No memory backed folder {root}, using {spill_folder}")
+            self.memory_folder = None
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *args):
+        self.close()
+
+    def folder(self, countryiso):
+        """Folder to generate the resource files of a country into, a BufferFolder if in memory"""
+        if self.memory_folder is None:
+            folder = join(self.spill_folder, countryiso)
+            makedirs(folder, exist_ok=True)
+            return folder
+        folder = join(self.memory_folder, countryiso)
+        makedirs(folder, exist_ok=True)
+        return BufferFolder(folder, join(self.spill_folder, countryiso), self.threshold)
+
+    def free(self, countryiso):
+        """Free the buffers (and spilled files) of a country"""
+        if self.memory_folder is not None:
+            rmtree(join(self.memory_folder, countryiso), ignore_errors=True)
+        rmtree(join(self.spill_folder, countryiso), ignore_errors=True)
+
+    def close(self):
+        if self.memory_folder is not None:
+            rmtree(self.memory_folder, ignore_errors=True)
+            self.memory_folder = None
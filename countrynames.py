@@ -0,0 +1,69 @@
+"""
+Compact table of the country names (ISO3 -> name), kept in config/country_names.json.
+
+unhcr.py only needs the name of each ISO3 code. Getting it from hdx-python-country means importing it and loading
+(by default downloading) its full reference data at every launch, whereas the table loads in about a millisecond.
+The table is compiled from hdx-python-country with the same names Country.get_country_name_from_iso3 gives, and
+is recompiled when missing, when its format version changes or on demand (run.py --refresh-countries).
+"""
+
+import json
+import logging
+from importlib.metadata import version
+from os.path import dirname, exists, join
+
+logger = logging.getLogger(__name__)
+
+# Next to the module so that the table is found from other folders (e.g. doc/charts.py)
+table_path = join(dirname(__file__), "config", "country_names.json")
+# Increase when the layout of the table changes so that old tables are recompiled
+table_version = 1
+
+_names = None
+
+
+def compile_country_names(path=table_path, use_live=None):
+    """Compile the table from hdx-python-country and save it in *path*, returns the names"""
+    # Only imported here as it is slow to import and load
+    from hdx.location.country import Country
+
+    countriesdata = Country.countriesdata(use_live=use_live)
+    names = {
+        countryiso: Country.get_country_name_from_iso3(countryiso)
+        for countryiso in sorted(countriesdata["countries"])
+    }
+    table = {
+        "version": table_version,
+        "source": f"hdx-python-country {version('hdx-python-country')}",
+        "names": names,
+    }
+    with open(path, "w", encoding="utf-8") as f:
+        json.dump(table, f, ensure_ascii=False, indent=1, sort_keys=True)
+        f.write("\n")
+    logger.info(f"Compiled {len(names)} country names into {path}")
+    return names
+
+
+def load_country_names(path=table_path):
+    """Names from the table in *path*, compiled first if it is missing or outdated"""
+    if exists(path):
+        with open(path, encoding="utf-8") as f:
+            table = json.load(f)
+        if table.get("version") == table_version:
+            return table["names"]
+        logger.info(f"Country names table {path} is outdated")
+    return compile_country_names(path)
+
+
+def refresh_country_names(path=table_path):
+    """Recompile the table from the latest hdx-python-country data"""
+    global _names
+    _names = compile_country_names(path, use_live=True)
+
+
+def get_country_name(countryiso):
+    """Name of the country with ISO3 code *countryiso*, None if unknown"""
+    global _names
+    if _names is None:
+        _names = load_country_names()
+    return _names.get(countryiso.upper())
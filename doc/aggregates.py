@@ -0,0 +1,61 @@
+"""
+Aggregate tables behind the report pages of charts.py.
+
+A report chart is a country's rows (as country of origin or of asylum), possibly only for the last year, summed up per
+year or per counterpart country.  Instead of filtering and grouping the whole converted resource for every chart,
+the numeric columns of each resource are summed once per (country, year, counterpart) for each direction.  The table
+is sorted by that index, so the totals of a country are a slice of it whose size doesn't depend on the size of the
+resource.
+"""
+
+directions = ("originating", "residing")
+
+
+def direction_of(country_of):
+    """Normalised direction - "originating" or "residing" (as in filter_country)"""
+    return directions[0] if country_of.lower().startswith("o") else directions[1]
+
+
+def build_aggregates(df, country_column, counterpart_column):
+    """Sums of the numeric columns of *df* indexed by (country, year, counterpart), sorted"""
+    numeric = [
+        column
+        for column in df.select_dtypes("number").columns
+        if column not in ("Year", country_column, counterpart_column)
+    ]
+    # The country columns are categorical: only the combinations in the data (observed), not all of them
+    table = df.groupby(
+        [country_column, "Year", counterpart_column],
+        dropna=False,
+        sort=True,
+        observed=True,
+    )[numeric].sum()
+    table.index.names = ["country", "Year", "counterpart"]
+    return table
+
+
+def lookup_totals(
+    table, countryiso, column="Country", last_year_only=False, country_map=None
+):
+    """Totals of *countryiso* from an aggregate *table*, the same (numeric) values as
+    filter_country, then last_year if *last_year_only*, then totals_per-*column* give.
+    *column* is "Year" or "Country" (counterpart names from *country_map*).
+    """
+    try:
+        rows = table.xs(countryiso, level="country")
+    except KeyError:
+        rows = table.iloc[:0].droplevel("country")
+    if last_year_only and len(rows):
+        year = rows.index.get_level_values("Year").max()
+        rows = rows.xs(year, level="Year", drop_level=False)
+    if column == "Year":
+        result = rows.groupby(level="Year").sum()
+    else:
+        rows = rows.reset_index()
+        rows[column] = [(country_map or {}).get(c, "") for c in rows.counterpart]
+        result = (
+            rows.drop(columns=["Year", "counterpart"])
+            .groupby(column, observed=True)
+            .sum()
+        )
+    return result.reset_index().sort_values(by=column)
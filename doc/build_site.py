@@ -0,0 +1,195 @@
+"""
+Static site of the reports of charts.py: every report page of every country and an index of them, e.g.
+  python build_site.py --output site --workers 4
+
+The pages are rendered in a pool of processes, one task per country (largest first) rendering all the pages of the
+country. The aggregate tables the pages are made from are loaded before the processes start, so that they are
+shared by all the pages. A page is only rendered again when its inputs changed: the rows of the country in the
+aggregates of its resource, the country names and the code of the reports. Their fingerprints are kept in
+manifest.json in the output folder. The folder can then be served as static files.
+"""
+
+import sys
+
+sys.path.append("..")
+
+import argparse
+import logging
+import os
+import re
+import shutil
+from os.path import exists, join
+
+import charts
+import pandas as pd
+from aggregates import directions
+from hdx.utilities.loader import load_json
+from hdx.utilities.saver import save_json
+from liquer.cache import NoCache, set_cache
+from scheduling import LargestFirstPool
+from stages import file_fingerprint, fingerprint
+
+logger = logging.getLogger(__name__)
+logger.setLevel(logging.INFO)
+logging.getLogger("scheduling").setLevel(logging.INFO)
+
+# Report pages (named as in charts.reports) and their resources
+report_resources = {
+    "applications": "asylum_applications",
+    "decisions": "asylum_decisions",
+    "demographics": "demographics",
+    "population_totals": "population_totals",
+    "solutions": "solutions",
+}
+code_files = (
+    "charts.py",
+    "aggregates.py",
+    "datastore.py",
+    "templates.py",
+    "static/charts.js",
+)
+
+worker_state = dict()
+
+
+def page_name(report, countryiso):
+    return f"{report}_{countryiso}.html"
+
+
+def country_rows(resource, direction, countryiso):
+    """Rows of *countryiso* in the aggregates of *resource* for *direction*"""
+    table = charts.aggregate_table(resource, direction)
+    try:
+        return table.xs(countryiso, level="country").reset_index()
+    except KeyError:
+        return table.iloc[:0].reset_index()
+
+
+def page_fingerprint(code, report, countryiso):
+    """Fingerprint of the inputs of the *report* page of *countryiso*"""
+    country_map = charts.store.country_map()
+    parts = [code, report, country_map.get(countryiso)]
+    for direction in directions:
+        rows = country_rows(report_resources[report], direction, countryiso)
+        hashes = pd.util.hash_pandas_object(rows, index=False)
+        names = [country_map.get(c) for c in rows.counterpart]
+        parts.append((list(rows.columns), hashes.to_numpy().tobytes().hex(), names))
+    return fingerprint(*parts)
+
+
+def country_cost(countryiso):
+    """Rows of the country in all the aggregates"""
+    return sum(
+        len(country_rows(resource, direction, countryiso))
+        for resource in report_resources.values()
+        for direction in directions
+    )
+
+
+def write_page(path, html):
+    """Write *html* to *path*, replacing the file at once so that it is never served half written"""
+    with open(f"{path}.tmp", "w", encoding="utf-8") as f:
+        f.write(html)
+    os.replace(f"{path}.tmp", path)
+
+
+def init_worker(output):
+    worker_state["output"] = output
+    for resource in report_resources.values():
+        for direction in directions:
+            charts.aggregate_table(resource, direction)
+    # The charts of the pages are only used once, there is no point caching them
+    set_cache(NoCache())
+
+
+def render_pages(task):
+    """Render the report pages of a country. *task* is a tuple (countryiso, reports)"""
+    countryiso, reports = task
+    for report in reports:
+        html = getattr(charts, f"report_{report}")(countryiso)
+        write_page(join(worker_state["output"], page_name(report, countryiso)), html)
+    return reports
+
+
+def build_site(output, workers, countries=None, force=False):
+    """Render the report pages of *countries* (all by default) into *output*, returns the number of pages
+    rendered and skipped
+    """
+    os.makedirs(output, exist_ok=True)
+    manifest_path = join(output, "manifest.json")
+    manifest = load_json(manifest_path) if exists(manifest_path) else dict()
+    if countries is None:
+        countries = list(charts.store.countries().iso3)
+    code = [file_fingerprint(path) for path in code_files]
+    tasks = []
+    fingerprints = dict()
+    skipped = 0
+    for countryiso in countries:
+        reports = []
+        for report in report_resources:
+            name = page_name(report, countryiso)
+            fingerprints[name] = page_fingerprint(code, report, countryiso)
+            if (
+                not force
+                and manifest.get(name) == fingerprints[name]
+                and exists(join(output, name))
+            ):
+                skipped += 1
+                continue
+            reports.append(report)
+        if reports:
+            tasks.append((countryiso, reports))
+    logger.info(
+        f"Rendering {sum(len(x[1]) for x in tasks)} pages of {len(tasks)} countries, {skipped} pages unchanged"
+    )
+    rendered = 0
+    if tasks:
+        costs = {countryiso: country_cost(countryiso) + 1 for countryiso, _ in tasks}
+        pool = LargestFirstPool(
+            render_pages,
+            costs,
+            workers,
+            key=lambda x: x[0],
+            initializer=init_worker,
+            initargs=(output,),
+        )
+        try:
+            for (countryiso, _), reports in pool.map(tasks):
+                for report in reports:
+                    name = page_name(report, countryiso)
+                    manifest[name] = fingerprints[name]
+                rendered += len(reports)
+        finally:
+            save_json(manifest, manifest_path)
+        pool.report()
+    # Script drawing the charts given as specs
+    os.makedirs(join(output, "static"), exist_ok=True)
+    shutil.copy(join("static", "charts.js"), join(output, "static", "charts.js"))
+    # The index links to the static pages instead of the LiQuer queries
+    index = re.sub(r"/liquer/q/report_\w+?-\w+/", "", charts.reports())
+    write_page(join(output, "index.html"), index)
+    return rendered, skipped
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.split("\n\n")[0])
+    parser.add_argument("--output", default="site", help="Output folder")
+    parser.add_argument(
+        "--workers", type=int, default=os.cpu_count(), help="Number of processes"
+    )
+    parser.add_argument(
+        "--countries", default="", help="Comma separated ISO3 codes (all by default)"
+    )
+    parser.add_argument(
+        "--force", action="store_true", help="Render unchanged pages too"
+    )
+    args = parser.parse_args()
+    countries = None
+    if args.countries:
+        countries = [x.strip().upper() for x in args.countries.split(",")]
+    rendered, skipped = build_site(args.output, args.workers, countries, args.force)
+    logger.info(f"Rendered {rendered} pages, {skipped} unchanged")
+
+
+if __name__ == "__main__":
+    main()
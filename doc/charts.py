@@ -2,21 +2,34 @@ import sys
 
 sys.path.append("..")
 
+import argparse
+import glob
+import gzip
+import html
+import json
 import logging
 import os.path
 import webbrowser
 
 import liquer.blueprint as bp
+import numpy as np
 import pandas as pd
 import plotly.express as px
 
 # import liquer.ext.lq_hxl
 import yaml
-from fields import convert_fields_in_iterator, convert_headers, hxltags_mapping
-from flask import Flask, redirect
-from liquer import command, evaluate, evaluate_template, first_command
-from liquer.cache import MemoryCache, set_cache
+from aggregates import build_aggregates, direction_of, directions, lookup_totals
+from datastore import DataStore, resource_files
+from fields import convert_headers, encoding, hxltags_mapping
+from flask import Flask, Response, redirect, request
+from liquer import command, evaluate, first_command
+from liquer.cache import set_cache
+from liquer.context import set_context_creator
 from liquer.state import get_vars, set_var
+from plotly.offline import get_plotlyjs_version
+from querycache import CoalescingContext, FingerprintedFileCache, data_fingerprint
+from stages import fingerprint
+from templates import evaluate_report
 
 # Use the extended method to cater for non-standard UNHCR ISO codes (STA, UKN etc.)
 from unhcr import Get_Country_Name_From_ISO3_Extended
@@ -32,6 +45,15 @@ app.register_blueprint(bp.app, url_prefix=url_prefix)
 set_var("api_path", url_prefix + "/q/")
 set_var("server", "http://localhost:5000")
 
+configuration_path = "../config/project_configuration.yml"
+cache_path = "cache"
+cache_size = 512 << 20  # bytes
+# Data slice API
+api_version = 1
+default_page_size = 1000
+max_page_size = 10000
+gzip_min_size = 1024  # bytes
+
 
 def data_path():
     if os.path.exists("../data/HDX_AsylumApplications.csv"):
@@ -40,77 +62,85 @@ def data_path():
         return "../tests/fixtures"
 
 
+# Each data file is read once, typed and indexed by country
+store = DataStore(data_path(), Get_Country_Name_From_ISO3_Extended)
+
+
 @first_command
 def config():
     "Config data structure containing the field name conversions and hxl tags"
-    return yaml.load(open("../config/project_configuration.yml"))
+    with open(configuration_path) as f:
+        return yaml.safe_load(f)
 
 
 @first_command
 def asylum_applications():
     "Return raw asylum application data"
-    return pd.read_csv(f"{data_path()}/HDX_AsylumApplications.csv")
+    return store.table("asylum_applications").df
 
 
 @first_command
 def asylum_decisions():
     "Return raw asylum decision data"
-    return pd.read_csv(f"{data_path()}/HDX_AsylumDecisions.csv")
+    return store.table("asylum_decisions").df
 
 
 @first_command
 def demographics():
     "Return raw demographic data"
-    return pd.read_csv(f"{data_path()}/HDX_Demographics.csv")
+    return store.table("demographics").df
 
 
 @first_command
 def population_totals():
     "Return raw end year population totals data"
-    return pd.read_csv(f"{data_path()}/HDX_EndYearPopulationTotals.csv")
+    return store.table("population_totals").df
 
 
 @first_command
 def solutions():
     "Return raw solutions data"
-    return pd.read_csv(f"{data_path()}/HDX_Solutions.csv")
+    return store.table("solutions").df
 
 
 @first_command
 def countries():
     "Table of countries (iso3 and country name) used in the data"
-    countries = set()
-    for data in [
-        "asylum_applications",
-        "asylum_decisions",
-        "demographics",
-        "population_totals",
-        "solutions",
-    ]:
-        df = evaluate(data).get()
-        countries.update(df.ISO3CoO)
-        countries.update(df.ISO3CoA)
-    countries = sorted(countries)
-    countrynames = [
-        #        Country.get_country_name_from_iso3(countryiso) for countryiso in countries
-        Get_Country_Name_From_ISO3_Extended(countryiso)
-        for countryiso in countries
-    ]
-    return pd.DataFrame(dict(iso3=countries, country=countrynames))
+    return store.countries()
+
+
+def decode_column(column, field_map):
+    """Values of *column* decoded with *field_map* (None if not in the map), looked up once per distinct value"""
+    codes, values = pd.factorize(column)
+    decoded = [field_map.get(value) for value in values]
+    # Missing values have code -1, so they take the last element
+    decoded = np.array(decoded + [field_map.get(None)], dtype=object)[codes]
+    return pd.Series(decoded, index=column.index).infer_objects()
 
 
 @command
 def convert(df, add_hxltags=True):
-    "Rename fields and optionally add hxl tags"
+    """Rename fields and optionally add hxl tags.
+    Same result as converting the records with convert_fields_in_iterator, but column by column.
+    """
     fields = config()["fields"]
+    encoding_map, encoding_field_names = encoding(fields, use_original_field_names=True)
     columns = convert_headers(df.columns, fields)
-    mapping = hxltags_mapping(fields)
+    df = df.reset_index(drop=True)
+    converted = df.rename(
+        columns=lambda field: fields.get(field, {}).get("name", field)
+    )
+    for field in df.columns:
+        if field in encoding_map:
+            converted[encoding_field_names[field]] = decode_column(
+                df[field], encoding_map[field]
+            )
+    converted = converted[columns]
     if add_hxltags:
-        hxltags = [{c: mapping.get(c, "") for c in columns}]
-    else:
-        hxltags = []
-    data = hxltags + list(convert_fields_in_iterator(df.to_dict("records"), fields))
-    return pd.DataFrame(data, columns=columns)
+        mapping = hxltags_mapping(fields)
+        hxltags = pd.DataFrame([{c: mapping.get(c, "") for c in columns}])
+        converted = pd.concat([hxltags, converted], ignore_index=True).infer_objects()
+    return converted
 
 
 def country_columns(df):
@@ -132,16 +162,17 @@ def filter_country(df, countryiso, country_of="originating"):
     """Keep only rows for one country - originating or residing.
     A column "Country" with column names of the variable country (residing or originating) is created.
     """
-    countries_table = evaluate(
-        "countries"
-    ).get()  # evaluate rather than call, so that the cache is used
-    country_map = dict(zip(countries_table.iso3, countries_table.country))
+    country_map = store.country_map()
     coo, coa = country_columns(df)
     is_originating = country_of.lower().startswith("o")
 
     fixed_country_column = coo if is_originating else coa
     variable_country_column = coa if is_originating else coo
-    df = df.loc[df[fixed_country_column] == countryiso, :]
+    table = store.indexed(df)
+    if table is not None:
+        df = df.iloc[table.positions(direction_of(country_of), countryiso)]
+    else:
+        df = df.loc[df[fixed_country_column] == countryiso, :]
     df["Country"] = [country_map.get(c, "") for c in df[variable_country_column]]
     return df
 
@@ -149,7 +180,7 @@ def filter_country(df, countryiso, country_of="originating"):
 @command
 def totals_per(df, column="Country"):
     "Group by a specific column and sum up each group (all numeric columns)"
-    df = df.groupby([column]).sum().reset_index()
+    df = df.groupby([column], observed=True).sum(numeric_only=True).reset_index()
     return df.sort_values(by=column)
 
 
@@ -159,34 +190,110 @@ def last_year(df):
     return df.loc[df.Year == df.Year.max(), :]
 
 
+@first_command
+def aggregates(resource, country_of="originating"):
+    "Sums of the numeric columns of a resource per country (originating or residing), year and counterpart country"
+    df = evaluate(f"{resource}/convert-f").get()
+    coo, coa = country_columns(df)
+    if direction_of(country_of) == "originating":
+        return build_aggregates(df, coo, coa)
+    return build_aggregates(df, coa, coo)
+
+
+# Aggregate tables by (resource, direction), loaded once from the cache as they are used for every report
+aggregate_tables = {}
+
+
+def aggregate_table(resource, country_of="originating"):
+    "Aggregates of a resource for a direction (originating or residing)"
+    key = (resource, direction_of(country_of))
+    if key not in aggregate_tables:
+        aggregate_tables[key] = evaluate(f"aggregates-{key[0]}-{key[1]}").get()
+    return aggregate_tables[key]
+
+
+@first_command
+def totals(
+    resource,
+    countryiso,
+    country_of="originating",
+    column="Country",
+    last_year_only=False,
+):
+    """Totals per Year or Country of the rows of one country in a resource, looked up in the aggregates.
+    Same numeric columns as resource/convert-f/filter_country/[last_year/]totals_per.
+    """
+    table = aggregate_table(resource, country_of)
+    country_map = store.country_map()
+    return lookup_totals(table, countryiso, column, last_year_only, country_map)
+
+
+def chart_spec(spec):
+    "Placeholder for a chart given by a compact *spec*, drawn in the browser by static/charts.js"
+    spec = json.dumps(spec, separators=(",", ":"))
+    return f'<div class="chart" data-spec="{html.escape(spec)}"></div>'
+
+
+def chart_scripts(output):
+    "Scripts drawing the charts of a page, if they are given as specs"
+    if output != "spec":
+        return ""
+    return f"""<script defer src="https://cdn.plot.ly/plotly-{get_plotlyjs_version()}.min.js"></script>
+  <script defer src="/static/charts.js"></script>"""
+
+
+def pie_chart(df, values_column, names_column, output):
+    "Pie chart as plotly html, or as a spec if *output* is spec"
+    if output == "spec":
+        return chart_spec(
+            dict(
+                type="pie",
+                labels=df[names_column].tolist(),
+                values=df[values_column].tolist(),
+            )
+        )
+    return px.pie(
+        df, values=values_column, names=names_column, width=600, height=400
+    ).to_html(full_html=False, include_plotlyjs="cdn")
+
+
+def bar_chart(df, x_column, y, output):
+    "Bar chart of the *y* column (or columns) as plotly html, or as a spec if *output* is spec"
+    if output == "spec":
+        y_columns = [y] if isinstance(y, str) else y
+        series = {column: df[column].tolist() for column in y_columns}
+        return chart_spec(
+            dict(type="bar", x=df[x_column].tolist(), x_title=x_column, series=series)
+        )
+    return px.bar(df, x=x_column, y=y, width=600, height=400).to_html(
+        full_html=False, include_plotlyjs="cdn"
+    )
+
+
 @command
-def pie(df, values_column, names_column="Country"):
-    "Create a pie chart (plotly html)"
+def pie(df, values_column, names_column="Country", output="html"):
+    "Create a pie chart (plotly html, or spec for a compact spec drawn by static/charts.js)"
     assert values_column in df.columns
     assert names_column in df.columns
     if len(df) == 0:
         return '<div class="alert alert-warning" role="alert">No data</div>'
-    return px.pie(
-        df, values=values_column, names=names_column, width=600, height=400
-    ).to_html(full_html=False, include_plotlyjs="cdn")
+    return pie_chart(df, values_column, names_column, output)
 
 
 @command
-def bar(df, y_column, x_column="Year"):
-    "Create a bar chart (plotly html)"
+def bar(df, y_column, x_column="Year", output="html"):
+    "Create a bar chart (plotly html, or spec for a compact spec drawn by static/charts.js)"
     if x_column not in df.columns:
         return f'<div class="alert alert-warning" role="alert">{x_column} not in dataframe</div>'
     if y_column not in df.columns:
         return f'<div class="alert alert-warning" role="alert">{y_column} not in dataframe</div>'
     if len(df) == 0:
         return '<div class="alert alert-warning" role="alert">No data</div>'
-    return px.bar(df, x=x_column, y=y_column, width=600, height=400).to_html(
-        full_html=False, include_plotlyjs="cdn"
-    )
+    return bar_chart(df, x_column, y_column, output)
 
 
 @command
-def decision_bar(df, x_column="Country"):
+def decision_bar(df, x_column="Country", output="html"):
     "Create a bar chart for decision categories"
     y = ["Recognized", "Complementary Protection", "Otherwise Closed", "Rejected"]
     y = [c for c in y if c in df.columns]
@@ -197,17 +304,11 @@ def decision_bar(df, x_column="Country"):
     if len(df) == 0:
         return '<div class="alert alert-warning" role="alert">No data</div>'
 
-    return px.bar(
-        df,
-        x=str(x_column),
-        y=y,
-        width=600,
-        height=400,
-    ).to_html(full_html=False, include_plotlyjs="cdn")
+    return bar_chart(df, str(x_column), y, output)
 
 
 @command
-def demographics_bar(df, x_column="Country", detailed=False):
+def demographics_bar(df, x_column="Country", detailed=False, output="html"):
     "Create a bar chart for demographics categories"
     if detailed:
         y = [
@@ -235,24 +336,18 @@ def demographics_bar(df, x_column="Country", detailed=False):
         return '<div class="alert alert-warning" role="alert">No data</div>'
 
     "Create a bar chart for decision categories"
-    return px.bar(
-        df,
-        x=str(x_column),
-        y=y,
-        width=600,
-        height=400,
-    ).to_html(full_html=False, include_plotlyjs="cdn")
+    return bar_chart(df, str(x_column), y, output)
 
 
 @command
-def population_bar(df, x_column="Country"):
+def population_bar(df, x_column="Country", output="html"):
     "Create a bar chart for population totals categories"
     if len(df) == 0:
         return '<div class="alert alert-warning" role="alert">No data</div>'
-    return px.bar(
+    return bar_chart(
         df,
-        x=str(x_column),
-        y=[
+        str(x_column),
+        [
             "Refugees",
             "Asylum-seekers",
             "Other people in need of international protection",
@@ -260,39 +355,34 @@ def population_bar(df, x_column="Country"):
             "Others of Concern to UNHCR",
             "Stateless persons",
         ],
-        width=600,
-        height=400,
-    ).to_html(full_html=False, include_plotlyjs="cdn")
+        output,
+    )
 
 
 @command
-def solutions_bar(df, x_column="Country"):
+def solutions_bar(df, x_column="Country", output="html"):
     "Create a bar chart for solutions categories"
     if len(df) == 0:
         return '<div class="alert alert-warning" role="alert">No data</div>'
-    return px.bar(
+    return bar_chart(
         df,
-        x=str(x_column),
-        y=["Resettlement arrivals", "Naturalisation", "Refugee returns", "IDP returns"],
-        width=600,
-        height=400,
-    ).to_html(full_html=False, include_plotlyjs="cdn")
+        str(x_column),
+        ["Resettlement arrivals", "Naturalisation", "Refugee returns", "IDP returns"],
+        output,
+    )
 
 
 @first_command
-def report_applications(countryiso):
-    "Create a report as html for asylum applications for a specific country"
-    countries_table = evaluate(
-        "countries"
-    ).get()  # evaluate rather than call, so that the cache is used
-    country_map = dict(zip(countries_table.iso3, countries_table.country))
-    country_name = country_map.get(countryiso)
-    return evaluate_template(
+def report_applications(countryiso, output="spec"):
+    "Create a report as html for asylum applications for a specific country (charts as html or spec)"
+    country_name = store.country_map().get(countryiso)
+    return evaluate_report(
         f"""
 <html>
 <head>
   <title>Asylum Applications - {country_name}</title>
   <link rel="stylesheet" href="https://stackpath.bootstrapcdn.com/bootstrap/4.5.0/css/bootstrap.min.css" integrity="sha384-9aIt2nRpC12Uk9gS9baDl411NQApFmC26EwAOH8WgZl5MYYxFfc+NcPb1dKGj7Sk" crossorigin="anonymous">
+  {chart_scripts(output)}
 
 </head>
 
@@ -303,21 +393,21 @@ def report_applications(countryiso):
     <div class="row">
       <div class="col-sm">
         <h4>Last year applications by country for refugees originating from {country_name}</h4>
-        $asylum_applications/convert-f/filter_country-{countryiso}-originating/last_year/totals_per-Country/pie-Number~.of~.Applications$
+        $totals-asylum_applications-{countryiso}-originating-Country-t/pie-Number~.of~.Applications-Country-{output}$
       </div>
       <div class="col-sm">
         <h4>Last year applications by country for refugees residing in {country_name}</h4>
-        $asylum_applications/convert-f/filter_country-{countryiso}-residing/last_year/totals_per-Country/pie-Number~.of~.Applications$
+        $totals-asylum_applications-{countryiso}-residing-Country-t/pie-Number~.of~.Applications-Country-{output}$
       </div>
     </div>
     <div class="row">
       <div class="col-sm">
         <h4>Applications by year for refugees originating from {country_name}</h4>
-        $asylum_applications/convert-f/filter_country-{countryiso}-originating/totals_per-Year/bar-Number~.of~.Applications$
+        $totals-asylum_applications-{countryiso}-originating-Year/bar-Number~.of~.Applications-Year-{output}$
       </div>
       <div class="col-sm">
         <h4>Applications by year for refugees residing in {country_name}</h4>
-        $asylum_applications/convert-f/filter_country-{countryiso}-residing/totals_per-Year/bar-Number~.of~.Applications$
+        $totals-asylum_applications-{countryiso}-residing-Year/bar-Number~.of~.Applications-Year-{output}$
       </div>
     </div>
   </div>
@@ -328,19 +418,16 @@ def report_applications(countryiso):
 
 
 @first_command
-def report_decisions(countryiso):
-    "Create a report as html for asylum decisions for a specific country"
-    countries_table = evaluate(
-        "countries"
-    ).get()  # evaluate rather than call, so that the cache is used
-    country_map = dict(zip(countries_table.iso3, countries_table.country))
-    country_name = country_map.get(countryiso)
-    return evaluate_template(
+def report_decisions(countryiso, output="spec"):
+    "Create a report as html for asylum decisions for a specific country (charts as html or spec)"
+    country_name = store.country_map().get(countryiso)
+    return evaluate_report(
         f"""
 <html>
 <head>
   <title>Asylum Decisions - {country_name}</title>
   <link rel="stylesheet" href="https://stackpath.bootstrapcdn.com/bootstrap/4.5.0/css/bootstrap.min.css" integrity="sha384-9aIt2nRpC12Uk9gS9baDl411NQApFmC26EwAOH8WgZl5MYYxFfc+NcPb1dKGj7Sk" crossorigin="anonymous">
+  {chart_scripts(output)}
 
 </head>
 
@@ -351,21 +438,21 @@ def report_decisions(countryiso):
     <div class="row">
       <div class="col-sm">
         <h4>Last year decisions by country for refugees originating from {country_name}</h4>
-        $asylum_decisions/convert-f/filter_country-{countryiso}-originating/last_year/totals_per-Country/decision_bar-Country$
+        $totals-asylum_decisions-{countryiso}-originating-Country-t/decision_bar-Country-{output}$
       </div>
       <div class="col-sm">
         <h4>Last year decisions by country for refugees residing in {country_name}</h4>
-        $asylum_decisions/convert-f/filter_country-{countryiso}-residing/last_year/totals_per-Country/decision_bar-Country$
+        $totals-asylum_decisions-{countryiso}-residing-Country-t/decision_bar-Country-{output}$
       </div>
     </div>
     <div class="row">
       <div class="col-sm">
         <h4>Decisions by year for refugees originating from {country_name}</h4>
-        $asylum_decisions/convert-f/filter_country-{countryiso}-originating/totals_per-Year/decision_bar-Year$
+        $totals-asylum_decisions-{countryiso}-originating-Year/decision_bar-Year-{output}$
       </div>
       <div class="col-sm">
         <h4>Decisions by year for refugees residing in {country_name}</h4>
-        $asylum_decisions/convert-f/filter_country-{countryiso}-residing/totals_per-Year/decision_bar-Year$
+        $totals-asylum_decisions-{countryiso}-residing-Year/decision_bar-Year-{output}$
       </div>
     </div>
   </div>
@@ -376,19 +463,16 @@ def report_decisions(countryiso):
 
 
 @first_command
-def report_demographics(countryiso):
-    "Create a report as html for demographics for a specific country"
-    countries_table = evaluate(
-        "countries"
-    ).get()  # evaluate rather than call, so that the cache is used
-    country_map = dict(zip(countries_table.iso3, countries_table.country))
-    country_name = country_map.get(countryiso)
-    return evaluate_template(
+def report_demographics(countryiso, output="spec"):
+    "Create a report as html for demographics for a specific country (charts as html or spec)"
+    country_name = store.country_map().get(countryiso)
+    return evaluate_report(
         f"""
 <html>
 <head>
   <title>Demographics - {country_name}</title>
   <link rel="stylesheet" href="https://stackpath.bootstrapcdn.com/bootstrap/4.5.0/css/bootstrap.min.css" integrity="sha384-9aIt2nRpC12Uk9gS9baDl411NQApFmC26EwAOH8WgZl5MYYxFfc+NcPb1dKGj7Sk" crossorigin="anonymous">
+  {chart_scripts(output)}
 
 </head>
 
@@ -399,21 +483,21 @@ def report_demographics(countryiso):
     <div class="row">
       <div class="col-sm">
         <h4>Last year demographics by country for refugees originating from {country_name}</h4>
-        $demographics/convert-f/filter_country-{countryiso}-originating/last_year/totals_per-Country/demographics_bar-Country-f$
+        $totals-demographics-{countryiso}-originating-Country-t/demographics_bar-Country-f-{output}$
       </div>
       <div class="col-sm">
         <h4>Last year demographics by country for refugees residing in {country_name}</h4>
-        $demographics/convert-f/filter_country-{countryiso}-residing/last_year/totals_per-Country/demographics_bar-Country-f$
+        $totals-demographics-{countryiso}-residing-Country-t/demographics_bar-Country-f-{output}$
       </div>
     </div>
     <div class="row">
       <div class="col-sm">
         <h4>Demographics by year for refugees originating from {country_name}</h4>
-        $demographics/convert-f/filter_country-{countryiso}-originating/totals_per-Year/demographics_bar-Year-f$
+        $totals-demographics-{countryiso}-originating-Year/demographics_bar-Year-f-{output}$
       </div>
       <div class="col-sm">
         <h4>Demographics by year for refugees residing in {country_name}</h4>
-        $demographics/convert-f/filter_country-{countryiso}-residing/totals_per-Year/demographics_bar-Year-f$
+        $totals-demographics-{countryiso}-residing-Year/demographics_bar-Year-f-{output}$
       </div>
     </div>
   </div>
@@ -424,21 +508,21 @@ def report_demographics(countryiso):
     <div class="row">
       <div class="col-sm">
         <h4>Last year demographics by country for refugees originating from {country_name}</h4>
-        $demographics/convert-f/filter_country-{countryiso}-originating/last_year/totals_per-Country/demographics_bar-Country-t$
+        $totals-demographics-{countryiso}-originating-Country-t/demographics_bar-Country-t-{output}$
       </div>
       <div class="col-sm">
         <h4>Last year demographics by country for refugees residing in {country_name}</h4>
-        $demographics/convert-f/filter_country-{countryiso}-residing/last_year/totals_per-Country/demographics_bar-Country-t$
+        $totals-demographics-{countryiso}-residing-Country-t/demographics_bar-Country-t-{output}$
       </div>
     </div>
     <div class="row">
       <div class="col-sm">
         <h4>Demographics by year for refugees originating from {country_name}</h4>
-        $demographics/convert-f/filter_country-{countryiso}-originating/totals_per-Year/demographics_bar-Year-t$
+        $totals-demographics-{countryiso}-originating-Year/demographics_bar-Year-t-{output}$
       </div>
       <div class="col-sm">
         <h4>Demographics by year for refugees residing in {country_name}</h4>
-        $demographics/convert-f/filter_country-{countryiso}-residing/totals_per-Year/demographics_bar-Year-t$
+        $totals-demographics-{countryiso}-residing-Year/demographics_bar-Year-t-{output}$
       </div>
     </div>
   </div>
@@ -450,19 +534,16 @@ def report_demographics(countryiso):
 
 
 @first_command
-def report_population_totals(countryiso):
-    "Create a report as html for population totals for a specific country"
-    countries_table = evaluate(
-        "countries"
-    ).get()  # evaluate rather than call, so that the cache is used
-    country_map = dict(zip(countries_table.iso3, countries_table.country))
-    country_name = country_map.get(countryiso)
-    return evaluate_template(
+def report_population_totals(countryiso, output="spec"):
+    "Create a report as html for population totals for a specific country (charts as html or spec)"
+    country_name = store.country_map().get(countryiso)
+    return evaluate_report(
         f"""
 <html>
 <head>
   <title>Population Totals - {country_name}</title>
   <link rel="stylesheet" href="https://stackpath.bootstrapcdn.com/bootstrap/4.5.0/css/bootstrap.min.css" integrity="sha384-9aIt2nRpC12Uk9gS9baDl411NQApFmC26EwAOH8WgZl5MYYxFfc+NcPb1dKGj7Sk" crossorigin="anonymous">
+  {chart_scripts(output)}
 
 </head>
 
@@ -473,21 +554,21 @@ def report_population_totals(countryiso):
     <div class="row">
       <div class="col-sm">
         <h4>Last year population totals - refugees originating from {country_name}</h4>
-        $population_totals/convert-f/filter_country-{countryiso}-originating/last_year/totals_per-Country/population_bar-Country$
+        $totals-population_totals-{countryiso}-originating-Country-t/population_bar-Country-{output}$
       </div>
       <div class="col-sm">
         <h4>Last year population totals - refugees residing in {country_name}</h4>
-        $population_totals/convert-f/filter_country-{countryiso}-residing/last_year/totals_per-Country/population_bar-Country$
+        $totals-population_totals-{countryiso}-residing-Country-t/population_bar-Country-{output}$
       </div>
     </div>
     <div class="row">
       <div class="col-sm">
         <h4>Population totals by year for refugees originating from {country_name}</h4>
-        $population_totals/convert-f/filter_country-{countryiso}-originating/totals_per-Year/population_bar-Year$
+        $totals-population_totals-{countryiso}-originating-Year/population_bar-Year-{output}$
       </div>
       <div class="col-sm">
         <h4>Population totals by year for refugees residing in {country_name}</h4>
-        $population_totals/convert-f/filter_country-{countryiso}-residing/totals_per-Year/population_bar-Year$
+        $totals-population_totals-{countryiso}-residing-Year/population_bar-Year-{output}$
       </div>
     </div>
   </div>
@@ -498,19 +579,16 @@ def report_population_totals(countryiso):
 
 
 @first_command
-def report_solutions(countryiso):
-    "Create a report as html for solutions for a specific country"
-    countries_table = evaluate(
-        "countries"
-    ).get()  # evaluate rather than call, so that the cache is used
-    country_map = dict(zip(countries_table.iso3, countries_table.country))
-    country_name = country_map.get(countryiso)
-    return evaluate_template(
+def report_solutions(countryiso, output="spec"):
+    "Create a report as html for solutions for a specific country (charts as html or spec)"
+    country_name = store.country_map().get(countryiso)
+    return evaluate_report(
         f"""
 <html>
 <head>
   <title>Solutions - {country_name}</title>
   <link rel="stylesheet" href="https://stackpath.bootstrapcdn.com/bootstrap/4.5.0/css/bootstrap.min.css" integrity="sha384-9aIt2nRpC12Uk9gS9baDl411NQApFmC26EwAOH8WgZl5MYYxFfc+NcPb1dKGj7Sk" crossorigin="anonymous">
+  {chart_scripts(output)}
 
 </head>
 
@@ -521,21 +599,21 @@ def report_solutions(countryiso):
     <div class="row">
       <div class="col-sm">
         <h4>Last year solutions by country for refugees originating from {country_name}</h4>
-        $solutions/convert-f/filter_country-{countryiso}-originating/last_year/totals_per-Country/solutions_bar-Country$
+        $totals-solutions-{countryiso}-originating-Country-t/solutions_bar-Country-{output}$
       </div>
       <div class="col-sm">
         <h4>Last year solutions by country for refugees residing in {country_name}</h4>
-        $solutions/convert-f/filter_country-{countryiso}-residing/last_year/totals_per-Country/solutions_bar-Country$
+        $totals-solutions-{countryiso}-residing-Country-t/solutions_bar-Country-{output}$
       </div>
     </div>
     <div class="row">
       <div class="col-sm">
         <h4>Solutions by year for refugees originating from {country_name}</h4>
-        $solutions/convert-f/filter_country-{countryiso}-originating/totals_per-Year/solutions_bar-Year$
+        $totals-solutions-{countryiso}-originating-Year/solutions_bar-Year-{output}$
       </div>
       <div class="col-sm">
         <h4>Solutions by year for refugees residing in {country_name}</h4>
-        $solutions/convert-f/filter_country-{countryiso}-residing/totals_per-Year/solutions_bar-Year$
+        $totals-solutions-{countryiso}-residing-Year/solutions_bar-Year-{output}$
       </div>
     </div>
   </div>
@@ -548,10 +626,7 @@ def report_solutions(countryiso):
 @first_command
 def reports():
     "Table of all reports for all countries"
-    countries_table = evaluate(
-        "countries"
-    ).get()  # evaluate rather than call, so that the cache is used
-    dict(zip(countries_table.iso3, countries_table.country))
+    countries_table = store.countries()
     rows = "".join(
         f"""    <tr>
       <th>{row.country}</th>
@@ -641,9 +716,157 @@ def index():
     return redirect("/liquer/static/index.html")
 
 
-# set_cache(FileCache("cache"))
-set_cache(MemoryCache())
+def api_error(status, message):
+    return Response(
+        json.dumps(dict(error=message)), status, mimetype="application/json"
+    )
+
+
+def int_argument(name, default=None, minimum=None, maximum=None):
+    """Integer query argument *name* of the request, raises ValueError if it isn't valid"""
+    value = request.args.get(name)
+    if value is None or value == "":
+        return default
+    try:
+        value = int(value)
+    except ValueError:
+        raise ValueError(f"{name} must be an integer") from None
+    if minimum is not None and value < minimum:
+        raise ValueError(f"{name} must be at least {minimum}")
+    if maximum is not None and value > maximum:
+        raise ValueError(f"{name} must be at most {maximum}")
+    return value
+
+
+@app.route(f"/api/v{api_version}/<resource>/<countryiso>")
+def data_slice(resource, countryiso):
+    """Rows of *resource* for a country as JSON. Query arguments:
+    direction - country as "originating" (country of origin, default) or "residing" (country of asylum),
+    from, to - years (included),
+    columns - comma separated columns (all by default),
+    page, page_size - page (from 1) of page_size rows.
+    The ETag is derived from the data version and the arguments, so a client sending it back in If-None-Match gets
+    304 Not Modified until the data changes.
+    """
+    if resource not in resource_files:
+        return api_error(404, f"Unknown resource {resource}")
+    table = store.table(resource)
+    countryiso = countryiso.upper()
+    direction = request.args.get("direction", "originating")
+    columns = request.args.get("columns")
+    columns = columns.split(",") if columns else list(table.df.columns)
+    try:
+        if direction not in directions:
+            raise ValueError(f"direction must be one of {', '.join(directions)}")
+        unknown = [column for column in columns if column not in table.df.columns]
+        if unknown:
+            raise ValueError(f"Unknown columns {', '.join(unknown)}")
+        first_year = int_argument("from")
+        last_year = int_argument("to")
+        page = int_argument("page", 1, minimum=1)
+        page_size = int_argument(
+            "page_size", default_page_size, minimum=1, maximum=max_page_size
+        )
+    except ValueError as e:
+        return api_error(400, str(e))
+    arguments = dict(
+        resource=resource,
+        country=countryiso,
+        direction=direction,
+        first_year=first_year,
+        last_year=last_year,
+        columns=columns,
+        page=page,
+        page_size=page_size,
+    )
+    etag = fingerprint(api_version, data_version, arguments)
+    if request.if_none_match.contains_weak(etag):
+        response = Response(status=304)
+    else:
+        positions = table.year_positions(direction, countryiso, first_year, last_year)
+        rows = table.df.iloc[positions[(page - 1) * page_size : page * page_size]]
+        pages = (len(positions) + page_size - 1) // page_size
+        metadata = dict(
+            api_version=api_version,
+            data_version=data_version,
+            **arguments,
+            total_rows=len(positions),
+            pages=pages,
+            next_page=page + 1 if page < pages else None,
+        )
+        # The rows are serialised by pandas (categories, missing values), spliced in the metadata object
+        body = json.dumps(metadata)[:-1] + ', "rows": '
+        body = (body + rows[columns].to_json(orient="values") + "}").encode("utf-8")
+        response = Response(body, mimetype="application/json")
+        if len(body) >= gzip_min_size and request.accept_encodings["gzip"] > 0:
+            response.set_data(gzip.compress(body, 6))
+            response.headers["Content-Encoding"] = "gzip"
+    # Weak, as the gzipped and plain bodies are equivalent
+    response.set_etag(etag, weak=True)
+    response.headers["Cache-Control"] = "no-cache"
+    response.vary.add("Accept-Encoding")
+    return response
+
+
+# Version of the data files and of the field conversions
+data_version = data_fingerprint(
+    glob.glob(f"{data_path()}/HDX_*.csv"), configuration_path
+)
+
+# Results persist across restarts and are invalidated when the data or the field conversions change
+set_cache(FingerprintedFileCache(cache_path, data_version, cache_size))
+# Identical queries evaluated at the same time (by other requests or server processes) wait for the first one
+set_context_creator(CoalescingContext)
+
+
+def warm_up():
+    "Load the data, countries and aggregates, so that they are shared by the workers forked when serving"
+    for resource in resource_files:
+        store.table(resource)
+        for direction in directions:
+            aggregate_table(resource, direction)
+    store.countries()
+
+
+def serve(host, port, workers, threads):
+    """Serve the app with gunicorn in *workers* processes of *threads* threads. The data and aggregates are loaded
+    before the workers are forked (preload), so that they share them.
+    """
+    from gunicorn.app.base import BaseApplication
+
+    class Server(BaseApplication):
+        def load_config(self):
+            self.cfg.set("bind", f"{host}:{port}")
+            self.cfg.set("workers", workers)
+            self.cfg.set("threads", threads)
+            self.cfg.set("preload_app", True)
+            # A cold report evaluates many queries
+            self.cfg.set("timeout", 120)
+
+        def load(self):
+            warm_up()
+            return app
+
+    Server().run()
+
 
 if __name__ == "__main__":
-    webbrowser.open("http://localhost:5000")
-    app.run(debug=True, threaded=False)
+    parser = argparse.ArgumentParser(description="LiQuer server of the UNHCR data")
+    parser.add_argument(
+        "--workers",
+        type=int,
+        default=0,
+        help="Serve requests with gunicorn in N processes (default: development server)",
+    )
+    parser.add_argument(
+        "--threads", type=int, default=1, help="Threads of each gunicorn process"
+    )
+    parser.add_argument("--host", default="localhost", help="Interface to listen on")
+    parser.add_argument("--port", type=int, default=5000, help="Port to listen on")
+    args = parser.parse_args()
+    if args.workers:
+        # The query results are shared through the file cache, and identical queries are coalesced by it
+        serve(args.host, args.port, args.workers, args.threads)
+    else:
+        webbrowser.open(f"http://{args.host}:{args.port}")
+        app.run(args.host, args.port, debug=True, threaded=False)
@@ -0,0 +1,156 @@
+"""
+Typed and indexed store of the UNHCR data files used by charts.py.
+
+Each file is read once with explicit types: the ISO3 and code columns are categorical, the years are 16 bit integers
+and the counts are 32 bit integers when they fit (they are written as floats like 1e+05 in some files).  Only empty
+values are missing, so that e.g. Namibia (NA) isn't read as a missing value.
+
+For each direction (originating or residing) the row positions are kept sorted by (country, year), so that the rows
+of a country are a slice found by binary search rather than a scan of the whole table.  The table of the countries
+used in the data is computed once.
+"""
+
+from os.path import join
+
+import numpy as np
+import pandas as pd
+from aggregates import directions
+
+resource_files = {
+    "asylum_applications": "HDX_AsylumApplications.csv",
+    "asylum_decisions": "HDX_AsylumDecisions.csv",
+    "demographics": "HDX_Demographics.csv",
+    "population_totals": "HDX_EndYearPopulationTotals.csv",
+    "solutions": "HDX_Solutions.csv",
+}
+
+# Country of origin and of asylum columns, in the order of directions
+country_columns = ("ISO3CoO", "ISO3CoA")
+code_columns = country_columns + (
+    "ProcedureType",
+    "ApplicationType",
+    "ApplicationDataType",
+    "DecisionType",
+    "DecisionDataType",
+    "PT",
+    "location",
+    "urbanRural",
+    "accommodationType",
+)
+ratio_columns = ("ApplicationAveragePersonsPerCase", "DecisionsAveragePersonsPerCase")
+
+
+def compact_counts(column):
+    """*column* as 32 or 64 bit integers if it only holds whole numbers"""
+    if column.isna().any() or (column != column.round()).any():
+        return column
+    if column.abs().max() < 1 << 31:
+        return column.astype("int32")
+    return column.astype("int64")
+
+
+def read_typed_csv(path):
+    """Read a data file with the types of its columns"""
+    headers = pd.read_csv(path, nrows=0).columns
+    dtype = dict()
+    for column in headers:
+        if column in code_columns:
+            dtype[column] = "category"
+        elif column == "Year":
+            dtype[column] = "int16"
+        else:
+            dtype[column] = "float64"
+    df = pd.read_csv(path, dtype=dtype, keep_default_na=False, na_values=[""])
+    for column in headers:
+        if dtype[column] == "float64" and column not in ratio_columns:
+            df[column] = compact_counts(df[column])
+    return df
+
+
+class IndexedTable:
+    """Table of *resource* with the row positions of each country (in both directions)"""
+
+    def __init__(self, resource, df):
+        # Lets filter_country recognise the (converted) table
+        df.attrs["resource"] = resource
+        self.df = df
+        self.indexes = dict()
+        years = df["Year"].to_numpy()
+        for direction, column in zip(directions, country_columns):
+            codes = df[column].cat.codes.to_numpy()
+            order = np.lexsort((years, codes))
+            self.indexes[direction] = (codes[order], order)
+
+    def positions(self, direction, countryiso):
+        """Positions of the rows of *countryiso* as country of origin ("originating") or of asylum ("residing"),
+        by year
+        """
+        column = self.df[country_columns[directions.index(direction)]]
+        code = column.cat.categories.get_indexer([countryiso])[0]
+        codes, order = self.indexes[direction]
+        if code < 0:
+            return order[:0]
+        start, end = np.searchsorted(codes, [code, code + 1])
+        return order[start:end]
+
+    def year_positions(self, direction, countryiso, first_year=None, last_year=None):
+        """Positions of the rows of *countryiso* from *first_year* to *last_year* (both included), by year"""
+        positions = self.positions(direction, countryiso)
+        years = self.df["Year"].to_numpy()[positions]
+        start = 0 if first_year is None else np.searchsorted(years, first_year)
+        end = (
+            len(years)
+            if last_year is None
+            else np.searchsorted(years, last_year, "right")
+        )
+        return positions[start:end]
+
+
+class DataStore:
+    """Data files in *folder*, loaded when first used. Country names come from *get_country_name*."""
+
+    def __init__(self, folder, get_country_name):
+        self.folder = folder
+        self.get_country_name = get_country_name
+        self.tables = dict()
+        self._countries = None
+        self._country_map = None
+
+    def table(self, resource):
+        """IndexedTable of *resource*"""
+        if resource not in self.tables:
+            df = read_typed_csv(join(self.folder, resource_files[resource]))
+            self.tables[resource] = IndexedTable(resource, df)
+        return self.tables[resource]
+
+    def indexed(self, df):
+        """IndexedTable whose rows *df* has (e.g. the table renamed or converted without hxl tags), None if none"""
+        resource = df.attrs.get("resource")
+        if resource not in resource_files:
+            return None
+        table = self.table(resource)
+        if len(df) != len(table.df):
+            return None
+        return table
+
+    def countries(self):
+        """Table of countries (iso3 and country name) used in the data"""
+        if self._countries is None:
+            countries = set()
+            for resource in resource_files:
+                df = self.table(resource).df
+                for column in country_columns:
+                    countries.update(df[column].dropna().unique())
+            countries = sorted(countries)
+            countrynames = [
+                self.get_country_name(countryiso) for countryiso in countries
+            ]
+            self._countries = pd.DataFrame(dict(iso3=countries, country=countrynames))
+        return self._countries
+
+    def country_map(self):
+        """Dictionary from iso3 to country name"""
+        if self._country_map is None:
+            countries = self.countries()
+            self._country_map = dict(zip(countries.iso3, countries.country))
+        return self._country_map
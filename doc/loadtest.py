@@ -0,0 +1,376 @@
+"""
+Load test of the LiQuer server of charts.py, e.g.
+  python loadtest.py --users 8 --requests 500 --workers 2 --threads 4
+
+The server is started (as with python charts.py --workers N --threads M) in a temporary folder with synthetic
+data files of the size of the published ones, so that the results don't depend on the data at hand and start from
+an empty cache. Virtual users then replay a mix of queries (query_mix): the report pages of countries picked by
+popularity (a few large countries get most of the requests), the index of the reports and raw data queries. Each
+user sends its next request as soon as it got the previous response.
+
+Reported are the latency percentiles (p50, p95, p99) and throughput, overall and for each kind of query, and the time
+spent in the server in each LiQuer command. The command times include the commands they evaluate (e.g. a report
+includes its charts), and queries answered from the cache evaluate no commands. Save the results with --output to
+compare them before and after a change.
+"""
+
+import sys
+
+sys.path.append("..")
+
+import argparse
+import json
+import logging
+import os
+import random
+import socket
+import subprocess
+import threading
+import urllib.error
+import urllib.request
+from collections import Counter, defaultdict
+from os.path import abspath, dirname, join
+from tempfile import TemporaryDirectory
+from time import perf_counter, sleep
+
+import numpy as np
+import pandas as pd
+from countrynames import load_country_names
+from datastore import code_columns, country_columns, ratio_columns, resource_files
+
+logger = logging.getLogger(__name__)
+
+doc_folder = dirname(abspath(__file__))
+repo_folder = dirname(doc_folder)
+
+# Rows of the synthetic data files, about the size of the published ones
+full_scale_rows = {
+    "asylum_applications": 90000,
+    "asylum_decisions": 75000,
+    "demographics": 80000,
+    "population_totals": 105000,
+    "solutions": 15000,
+}
+first_year = 2000
+last_year = 2020
+
+reports = (
+    "applications",
+    "decisions",
+    "demographics",
+    "population_totals",
+    "solutions",
+)
+
+# Kind of query: (share of the requests, url). Kinds and urls are filled with a random report, resource, direction
+# and a country picked by popularity.
+query_mix = {
+    "report_{report}": (60, "/liquer/q/report_{report}-{iso}/{report}_{iso}.html"),
+    "reports": (5, "/liquer/q/reports/reports_by_country.html"),
+    # As linked from the menu of the LiQuer web application
+    "countries": (5, "/liquer/q/countries"),
+    "filter_country": (20, "/liquer/q/{resource}/filter_country-{iso}-{direction}"),
+    "convert": (5, "/liquer/q/{resource}/convert"),
+    "data_slice": (5, "/api/v1/{resource}/{iso}?direction={direction}"),
+}
+
+
+def generate_data(folder, scale=1.0, seed=1):
+    """Write synthetic data files to *folder* with the columns and codes of the test fixtures, *scale* times the
+    full size. Returns the countries, most rows first.
+    """
+    rng = np.random.default_rng(seed)
+    countries = list(rng.permutation(sorted(load_country_names())))
+    # Zipf like, a few countries have most of the rows
+    popularity = 1 / np.arange(1, len(countries) + 1) ** 1.2
+    popularity /= popularity.sum()
+    for resource, rows in full_scale_rows.items():
+        filename = resource_files[resource]
+        sample = pd.read_csv(
+            join(repo_folder, "tests", "fixtures", filename),
+            dtype=str,
+            keep_default_na=False,
+        )
+        n = max(int(rows * scale), 1)
+        data = dict()
+        for column in sample.columns:
+            if column in country_columns:
+                data[column] = rng.choice(countries, n, p=popularity)
+            elif column in code_columns:
+                data[column] = rng.choice(sample[column].unique(), n)
+            elif column == "Year":
+                data[column] = rng.integers(first_year, last_year + 1, n)
+            elif column in ratio_columns:
+                data[column] = rng.uniform(1, 3, n).round(2)
+            else:
+                data[column] = rng.lognormal(4, 2, n).astype("int64")
+        df = pd.DataFrame(data).sort_values(["Year", "ISO3CoO", "ISO3CoA"])
+        df.to_csv(join(folder, filename), index=False)
+        logger.info(f"Generated {n} rows of {filename}")
+    return countries
+
+
+def build_workload(countries, requests, seed=1):
+    """List of *requests* tuples (kind, url) following query_mix"""
+    rng = random.Random(seed)
+    popularity = [1 / (rank + 1) ** 1.2 for rank in range(len(countries))]
+    kinds = list(query_mix)
+    shares = [query_mix[kind][0] for kind in kinds]
+    workload = []
+    for kind in rng.choices(kinds, shares, k=requests):
+        values = dict(
+            report=rng.choice(reports),
+            resource=rng.choice(list(resource_files)),
+            direction=rng.choice(("originating", "residing")),
+            iso=rng.choices(countries, popularity)[0],
+        )
+        workload.append((kind.format(**values), query_mix[kind][1].format(**values)))
+    return workload
+
+
+def record_command_times(path):
+    """Append the time of each LiQuer command evaluated in this process (and the processes it forks) to *path*,
+    one json list [command, seconds] per line
+    """
+    from liquer.context import Context
+    from liquer.parser import TransformQuerySegment
+
+    evaluate_action = Context.evaluate_action
+
+    def timed_evaluate_action(self, state, action, *args, **kwargs):
+        start = perf_counter()
+        try:
+            return evaluate_action(self, state, action, *args, **kwargs)
+        finally:
+            seconds = perf_counter() - start
+            if isinstance(action, TransformQuerySegment):
+                action = None if action.is_filename() else action.query[0]
+            if action is not None:
+                # Lines this short are appended at once, also by concurrent processes
+                with open(path, "a") as f:
+                    f.write(json.dumps([action.name, seconds]) + "\n")
+
+    Context.evaluate_action = timed_evaluate_action
+
+
+def serve(args):
+    """Run the charts.py server, recording the command times in args.timings"""
+    import charts
+
+    record_command_times(args.timings)
+    charts.serve(args.host, args.port, args.workers, args.threads)
+
+
+def free_port(host):
+    with socket.socket() as s:
+        s.bind((host, 0))
+        return s.getsockname()[1]
+
+
+def start_server(folder, host, port, workers, threads):
+    """Start the server in *folder* (with the data in folder/data), returns the process once it listens"""
+    os.makedirs(join(folder, "doc"))
+    os.symlink(join(repo_folder, "config"), join(folder, "config"))
+    command = [sys.executable, abspath(__file__), "--serve", "--host", host]
+    command += [
+        "--port",
+        str(port),
+        "--workers",
+        str(workers),
+        "--threads",
+        str(threads),
+    ]
+    command += ["--timings", join(folder, "timings.jsonl")]
+    env = dict(os.environ)
+    env["PYTHONPATH"] = os.pathsep.join(
+        [doc_folder, repo_folder, env.get("PYTHONPATH", "")]
+    )
+    log = open(join(folder, "server.log"), "w")
+    process = subprocess.Popen(
+        command, cwd=join(folder, "doc"), env=env, stdout=log, stderr=log
+    )
+    while True:
+        if process.poll() is not None:
+            with open(join(folder, "server.log")) as f:
+                raise RuntimeError(f"Server failed to start:\n{f.read()[-2000:]}")
+        try:
+            socket.create_connection((host, port), timeout=1).close()
+            return process
+        except OSError:
+            sleep(0.2)
+
+
+def replay(base_url, workload, users):
+    """Send the requests of *workload* from *users* threads, returns the list of tuples (kind, seconds, status,
+    bytes) and the duration in seconds
+    """
+    results = []
+    queue = iter(workload)
+    lock = threading.Lock()
+
+    def user():
+        while True:
+            with lock:
+                item = next(queue, None)
+            if item is None:
+                return
+            kind, url = item
+            start = perf_counter()
+            try:
+                with urllib.request.urlopen(base_url + url, timeout=600) as response:
+                    status = response.status
+                    size = len(response.read())
+            except urllib.error.HTTPError as e:
+                status = e.code
+                size = len(e.read())
+            except OSError:
+                status = None
+                size = 0
+            with lock:
+                results.append((kind, perf_counter() - start, status, size))
+
+    threads = [threading.Thread(target=user) for _ in range(users)]
+    start = perf_counter()
+    for thread in threads:
+        thread.start()
+    for thread in threads:
+        thread.join()
+    return results, perf_counter() - start
+
+
+def latency_summary(seconds, duration):
+    p50, p95, p99 = np.percentile(seconds, [50, 95, 99]) if seconds else (0, 0, 0)
+    return {
+        "requests": len(seconds),
+        "per_second": len(seconds) / duration if duration else 0,
+        "p50": p50,
+        "p95": p95,
+        "p99": p99,
+        "max": max(seconds, default=0),
+    }
+
+
+def summarise(results, duration, timings):
+    """Dictionary of the latencies (overall and by kind), errors and command times"""
+    by_kind = defaultdict(list)
+    errors = Counter()
+    for kind, seconds, status, _ in results:
+        by_kind[kind].append(seconds)
+        errors[kind] += status != 200
+    commands = defaultdict(list)
+    for name, seconds in timings:
+        commands[name].append(seconds)
+    return {
+        "duration": duration,
+        "overall": dict(
+            latency_summary([x[1] for x in results], duration),
+            errors=sum(errors.values()),
+        ),
+        "kinds": {
+            kind: dict(latency_summary(seconds, duration), errors=errors[kind])
+            for kind, seconds in sorted(by_kind.items())
+        },
+        "statuses": dict(Counter(str(x[2]) for x in results)),
+        "megabytes": sum(x[3] for x in results) / 1e6,
+        "commands": {
+            name: {
+                "calls": len(seconds),
+                "total": sum(seconds),
+                "mean": sum(seconds) / len(seconds),
+                "p95": float(np.percentile(seconds, 95)),
+            }
+            for name, seconds in sorted(
+                commands.items(), key=lambda x: sum(x[1]), reverse=True
+            )
+        },
+    }
+
+
+def read_timings(path):
+    if not os.path.exists(path):
+        return []
+    with open(path) as f:
+        return [json.loads(line) for line in f if line.endswith("\n")]
+
+
+def print_summary(summary):
+    print(
+        f"{summary['overall']['requests']} requests in {summary['duration']:.1f}s, "
+        f"{summary['megabytes']:.1f} MB, statuses {summary['statuses']}"
+    )
+    print(
+        f"{'kind':<24} {'requests':>8} {'req/s':>7} {'p50 ms':>8} {'p95 ms':>8} {'p99 ms':>8} {'max ms':>8} {'errors':>6}"
+    )
+    for kind, r in [("overall", summary["overall"])] + list(summary["kinds"].items()):
+        print(
+            f"{kind:<24} {r['requests']:>8} {r['per_second']:>7.1f} {r['p50'] * 1000:>8.0f} "
+            f"{r['p95'] * 1000:>8.0f} {r['p99'] * 1000:>8.0f} {r['max'] * 1000:>8.0f} {r['errors']:>6}"
+        )
+    print(
+        f"{'command (server)':<24} {'calls':>8} {'total s':>8} {'mean ms':>8} {'p95 ms':>8}"
+    )
+    for name, c in summary["commands"].items():
+        print(
+            f"{name:<24} {c['calls']:>8} {c['total']:>8.1f} {c['mean'] * 1000:>8.1f} "
+            f"{c['p95'] * 1000:>8.1f}"
+        )
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.split("\n\n")[0])
+    parser.add_argument("--users", type=int, default=8, help="Concurrent users")
+    parser.add_argument(
+        "--requests", type=int, default=500, help="Number of measured requests"
+    )
+    parser.add_argument(
+        "--warmup", type=int, default=0, help="Requests sent before measuring"
+    )
+    parser.add_argument(
+        "--scale", type=float, default=1.0, help="Size of the data (1 is full size)"
+    )
+    parser.add_argument(
+        "--workers", type=int, default=1, help="Server processes (gunicorn workers)"
+    )
+    parser.add_argument(
+        "--threads", type=int, default=1, help="Threads of each server process"
+    )
+    parser.add_argument("--seed", type=int, default=1, help="Seed of the data and mix")
+    parser.add_argument("--output", help="Save the results to this json file")
+    parser.add_argument("--host", default="127.0.0.1", help=argparse.SUPPRESS)
+    parser.add_argument("--port", type=int, help=argparse.SUPPRESS)
+    parser.add_argument("--serve", action="store_true", help=argparse.SUPPRESS)
+    parser.add_argument("--timings", help=argparse.SUPPRESS)
+    args = parser.parse_args()
+    if args.serve:
+        serve(args)
+        return
+
+    with TemporaryDirectory() as folder:
+        os.makedirs(join(folder, "data"))
+        countries = generate_data(join(folder, "data"), args.scale, args.seed)
+        port = args.port or free_port(args.host)
+        server = start_server(folder, args.host, port, args.workers, args.threads)
+        try:
+            base_url = f"http://{args.host}:{port}"
+            workload = build_workload(countries, args.warmup + args.requests, args.seed)
+            timings_path = join(folder, "timings.jsonl")
+            if args.warmup:
+                replay(base_url, workload[: args.warmup], args.users)
+                if os.path.exists(timings_path):
+                    os.remove(timings_path)
+            logger.info(f"Sending {args.requests} requests from {args.users} users")
+            results, duration = replay(base_url, workload[args.warmup :], args.users)
+        finally:
+            server.terminate()
+            server.wait()
+        summary = summarise(results, duration, read_timings(timings_path))
+    summary["options"] = vars(args)
+    print_summary(summary)
+    if args.output:
+        with open(args.output, "w") as f:
+            json.dump(summary, f, indent=1)
+
+
+if __name__ == "__main__":
+    logging.basicConfig(level=logging.INFO)
+    main()
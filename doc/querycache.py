@@ -0,0 +1,323 @@
+"""
+Persistent cache of the LiQuer query results of charts.py.
+
+The results are kept in files like with the FileCache of LiQuer, so that a restarted server is warm, but:
+
+- the file names are derived from the query together with a fingerprint of the data files and of the fields of
+  project_configuration.yml, so new data or changed field conversions never get stale results,
+- entries of other fingerprints are removed when the cache is opened,
+- the total size of the files is kept under a limit by removing the least recently used entries.
+
+The fingerprint is computed once, when charts.py is imported, so the server has to be restarted after the data files
+or the fields change. Until then it keeps serving (and caching) the data it loaded at start.
+
+The cache can be shared by several server processes (or threads): the files are replaced at once when written and
+entries removed by another process are skipped. Identical queries evaluated at the same time are coalesced when
+evaluated in a CoalescingContext: the first one to miss the cache holds a lock on the query (a file lock, so across
+processes) while it is evaluated, and the others wait for the lock and then get the stored result rather than
+evaluating the query again. Reading the cache (e.g. /liquer/api/cache/get) never takes the lock.
+"""
+
+import glob
+import hashlib
+import json
+import logging
+import os
+import threading
+from os.path import basename, join
+from time import monotonic, sleep
+
+import yaml
+from liquer.cache import FileCache
+from liquer.context import Context
+from liquer.state_types import state_types_registry
+from stages import fingerprint
+
+try:
+    import fcntl
+except ImportError:  # Windows, queries are not coalesced
+    fcntl = None
+
+logger = logging.getLogger(__name__)
+
+
+def data_fingerprint(data_files, configuration_path):
+    """Fingerprint of the *data_files* (name, size and modification time) and the fields in *configuration_path*"""
+    files = []
+    for path in sorted(data_files):
+        stat = os.stat(path)
+        files.append((basename(path), stat.st_size, stat.st_mtime_ns))
+    with open(configuration_path) as f:
+        fields = yaml.safe_load(f)["fields"]
+    return fingerprint(files, fields)
+
+
+def write_file(path, b):
+    """Write bytes *b* to *path*, replacing the file at once so that other processes never read it half written"""
+    temporary = f"{path}.{os.getpid()}.{threading.get_ident()}.tmp"
+    with open(temporary, "wb") as f:
+        f.write(b)
+    os.replace(temporary, path)
+
+
+def remove_files(paths):
+    """Remove the files in *paths*, skipping those already removed (e.g. by another process)"""
+    for path in paths:
+        try:
+            os.remove(path)
+        except FileNotFoundError:
+            pass
+
+
+class FingerprintedFileCache(FileCache):
+    """File cache in *path* for the data with *data_fingerprint*, holding at most *max_size* bytes"""
+
+    def __init__(self, path, data_fingerprint, max_size=512 << 20, lock_timeout=120):
+        super().__init__(path)
+        self.data_fingerprint = data_fingerprint
+        self.max_size = max_size
+        # Seconds to wait for a query evaluated by someone else before evaluating it anyway
+        self.lock_timeout = lock_timeout
+        self.locks_path = join(path, "locks")
+        os.makedirs(self.locks_path, exist_ok=True)
+        # Lock files held by the threads of this process, by (thread, key)
+        self.held = dict()
+        self.held_lock = threading.Lock()
+        self.remove_stale()
+        # Bytes in the cache as of the last scan, plus those stored and removed by this process since
+        self.size = 0
+        self.evict()
+
+    def to_path(self, key, prefix="state_", extension="json"):
+        digest = hashlib.md5(f"{self.data_fingerprint}/{key}".encode("utf-8"))
+        return join(self.path, f"{prefix}{digest.hexdigest()}.{extension}")
+
+    def entries(self):
+        """Dictionary of the files of each entry (by digest), state file first"""
+        entries = dict()
+        for path in sorted(glob.glob(join(self.path, "*_*.*"))):
+            if path.endswith(".tmp"):  # Being written
+                continue
+            prefix, rest = basename(path).split("_", 1)
+            files = entries.setdefault(rest.split(".")[0], [])
+            if prefix == "state":
+                files.insert(0, path)
+            else:
+                files.append(path)
+        return entries
+
+    def remove_stale(self):
+        """Remove the entries stored for other data"""
+        removed = 0
+        for files in self.entries().values():
+            metadata = None
+            if basename(files[0]).startswith("state_"):
+                metadata = self._load_metadata(files[0])
+            if metadata and metadata.get("data_fingerprint") == self.data_fingerprint:
+                continue
+            remove_files(files)
+            removed += 1
+        if removed:
+            logger.info(f"Removed {removed} stale entries from {self}")
+
+    def entry_size(self, key):
+        """Bytes in the files of *key*"""
+        size = 0
+        for path in glob.glob(self.to_path(key, "*_", "*")):
+            if path.endswith(".tmp"):
+                continue
+            try:
+                size += os.path.getsize(path)
+            except FileNotFoundError:
+                pass
+        return size
+
+    def evict(self):
+        """Remove the least recently used entries until the files fit in max_size, with a tenth of it to spare. As it
+        scans the cache, it is only called when the running size goes above max_size. The entries stored by other
+        processes are counted at the scan, so with several processes the files can go above max_size by what the
+        others stored in between.
+        """
+        entries = []
+        total = 0
+        for files in self.entries().values():
+            try:
+                stats = [os.stat(path) for path in files]
+            except FileNotFoundError:  # Removed by another process
+                continue
+            size = sum(stat.st_size for stat in stats)
+            entries.append((stats[0].st_mtime, size, files))
+            total += size
+        entries.sort()
+        if total > self.max_size:
+            while total > self.max_size - self.max_size // 10 and entries:
+                _, size, files = entries.pop(0)
+                remove_files(files)
+                total -= size
+                logger.debug(f"Evicted {len(files)} files ({size} bytes) from {self}")
+        self.size = total
+
+    def lock_path(self, key):
+        return join(self.locks_path, basename(self.to_path(key, "", "lock")))
+
+    def lock(self, key):
+        """Wait for the lock on *key*, returns False if it timed out"""
+        if fcntl is None:
+            return True
+        f = open(self.lock_path(key), "a")
+        deadline = monotonic() + self.lock_timeout
+        while True:
+            try:
+                fcntl.flock(f, fcntl.LOCK_EX | fcntl.LOCK_NB)
+                break
+            except BlockingIOError:
+                if monotonic() > deadline:
+                    f.close()
+                    logger.warning(f"Timed out waiting for {key}, evaluating it again")
+                    return False
+                sleep(0.05)
+        with self.held_lock:
+            self.held[(threading.get_ident(), key)] = f
+        return True
+
+    def unlock(self, key):
+        """Release the lock on *key* if it is held"""
+        with self.held_lock:
+            f = self.held.pop((threading.get_ident(), key), None)
+        if f is not None:
+            # Removed so that the lock files don't pile up. At worst, a query waiting on the removed file and one
+            # arriving after are both evaluated if the first evaluation failed.
+            remove_files([self.lock_path(key)])
+            fcntl.flock(f, fcntl.LOCK_UN)
+            f.close()
+
+    def is_ready(self, key):
+        """True if the result of *key* is stored"""
+        metadata = self._load_metadata(self.to_path(key))
+        return (
+            bool(metadata)
+            and metadata.get("query") == key
+            and metadata.get("status") == "ready"
+        )
+
+    def lock_missing(self, key):
+        """Wait for the lock on *key* unless its result is stored. Returns True if the lock is held, and the caller
+        then evaluates *key* and unlocks it. Identical queries waiting meanwhile find the result stored.
+        """
+        if self.is_ready(key) or not self.lock(key):
+            return False
+        if self.is_ready(key):
+            # Evaluated while waiting
+            self.unlock(key)
+            return False
+        return True
+
+    def get(self, key):
+        state = super().get(key)
+        if state is not None:
+            # The modification time of the state file is the last use
+            try:
+                os.utime(self.to_path(key))
+            except FileNotFoundError:
+                pass
+        return state
+
+    def keys(self):
+        for key in super().keys():
+            if self.contains(key):
+                yield key
+
+    def store(self, state):
+        if state.is_error:
+            return None
+        state.metadata["status"] = "ready"
+        state.metadata["data_fingerprint"] = self.data_fingerprint
+        t = state_types_registry().get(state.type_identifier)
+        try:
+            b, mime = t.as_bytes(state.data)
+        except NotImplementedError:
+            return False
+        previous_size = self.entry_size(state.query)
+        # The data first, so that ready metadata always has its data
+        path = self.to_path(
+            state.query, prefix="data_", extension=t.default_extension()
+        )
+        write_file(path, self.encode(b))
+        stored = self.store_metadata(state.metadata)
+        self.size += self.entry_size(state.query) - previous_size
+        if self.size > self.max_size:
+            self.evict()
+        if not stored:
+            return False
+        return True
+
+    def store_metadata(self, metadata):
+        try:
+            write_file(
+                self.to_path(metadata["query"]),
+                self.encode_metadata(json.dumps(metadata)),
+            )
+        except Exception:
+            logging.exception(f"Cache writing error: {metadata['query']}")
+            return False
+        return True
+
+    def remove(self, key):
+        size = self.entry_size(key)
+        try:
+            return super().remove(key)
+        except FileNotFoundError:
+            return True
+        finally:
+            self.size -= size - self.entry_size(key)
+
+    def __str__(self):
+        return f"Fingerprinted file cache at {self.path}"
+
+    def __repr__(self):
+        return f"FingerprintedFileCache({self.path!r}, {self.data_fingerprint!r}, {self.max_size})"
+
+
+class CoalescingContext(Context):
+    """LiQuer context holding the lock on a query missing from the FingerprintedFileCache while it is evaluated, so
+    that identical queries evaluated at the same time wait for its result. Set with set_context_creator.
+    """
+
+    def evaluate(
+        self,
+        query,
+        cache=None,
+        extra_parameters=None,
+        input_value=None,
+        input_value_specified=False,
+        **kwargs,
+    ):
+        key = None
+        if (
+            self.query is None
+            and not extra_parameters
+            and input_value is None
+            and not input_value_specified
+        ):
+            if cache is None:
+                cache = self.cache()
+            parsed = self.to_query(query)[1]
+            if (
+                isinstance(cache, FingerprintedFileCache)
+                and not parsed.is_resource_query()
+            ):
+                key = parsed.encode()
+                if not cache.lock_missing(key):
+                    key = None
+        try:
+            return super().evaluate(
+                query,
+                cache=cache,
+                extra_parameters=extra_parameters,
+                input_value=input_value,
+                input_value_specified=input_value_specified,
+                **kwargs,
+            )
+        finally:
+            if key is not None:
+                cache.unlock(key)
@@ -0,0 +1,31 @@
+// Draws the charts given as compact specs by the chart commands of charts.py (output "spec") with plotly.js.
+// A spec is the aggregated data of the chart: {type: "pie", labels, values} or
+// {type: "bar", x, x_title, series: {name: values}}, with the layout of the plotly html charts.
+(function () {
+  function traces(spec) {
+    if (spec.type === "pie") {
+      return [{type: "pie", labels: spec.labels, values: spec.values}];
+    }
+    return Object.keys(spec.series).map(function (name) {
+      return {type: "bar", name: name, x: spec.x, y: spec.series[name]};
+    });
+  }
+
+  function layout(spec) {
+    var layout = {width: 600, height: 400};
+    if (spec.type === "bar") {
+      var names = Object.keys(spec.series);
+      layout.barmode = "relative";
+      layout.showlegend = names.length > 1;
+      layout.legend = {title: {text: "variable"}};
+      layout.xaxis = {title: {text: spec.x_title}};
+      layout.yaxis = {title: {text: names.length > 1 ? "value" : names[0]}};
+    }
+    return layout;
+  }
+
+  document.querySelectorAll("div.chart[data-spec]").forEach(function (div) {
+    var spec = JSON.parse(div.dataset.spec);
+    Plotly.newPlot(div, traces(spec), layout(spec));
+  });
+})();
@@ -0,0 +1,103 @@
+"""
+Evaluation of the report templates of charts.py.
+
+A report template embeds several queries ($query$), e.g. the same totals of a country drawn as two different charts.
+liquer.evaluate_template evaluates them one after the other, each from scratch (or from the cache). Here the queries
+are parsed first, and the longest prefix each query shares with another one is evaluated once. Then the queries are
+evaluated concurrently, those with a shared prefix only running their remaining actions on its value.
+"""
+
+import logging
+from collections import Counter
+from concurrent.futures import ThreadPoolExecutor
+
+from liquer import evaluate
+from liquer.context import Vars, find_queries_in_template, get_context
+from liquer.parser import parse
+
+logger = logging.getLogger(__name__)
+
+
+def query_prefixes(query):
+    """List of tuples (prefix, remaining actions) of *query*, longest prefix first"""
+    prefixes = []
+    rest = []
+    predecessor, action = parse(query).predecessor()
+    while action is not None and predecessor is not None and not predecessor.is_empty():
+        rest.insert(0, action.encode())
+        prefixes.append((predecessor.encode(), "/".join(rest)))
+        predecessor, action = predecessor.predecessor()
+    return prefixes
+
+
+def shared_prefixes(queries):
+    """Dictionary query -> (prefix, remaining actions) of the longest prefix of each query that another query of
+    *queries* has too. Queries sharing no prefix are left out.
+    """
+    counts = Counter(
+        prefix for query in set(queries) for prefix, _ in query_prefixes(query)
+    )
+    shared = dict()
+    for query in queries:
+        for prefix, rest in query_prefixes(query):
+            if counts[prefix] > 1:
+                shared[query] = (prefix, rest)
+                break
+    return shared
+
+
+def evaluate_on(value, query):
+    """State of the actions of *query* evaluated on *value*, without the cache. Like Context.evaluate_on, which also
+    prints a notice to stdout on each call.
+    """
+    actions = []
+    predecessor, action = parse(query).predecessor()
+    while action is not None:
+        actions.insert(0, action)
+        if predecessor is None or predecessor.is_empty():
+            break
+        predecessor, action = predecessor.predecessor()
+    state = get_context().create_initial_state(input_value=value)
+    for action in actions:
+        context = get_context()
+        context.vars = Vars(state.vars)
+        state = context.evaluate_action(state, action)
+        if state.is_error:
+            break
+    state.query = query
+    return state
+
+
+def expand(query, prefix_states, shared):
+    """Value of *query* as text, evaluated from its shared prefix if it has one"""
+    try:
+        if query in shared:
+            prefix, rest = shared[query]
+            state = prefix_states[prefix]
+            if not state.is_error:
+                state = evaluate_on(state.get(), rest)
+        else:
+            state = evaluate(query)
+        if state.is_error:
+            logger.error(f"Template failed to expand {query}")
+            return f"ERROR({query})"
+        return str(state.get())
+    except Exception:
+        logger.exception(f"Template crashed on expanding {query}")
+        return f"ERROR({query})"
+
+
+def evaluate_report(template, workers=4):
+    """Replace the queries in *template* ($query$) by their values, like liquer.evaluate_template"""
+    parts = list(find_queries_in_template(template, "$", "$"))
+    queries = list(dict.fromkeys(query for _, query in parts if query is not None))
+    shared = shared_prefixes(queries)
+    prefixes = list(dict.fromkeys(prefix for prefix, _ in shared.values()))
+    with ThreadPoolExecutor(workers) as executor:
+        # The prefixes first, so that no query waits for a prefix queued behind it
+        prefix_states = dict(zip(prefixes, executor.map(evaluate, prefixes)))
+        values = executor.map(lambda x: expand(x, prefix_states, shared), queries)
+        values = dict(zip(queries, values))
+    return "".join(
+        text + (values[query] if query is not None else "") for text, query in parts
+    )
@@ -16,8 +16,15 @@ The fields structure looks is a dictionary that looks like this:
 
 Use convert_fields_in_iterator to convert an iterator, hxltags_mapping to extract mapping of field names (new or old)
 and finally convert_headers to convert the headers.
+
+Calling trace() at the start of a RowIterator chain (e.g. ListIterator(data).trace("qc").select(...).with_fields(...))
+records the rows, time and materializations of every operator of the chain, which explain() prints as a plan tree.
 """
 
+import csv
+from itertools import islice
+from time import perf_counter
+
 
 def rename_fields_in_iterator(iterator, fields):
     """Rename fields in iterator.
@@ -104,6 +111,37 @@ def convert_headers(headers, fields):
     return new_headers
 
 
+def write_converted_csv(f, headers, rows, fields, block_size=65536):
+    """Write rows converted with the fields structure (including the hxl tags row) to a csv file object *f*.
+    The result is the same as writing RowIterator(headers, rows).with_fields(fields), but the rows are processed
+    in blocks of *block_size* rows, column by column, with the encoding maps used as lookup tables.
+    The file should be opened with newline="". Returns the number of data rows written.
+    """
+    encoding_map, _ = encoding(fields, use_original_field_names=True)
+    new_headers = convert_headers(headers, fields)
+    mapping = hxltags_mapping(fields)
+    writer = csv.writer(f)
+    writer.writerow(new_headers)
+    writer.writerow([mapping.get(x, "") for x in new_headers])
+
+    number_of_rows = 0
+    iterator = iter(rows)
+    while True:
+        block = list(islice(iterator, block_size))
+        if not block:
+            break
+        columns = []
+        for field in headers:
+            column = [row.get(field) for row in block]
+            columns.append(column)
+            if field in encoding_map:
+                field_map = encoding_map[field]
+                columns.append([field_map.get(value) for value in column])
+        writer.writerows(zip(*columns))
+        number_of_rows += len(block)
+    return number_of_rows
+
+
 class RowIteratorMixin:
     """Mixin defining RowIterator builder interface"""
 
@@ -115,6 +153,14 @@ class RowIteratorMixin:
         "Dictionary mapping field names to hxl tags"
         return {}
 
+    def trace(self, name=None, enabled=True):
+        """Record the rows, time and materializations of this iterator and of the operators chained after it
+        (unless *enabled* is False)
+        """
+        if not enabled:
+            return self
+        return TracedRowIterator(self, name or type(self).__name__)
+
     def with_sum_field(self, field_name, hxltag="", sum_fields=None):
         """Create a new column fith *field_name* and *hxltag* that is a sum of *sum_fields*"""
 
@@ -290,3 +336,163 @@ class RowIteratorWithSumField(RowIteratorProxyMixin):
             value = int(value)
         row[self.field_name] = value
         return row
+
+
+class OperatorStats:
+    """Statistics of an operator of a traced chain. *children* are the statistics of the operators it reads from."""
+
+    def __init__(self, name, detail="", children=tuple()):
+        self.name = name
+        self.detail = detail
+        self.children = list(children)
+        self.rows = 0
+        self.passes = 1
+        self.seconds = 0.0
+        self.build_seconds = 0.0
+        self.materialized = 0
+        self.calls = dict()
+
+    def rows_in(self):
+        return sum(child.rows for child in self.children)
+
+    def total_seconds(self):
+        return self.build_seconds + self.seconds
+
+    def own_seconds(self):
+        """Time spent in this operator, i.e. without the rows pulled from its children"""
+        return self.total_seconds() - sum(child.seconds for child in self.children)
+
+    def plan(self):
+        """Plan tree as a dictionary"""
+        return {
+            "operator": self.name,
+            "detail": self.detail,
+            "rows_in": self.rows_in(),
+            "rows_out": self.rows,
+            "passes": self.passes,
+            "materialized": self.materialized,
+            "own_seconds": self.own_seconds(),
+            "total_seconds": self.total_seconds(),
+            "calls": dict(self.calls),
+            "children": [child.plan() for child in self.children],
+        }
+
+    def explain(self, indent=0):
+        """Plan tree as text, one line per operator"""
+        text = self.name
+        if self.detail:
+            text += f" [{self.detail}]"
+        text += f": {self.rows_in()} rows in, {self.rows} rows out"
+        if self.passes > 1:
+            text += f" in {self.passes} passes"
+        if self.materialized:
+            text += f", {self.materialized} rows materialized"
+        text += f", {self.own_seconds() * 1000:.1f}ms own"
+        text += f", {self.total_seconds() * 1000:.1f}ms total"
+        for name, seconds in self.calls.items():
+            text += f", {name} {seconds * 1000:.1f}ms"
+        lines = [" " * indent + text]
+        for child in self.children:
+            lines.append(child.explain(indent + 2))
+        return "\n".join(lines)
+
+
+class TracedRowIterator(RowIteratorProxyMixin):
+    """Row iterator recording the statistics of the iterator *rowit*. The builder methods return traced iterators,
+    so the whole chain after trace() is traced. Other methods (e.g. column or auto_headers of ListIterator) are passed
+    to *rowit* and timed.
+    """
+
+    def __init__(self, rowit, name, detail="", children=tuple()):
+        self.rowit = rowit
+        self.stats = OperatorStats(name, detail, children)
+
+    def __getattr__(self, name):
+        if name in ("rowit", "stats"):
+            raise AttributeError(name)
+        attribute = getattr(self.rowit, name)
+        if not callable(attribute):
+            return attribute
+
+        def method(*args, **kwargs):
+            start = perf_counter()
+            result = attribute(*args, **kwargs)
+            calls = self.stats.calls
+            calls[name] = calls.get(name, 0.0) + perf_counter() - start
+            # Keep the chain traced for methods returning the iterator itself
+            return self if result is self.rowit else result
+
+        return method
+
+    def chain(self, name, detail, build):
+        """Build the operator *name* reading from this iterator, timing the build (where materializations happen)"""
+        start = perf_counter()
+        rowit = build()
+        seconds = perf_counter() - start
+        traced = TracedRowIterator(rowit, name, detail, [self.stats])
+        traced.stats.build_seconds = seconds
+        if isinstance(rowit, ListIterator):
+            traced.stats.materialized = len(rowit._data)
+        return traced
+
+    def with_sum_field(self, field_name, hxltag="", sum_fields=None):
+        return self.chain(
+            "with_sum_field",
+            field_name,
+            lambda: super(TracedRowIterator, self).with_sum_field(
+                field_name, hxltag, sum_fields
+            ),
+        )
+
+    def with_fields(self, fields):
+        return self.chain(
+            "with_fields",
+            f"{len(fields)} fields",
+            lambda: super(TracedRowIterator, self).with_fields(fields),
+        )
+
+    def sort_by(self, field, descending=False):
+        return self.chain(
+            "sort_by",
+            field,
+            lambda: super(TracedRowIterator, self).sort_by(field, descending),
+        )
+
+    def to_list_iterator(self):
+        return self.chain(
+            "to_list_iterator",
+            "",
+            lambda: super(TracedRowIterator, self).to_list_iterator(),
+        )
+
+    def select(self, condition):
+        return self.chain(
+            "select",
+            getattr(condition, "__name__", ""),
+            lambda: super(TracedRowIterator, self).select(condition),
+        )
+
+    def trace(self, name=None, enabled=True):
+        return self
+
+    def reset(self):
+        self.rowit.reset()
+        self.stats.passes += 1
+        return self
+
+    def __next__(self):
+        start = perf_counter()
+        try:
+            row = next(self.rowit)
+        finally:
+            self.stats.seconds += perf_counter() - start
+        self.stats.rows += 1
+        return row
+
+    def plan(self):
+        """Plan tree of the chain as a dictionary"""
+        return self.stats.plan()
+
+    def explain(self):
+        """Plan tree of the chain as text"""
+        return self.stats.explain()
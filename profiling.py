@@ -0,0 +1,187 @@
+"""
+Profiling of get_countriesdata and of the generation of selected countries.
+
+Each profiled call is run under cProfile and a sampling profiler. The cProfile statistics are saved as NAME.pstats
+(for pstats, snakeviz etc.) and the sampled stacks as NAME.collapsed, one "frame;frame;frame count" line per stack,
+which flamegraph.pl, speedscope or inferno render as a flame graph. Calls that aren't selected run the function as is,
+so there is no overhead when profiling is off.
+
+measure_memory runs a function under tracemalloc while sampling the resident memory of the process, for the memory
+budgets checked in tests/test_memory.py.
+"""
+
+import cProfile
+import logging
+import os
+import sys
+import tracemalloc
+from collections import Counter
+from os import makedirs
+from os.path import basename, exists, join
+from threading import Event, Thread, get_ident
+from time import perf_counter
+
+logger = logging.getLogger(__name__)
+
+runcall_code = cProfile.Profile.runcall.__code__
+
+
+class StackSampler:
+    """Samples the stack of thread *thread_id* every *interval* seconds in a background thread"""
+
+    def __init__(self, thread_id, interval=0.005):
+        self.thread_id = thread_id
+        self.interval = interval
+        self.stacks = Counter()
+        self.stopped = Event()
+        self.thread = Thread(target=self.sample, daemon=True)
+
+    def sample(self):
+        while not self.stopped.wait(self.interval):
+            frame = sys._current_frames().get(self.thread_id)
+            stack = []
+            # The stacks start at the profiled function, i.e. below cProfile's runcall
+            while frame is not None and frame.f_code is not runcall_code:
+                code = frame.f_code
+                stack.append(
+                    f"{code.co_name} ({basename(code.co_filename)}:{code.co_firstlineno})"
+                )
+                frame = frame.f_back
+            if frame is not None and stack:
+                self.stacks[";".join(reversed(stack))] += 1
+
+    def __enter__(self):
+        self.thread.start()
+        return self
+
+    def __exit__(self, *args):
+        self.stopped.set()
+        self.thread.join()
+
+    def save(self, path):
+        with open(path, "w") as f:
+            for stack, count in sorted(self.stacks.items()):
+                f.write(f"{stack} {count}\n")
+
+
+class Profiler:
+    """Profiles the calls whose name is in *names* (iso3 codes of countries, world or countriesdata), saving the
+    results in *folder*
+    """
+
+    def __init__(self, folder=None, names=tuple(), interval=0.005):
+        self.folder = folder
+        self.names = {name.upper() for name in names}
+        self.interval = interval
+
+    @classmethod
+    def from_option(cls, folder, option):
+        """Profiler for the comma separated countries given in *option*, along with get_countriesdata"""
+        if not option:
+            return cls(folder)
+        names = [name.strip() for name in option.split(",") if name.strip()]
+        return cls(folder, ["countriesdata"] + names)
+
+    def selected(self, name):
+        return name.upper() in self.names
+
+    def run(self, name, function, *args, **kwargs):
+        """Call function(*args, **kwargs), profiling it if *name* is selected"""
+        if not self.selected(name):
+            return function(*args, **kwargs)
+        makedirs(self.folder, exist_ok=True)
+        profile = cProfile.Profile()
+        sampler = StackSampler(get_ident(), self.interval)
+        start = perf_counter()
+        try:
+            with sampler:
+                return profile.runcall(function, *args, **kwargs)
+        finally:
+            seconds = perf_counter() - start
+            path = join(self.folder, name.upper())
+            profile.dump_stats(f"{path}.pstats")
+            sampler.save(f"{path}.collapsed")
+            logger.info(f"Profiled {name} ({seconds:.1f}s) into {path}.*")
+
+
+# Profiler that profiles nothing
+no_profiling = Profiler()
+
+
+def get_rss():
+    """Resident memory of the process in bytes (None if not available)"""
+    if not exists("/proc/self/statm"):
+        return None
+    with open("/proc/self/statm") as f:
+        return int(f.read().split()[1]) * os.sysconf("SC_PAGE_SIZE")
+
+
+class MemoryReport:
+    """Peak memory of a call: *peak* traced by tracemalloc and *peak_rss* growth of the resident memory (bytes) and
+    the *top_lines* (source line, bytes) allocating the most at the peak
+    """
+
+    def __init__(self, peak, peak_rss, top_lines):
+        self.peak = peak
+        self.peak_rss = peak_rss
+        self.top_lines = top_lines
+
+    def per_million(self, rows):
+        """Peak traced memory in MB per million *rows*"""
+        return self.peak / (1 << 20) / rows * 1000000
+
+    def __str__(self):
+        lines = [f"Peak traced memory {self.peak / (1 << 20):.1f}MB"]
+        if self.peak_rss is not None:
+            lines[0] += f", resident memory growth {self.peak_rss / (1 << 20):.1f}MB"
+        for line, size in self.top_lines:
+            lines.append(f"  {size / (1 << 20):8.2f}MB {line}")
+        return "\n".join(lines)
+
+
+def measure_memory(function, *args, top=10, interval=0.01, **kwargs):
+    """Call function(*args, **kwargs) under tracemalloc. The traced and resident memory are sampled every *interval*
+    seconds, and a snapshot is taken whenever the traced memory grows by 10%, so that the *top* source lines can be
+    attributed at the peak. Returns tuple (result, MemoryReport).
+    """
+    started = not tracemalloc.is_tracing()
+    if started:
+        tracemalloc.start()
+    tracemalloc.reset_peak()
+    baseline, _ = tracemalloc.get_traced_memory()
+    baseline_rss = get_rss()
+    peak_rss = 0
+    snapshot = None
+    snapshot_size = 0
+    stopped = Event()
+
+    def sample():
+        nonlocal peak_rss, snapshot, snapshot_size
+        while not stopped.wait(interval):
+            current, _ = tracemalloc.get_traced_memory()
+            if current > snapshot_size * 1.1:
+                snapshot = tracemalloc.take_snapshot()
+                snapshot_size = current
+            if baseline_rss is not None:
+                peak_rss = max(peak_rss, get_rss() - baseline_rss)
+
+    thread = Thread(target=sample, daemon=True)
+    thread.start()
+    try:
+        result = function(*args, **kwargs)
+        _, peak = tracemalloc.get_traced_memory()
+    finally:
+        stopped.set()
+        thread.join()
+        end_snapshot = tracemalloc.take_snapshot()
+        if started:
+            tracemalloc.stop()
+    if snapshot is None or sum(x.size for x in end_snapshot.traces) > snapshot_size:
+        snapshot = end_snapshot
+    top_lines = [
+        (f"{stat.traceback[0].filename}:{stat.traceback[0].lineno}", stat.size)
+        for stat in snapshot.statistics("lineno")[:top]
+    ]
+    return result, MemoryReport(
+        peak - baseline, peak_rss if baseline_rss is not None else None, top_lines
+    )
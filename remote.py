@@ -0,0 +1,177 @@
+"""
+Remote state of the UNHCR datasets in HDX, prefetched in bulk at the start of a run.
+
+Publishing a country costs several HDX calls even when nothing changed: loading and updating the dataset, creating
+the default views and the QuickCharts view, loading and updating the showcase and listing the datasets of the
+showcase.  The datasets (with their resources) and the showcases are prefetched with two searches,
+and each country only sends the calls needed to bring HDX to the target state.
+
+Resource views and showcase associations can't be fetched in bulk, so what was last published for them is kept in
+a state file next to the digests.
+"""
+
+import logging
+from os.path import exists
+
+from hdx.utilities.loader import load_json
+from hdx.utilities.saver import save_json
+from stages import fingerprint
+
+logger = logging.getLogger(__name__)
+
+dataset_prefix = "unhcr-population-data-for-"
+page_size = 1000
+
+# Calls made by hdx-python-api for each operation that can be skipped
+dataset_calls = 3  # package_show, package_update, package_create_default_resource_views
+resourceview_calls = 2  # resource_view_list, resource_view_update
+showcase_calls = 2  # ckanext_showcase_show, ckanext_showcase_update
+association_calls = 1  # ckanext_showcase_package_list
+
+
+def matches(target, remote):
+    """True if the *remote* value already holds the *target* value. Dictionaries only need to match on the keys of
+    *target* (HDX adds ids, display names etc.) and lists of dictionaries are compared regardless of order.
+    """
+    if isinstance(target, dict):
+        return isinstance(remote, dict) and all(
+            key in remote and matches(value, remote[key])
+            for key, value in target.items()
+        )
+    if isinstance(target, list):
+        return (
+            isinstance(remote, list)
+            and len(target) == len(remote)
+            and all(any(matches(x, y) for y in remote) for x in target)
+        )
+    if target == remote:
+        return True
+    if isinstance(target, str) and isinstance(remote, str):
+        return False
+    # e.g. True and "true" or 1 and "1"
+    return str(target).lower() == str(remote).lower()
+
+
+def resourceview_fingerprint(dataset):
+    resourceview = dataset._preview_resourceview
+    if resourceview is None:
+        return None
+    return fingerprint(resourceview.data)
+
+
+class RemoteState:
+    """Datasets and showcases found in HDX (dictionaries name -> object) and the resource views and showcase
+    associations published by the previous runs (kept in *path*). Counts the calls saved by the diffing.
+    """
+
+    def __init__(self, datasets, showcases, path, calls=0):
+        self.datasets = datasets
+        self.showcases = showcases
+        self.path = path
+        if exists(path):
+            self.published = load_json(path)
+        else:
+            self.published = dict()
+        self.calls = calls
+        self.saved = 0
+
+    @classmethod
+    def prefetch(cls, path):
+        """Fetch all the UNHCR population datasets and their showcases from HDX"""
+        from hdx.api.configuration import Configuration
+        from hdx.data.dataset import Dataset
+        from hdx.data.showcase import Showcase
+
+        # The searches page through the results and are redone if the counts change, so the calls are counted
+        configuration = Configuration.read()
+        call_remoteckan = configuration.call_remoteckan
+        calls = 0
+
+        def counted_call_remoteckan(*args, **kwargs):
+            nonlocal calls
+            calls += 1
+            return call_remoteckan(*args, **kwargs)
+
+        configuration.call_remoteckan = counted_call_remoteckan
+        try:
+            fq = f"name:{dataset_prefix}*"
+            datasets = Dataset.search_in_hdx(fq=fq, page_size=page_size)
+            showcases = Showcase.search_in_hdx(fq=fq, page_size=page_size)
+        finally:
+            del configuration.call_remoteckan
+        logger.info(
+            f"Prefetched {len(datasets)} datasets and {len(showcases)} showcases from HDX"
+        )
+        return cls(
+            {dataset["name"]: dataset for dataset in datasets},
+            {showcase["name"]: showcase for showcase in showcases},
+            path,
+            calls,
+        )
+
+    def unchanged_dataset(self, dataset):
+        """The dataset in HDX if it already matches *dataset* (metadata, resource files and resource view),
+        otherwise None
+        """
+        from hdx.api.utilities.size_hash import get_size_and_hash
+
+        remote = self.datasets.get(dataset["name"])
+        if remote is None:
+            return None
+        data = {key: value for key, value in dataset.data.items() if key != "resources"}
+        if not matches(data, remote.data):
+            return None
+        resources = dataset.get_resources()
+        remote_resources = {
+            resource["name"]: resource for resource in remote.get_resources()
+        }
+        # The resources must also be in the same order
+        if [resource["name"] for resource in resources] != list(remote_resources):
+            return None
+        for resource in resources:
+            remote_resource = remote_resources.get(resource["name"])
+            if remote_resource is None:
+                return None
+            data = dict(resource.data)
+            file_format = data.pop("format", "").lower()
+            if file_format != remote_resource.get("format", "").lower():
+                return None
+            if not matches(data, remote_resource.data):
+                return None
+            file_to_upload = resource.get_file_to_upload()
+            if file_to_upload:
+                size, hash = get_size_and_hash(file_to_upload, file_format)
+                if (size, hash) != (
+                    remote_resource.get("size"),
+                    remote_resource.get("hash"),
+                ):
+                    return None
+        published = self.published.get(dataset["name"], dict())
+        if published.get("resourceview") != resourceview_fingerprint(dataset):
+            return None
+        return remote
+
+    def unchanged_showcase(self, showcase):
+        """The showcase in HDX if it already matches *showcase*, otherwise None"""
+        remote = self.showcases.get(showcase["name"])
+        if remote is None or not matches(showcase.data, remote.data):
+            return None
+        return remote
+
+    def is_associated(self, dataset, showcase):
+        """True if the previous runs added the dataset to the showcase"""
+        published = self.published.get(dataset["name"], dict())
+        return published.get("showcase") == [showcase["id"], dataset["id"]]
+
+    def log_calls(self):
+        logger.info(
+            f"HDX calls saved: {self.saved} (prefetching made {self.calls} calls)"
+        )
+
+    def record(self, dataset, showcase, resourceview):
+        """Record what was published for *dataset*"""
+        self.published[dataset["name"]] = {
+            "resourceview": resourceview,
+            "showcase": [showcase["id"], dataset["id"]],
+        }
+        save_json(self.published, self.path, sortkeys=True)
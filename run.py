@@ -10,34 +10,378 @@ import logging
 import sys
 
 # Added Dec-2020
-from os import getenv
-from os.path import join
+from os import getenv, makedirs, remove
+from os.path import exists, join
 from pathlib import Path
+from shutil import rmtree
 from time import sleep
 
 from hdx.api.configuration import Configuration
-from hdx.facades.simple import facade
+from hdx.facades.infer_arguments import facade
 from hdx.utilities.downloader import Download
-from hdx.utilities.path import progress_storing_tempdir
+from hdx.utilities.loader import load_json, load_text
+from hdx.utilities.path import (
+    NotFoundError,
+    get_wheretostart,
+    progress_storing_tempdir,
+    wheretostart_tempdir_batch,
+)
 from hdx.utilities.matching import multiple_replace
-from unhcr import generate_dataset_and_showcase, get_countriesdata
+from hdx.utilities.saver import save_json, save_text
+from buffers import ResourceBuffers
+from countrynames import refresh_country_names
+from profiling import Profiler, no_profiling
+from remote import (
+    RemoteState,
+    association_calls,
+    dataset_calls,
+    resourceview_calls,
+    resourceview_fingerprint,
+    showcase_calls,
+)
+from scheduling import (
+    LargestFirstPool,
+    get_countrycosts,
+    load_shard_processed,
+    merge_shard_reports,
+    parse_shard,
+    pipeline,
+    save_shard_report,
+    shard_batch,
+    shard_report_path,
+    shard_suffix,
+    split_into_shards,
+)
+from stages import StageRunner, file_fingerprint, from_bundle, to_bundle
+from unhcr import (
+    check_resource_order,
+    desired_order,
+    direction_order,
+    generate_dataset_and_showcase,
+    get_affected_countries,
+    get_countriesdata,
+    get_countriesdigests,
+)
 
 logger = logging.getLogger(__name__)
 
 lookup = "hdx-scraper-unhcr-population"
 
-desired_order = (
-    "End-year stock",
-    "Demographics",
-    "Asylum applications",
-    "Asylum decisions",
-    "Solutions",
-)
-direction_order = ("originating", "residing", "(Global)")
+# Folder keeping state between runs (e.g. the digests of the input rows of the last published datasets)
+state_folder = "state"
+digests_file = join(state_folder, "digests.json")
+
+# Data of the generation worker processes (--workers), set by init_generation_worker
+worker_state = dict()
+
+
+def update_metadata(dataset):
+    """Metadata stage: static metadata from hdx_dataset_static.yml"""
+    dataset.update_from_yaml()
+    dataset["notes"] = dataset["notes"].replace(
+        "\n", "  \n"
+    )  # ensure markdown has line breaks
+
+
+def generate_resource_view(dataset, country, bites_disabled):
+    """Resource view stage: QuickCharts from hdx_resource_view_static.yml"""
+    # June-23 - change to underscore method name (and actually the correct one is generate quick charts)
+    # resourceview = dataset.generate_resource_view(
+    # resourceview = dataset._generate_resource_view(
+    resourceview = dataset.generate_quickcharts(-1, bites_disabled=bites_disabled)
+    if resourceview:
+        resourceview["hxl_preview_config"] = multiple_replace(
+            resourceview["hxl_preview_config"],
+            {
+                "{{#country+iso}}": country["iso3"],
+                "{{#country+name}}": country["countryname"],
+            },
+        )
+
+
+def publish(info, dataset, showcase, remote=None):
+    """Upload stage: create dataset in HDX (with the resources in the order generated) and create the showcase.
+    With the *remote* state prefetched from HDX, the calls that wouldn't change anything are skipped.
+    """
+    # The resources are generated in display order, check it before anything is uploaded
+    for name in check_resource_order(dataset):
+        logger.error(f"{name} is missing from the resource order!")
+        sys.exit(-1)
+    resourceview = resourceview_fingerprint(dataset)
+    remote_dataset = remote.unchanged_dataset(dataset) if remote else None
+    if remote_dataset:
+        logger.info(f"Dataset {dataset['name']} is up to date in HDX")
+        dataset = remote_dataset
+        remote.saved += dataset_calls
+        if resourceview:
+            remote.saved += resourceview_calls
+    else:
+        dataset.create_in_hdx(
+            remove_additional_resources=True,
+            match_resource_order=True,
+            hxl_update=False,
+            updated_by_script="UNHCR population",
+            batch=info["batch"],
+        )
+
+    remote_showcase = remote.unchanged_showcase(showcase) if remote else None
+    if remote_showcase:
+        showcase = remote_showcase
+        remote.saved += showcase_calls
+        if remote.is_associated(dataset, showcase):
+            remote.saved += association_calls
+        else:
+            showcase.add_dataset(dataset)
+    else:
+        existing = remote is None or showcase["name"] in remote.showcases
+        showcase.create_in_hdx()
+        if existing:
+            showcase.add_dataset(dataset)
+        else:
+            # A new showcase has no datasets yet
+            showcase.add_dataset(dataset, datasets_to_check=[])
+            remote.saved += association_calls
+    if remote:
+        remote.record(dataset, showcase, resourceview)
+
+
+def run_country_stages(
+    runner,
+    info,
+    country,
+    countrydata,
+    qc_rows,
+    headers,
+    resources,
+    fields,
+    digests,
+    remote=None,
+    profiler=no_profiling,
+    explain=False,
+):
+    """Run the per-country stages (generate, metadata, resource view and upload), each of them only if its inputs
+    or an upstream stage changed since the previous run. Returns True if the country has a dataset.
+    """
+    countryiso = country["iso3"]
+    folder = join(runner.folder, "files", countryiso)
+
+    def generate():
+        makedirs(folder, exist_ok=True)
+        return to_bundle(
+            *profiler.run(
+                countryiso,
+                generate_dataset_and_showcase,
+                folder,
+                country,
+                countrydata,
+                qc_rows,
+                headers,
+                resources,
+                fields,
+                explain=explain,
+            )
+        )
+
+    generated_bundle, generated = runner.run(
+        f"generate/{countryiso}",
+        generate,
+        inputs={
+            "rows": digests,
+            "resources": resources,
+            "fields": fields,
+            "order": [desired_order, direction_order],
+        },
+    )
+    if generated_bundle is None:
+        return False
+
+    def metadata():
+        dataset, showcase, bites_disabled = from_bundle(generated_bundle)
+        update_metadata(dataset)
+        return to_bundle(dataset, showcase, bites_disabled)
+
+    metadata_bundle, metadata_updated = runner.run(
+        f"metadata/{countryiso}",
+        metadata,
+        inputs={"yaml": file_fingerprint(join("config", "hdx_dataset_static.yml"))},
+        dependencies=[generated],
+    )
+
+    def resource_view():
+        dataset, showcase, bites_disabled = from_bundle(metadata_bundle)
+        generate_resource_view(dataset, country, bites_disabled)
+        return to_bundle(dataset, showcase, bites_disabled)
+
+    resourceview_bundle, resourceview_generated = runner.run(
+        f"resource_view/{countryiso}",
+        resource_view,
+        inputs={
+            "yaml": file_fingerprint(join("config", "hdx_resource_view_static.yml"))
+        },
+        dependencies=[metadata_updated],
+    )
+
+    def upload():
+        dataset, showcase, _ = from_bundle(resourceview_bundle)
+        publish(info, dataset, showcase, remote)
+        return True
+
+    runner.run(f"upload/{countryiso}", upload, dependencies=[resourceview_generated])
+    return True
+
+
+def generation_configuration(configuration):
+    """Arguments setting up a read only copy of *configuration* in the generation workers. Generation doesn't write
+    to HDX, so the HDX key is left out rather than sent to every worker.
+    """
+    data = {
+        key: value
+        for key, value in configuration.data.items()
+        if not key.startswith("hdx_key")
+    }
+    return {
+        "hdx_base_config_dict": data,
+        "hdx_site": configuration.hdx_site[len("hdx_") : -len("_site")],
+        "hdx_read_only": True,
+        "full_agent": configuration.get_user_agent(),
+    }
+
+
+def init_generation_worker(configuration_arguments, state):
+    # Replaces the configuration inherited when the processes are forked
+    Configuration.setup(**configuration_arguments)
+    Configuration.read().setup_session_remoteckan()
+    worker_state.update(state)
 
 
-def main():
-    """Generate dataset and create it in HDX"""
+def generate_country(item):
+    """Generate the dataset of a country (tuple of country and folder) in a worker process, returned as a bundle"""
+    country, folder = item
+    return to_bundle(
+        *worker_state["profiler"].run(
+            country["iso3"],
+            generate_dataset_and_showcase,
+            folder,
+            country,
+            worker_state["countriesdata"][country["id"]],
+            worker_state["qc_rows"],
+            worker_state["headers"],
+            worker_state["resources"],
+            worker_state["fields"],
+            explain=country["iso3"].upper() in worker_state["explained"],
+        )
+    )
+
+
+def get_remaining_countries(folder, countries):
+    """Countries still to be processed given WHERETOSTART or the progress file in *folder*,
+    following the same rules as progress_storing_tempdir.
+    """
+    contents = getenv("WHERETOSTART")
+    message = "Environment variable"
+    if not contents:
+        progress_file = join(folder, "progress.txt")
+        if not exists(progress_file):
+            return countries
+        contents = load_text(progress_file, strip=True)
+        message = "File"
+    wheretostart = get_wheretostart(contents, message, "iso3")
+    if not wheretostart:
+        return countries
+    if wheretostart == "IGNORE":
+        return []
+    for i, country in enumerate(countries):
+        if country["iso3"] == wheretostart:
+            logger.info(f"Starting run from WHERETOSTART {wheretostart}")
+            return countries[i:]
+    raise NotFoundError(
+        f"WHERETOSTART ({wheretostart}) not matched in countries and no run started!"
+    )
+
+
+def merge_shards(number_of_shards):
+    """Check that the shards processed every country exactly once and merge their state files"""
+    problems = merge_shard_reports(state_folder, number_of_shards)
+    for problem in problems:
+        logger.error(problem)
+    if problems:
+        sys.exit(-1)
+    # The digests and what was published to HDX (see remote.py) are kept per shard
+    for name in ("digests", "remote"):
+        path = join(state_folder, f"{name}.json")
+        if exists(path):
+            merged = load_json(path)
+        else:
+            merged = dict()
+        shard_files = [
+            join(state_folder, f"{name}{shard_suffix(index, number_of_shards)}.json")
+            for index in range(1, number_of_shards + 1)
+        ]
+        for shard_file in shard_files:
+            if exists(shard_file):
+                merged.update(load_json(shard_file))
+        save_json(merged, path, sortkeys=True)
+        for shard_file in shard_files:
+            if exists(shard_file):
+                remove(shard_file)
+    # A later run on the same data is a new run, not the resumption of this one
+    for index in range(1, number_of_shards + 1):
+        remove(shard_report_path(state_folder, index, number_of_shards))
+    logger.info(f"All {number_of_shards} shards processed every country once")
+
+
+def main(
+    delta: bool = False,
+    stages: bool = False,
+    shard: str = "",
+    merge_shards_of: int = 0,
+    pipelined: bool = False,
+    queue_size: int = 2,
+    in_memory: bool = False,
+    spill_threshold: int = 64,
+    prefetch: bool = False,
+    profile: str = "",
+    explain: str = "",
+    refresh_countries: bool = False,
+    workers: int = 1,
+):
+    """Generate dataset and create it in HDX
+
+    Args:
+        delta (bool): Only generate and publish the countries whose input rows changed since the last run
+        stages (bool): Persist the artifacts of each stage in the state folder and only rerun the stages affected by changes since the last run
+        shard (str): Only process shard i of N (given as i/N) of the countries, split by expected number of rows
+        merge_shards_of (int): Check the reports of the given number of shards and merge their digests instead of running
+        pipelined (bool): Generate the next countries in the background while a country is being published
+        queue_size (int): Number of generated countries that can wait to be published in pipelined mode
+        in_memory (bool): Generate the resource files in memory instead of the temporary folder on disk
+        spill_threshold (int): Size in MB above which an in memory resource file is moved to disk
+        prefetch (bool): Fetch the existing datasets and showcases from HDX up front and skip the calls that wouldn't change anything
+        profile (str): Comma separated iso3 codes (or world) of the countries whose generation is profiled, along with the reading of the data, into state/profiles
+        explain (str): Comma separated iso3 codes (or world) of the countries whose row iterator chains are traced, logging their plans
+        refresh_countries (bool): Recompile the country names table (config/country_names.json) from the latest HDX country data first
+        workers (int): Number of processes generating the countries in pipelined mode, largest countries first
+    """
+    if merge_shards_of:
+        merge_shards(merge_shards_of)
+        return
+    if pipelined and stages:
+        raise ValueError("Pipelined mode can't be combined with stages!")
+    if in_memory and stages:
+        raise ValueError("In memory resources can't be combined with stages!")
+    if workers > 1 and not pipelined:
+        raise ValueError("Several workers are only supported in pipelined mode!")
+    if shard:
+        shard_index, number_of_shards = parse_shard(shard)
+        suffix = shard_suffix(shard_index, number_of_shards)
+    else:
+        suffix = ""
+
+    if refresh_countries:
+        refresh_country_names()
+    profiler = Profiler.from_option(join(state_folder, "profiles"), profile)
+    explained = {countryiso.strip().upper() for countryiso in explain.split(",")}
+
     configuration = Configuration.read()
     # October-2025 - the code below cleverly uses the same variable name ("resources"), but for a dataset specific list rather than this global dictionary.
     # It's perhaps clearer to simply rename this one, which is only referenced a couple of times
@@ -57,81 +401,253 @@ def main():
         print(
             "Using the following data directory: ", configuration["hdx_data_directory"]
         )
-        download_url = configuration["hdx_data_directory"]
+        data_directory = configuration["hdx_data_directory"]
+        download_url = data_directory
     #'/Dropbox/UNHCR Statistics/Data/HDX/'
     else:
         # Set the download_url as a path on linux
-        download_url = Path("data").resolve().as_uri()
+        data_directory = "data"
+        download_url = Path(data_directory).resolve().as_uri()
 
     with Download() as downloader:
-        countries, headers, countriesdata, qc_rows = get_countriesdata(
-            download_url, global_resources, downloader
-        )
-        logger.info(f"Number of countries: {len(countriesdata)}")
-        for info, country in progress_storing_tempdir(
-            "UNHCR_population", countries, "iso3"
-        ):
-            folder = info["folder"]
-
-            countryiso = country["iso3"]
-            dataset, showcase, bites_disabled = generate_dataset_and_showcase(
-                folder,
-                country,
-                countriesdata[countryiso],
-                qc_rows,
-                headers,
+        makedirs(state_folder, exist_ok=True)
+        if stages:
+            runner = StageRunner(join(state_folder, f"stages{suffix}"))
+            (countries, headers, countriesdata, qc_rows), _ = runner.run(
+                "ingest",
+                lambda: profiler.run(
+                    "countriesdata",
+                    get_countriesdata,
+                    download_url,
+                    global_resources,
+                    downloader,
+                ),
+                inputs={
+                    "files": {
+                        record["file"]: file_fingerprint(
+                            join(data_directory, record["file"])
+                        )
+                        for record in global_resources.values()
+                    },
+                    "resources": global_resources,
+                },
+            )
+        else:
+            countries, headers, countriesdata, qc_rows = profiler.run(
+                "countriesdata",
+                get_countriesdata,
+                download_url,
                 global_resources,
-                fields,
+                downloader,
+            )
+        logger.info(f"Number of countries: {len(countriesdata)}")
+        digests = get_countriesdigests(countries, headers, countriesdata, qc_rows)
+        if exists(digests_file):
+            previous_digests = load_json(digests_file)
+        else:
+            previous_digests = dict()
+        if delta:
+            countries = get_affected_countries(countries, digests, previous_digests)
+        if shard:
+            costs = get_countrycosts(countries, countriesdata, qc_rows)
+            all_countries = countries
+            countries = split_into_shards(countries, costs, number_of_shards)[
+                shard_index - 1
+            ]
+            batch = shard_batch(all_countries, digests)
+            processed = load_shard_processed(
+                state_folder, shard_index, number_of_shards, batch
             )
-            if dataset:
-                dataset.update_from_yaml()
-                dataset["notes"] = dataset["notes"].replace(
-                    "\n", "  \n"
-                )  # ensure markdown has line breaks
-                # June-23 - change to underscore method name (and actually the correct one is generate quick charts)
-                # resourceview = dataset.generate_resource_view(
-                # resourceview = dataset._generate_resource_view(
-                resourceview = dataset.generate_quickcharts(
-                    -1, bites_disabled=bites_disabled
+
+            def save_report():
+                save_shard_report(
+                    state_folder,
+                    shard_index,
+                    number_of_shards,
+                    batch,
+                    all_countries,
+                    countries,
+                    processed,
                 )
-                if resourceview:
-                    resourceview["hxl_preview_config"] = multiple_replace(
-                        resourceview["hxl_preview_config"],
-                        {
-                            "{{#country+iso}}": countryiso,
-                            "{{#country+name}}": country["countryname"],
-                        },
+
+            # Saved from the start, so that a shard without countries has a report to merge too
+            save_report()
+            # Each shard keeps the digests of its published countries, merged by --merge-shards-of
+            published_digests_file = join(state_folder, f"digests{suffix}.json")
+            if exists(published_digests_file):
+                published_digests = load_json(published_digests_file)
+            else:
+                published_digests = dict()
+        else:
+            published_digests_file = digests_file
+            published_digests = previous_digests
+        remote = None
+        if prefetch:
+            remote = RemoteState.prefetch(join(state_folder, f"remote{suffix}.json"))
+
+        def record_processed(countryiso):
+            # Only remember the digests once the country is published, or found to have no dataset (e.g. STA and
+            # UKN) so that delta runs don't generate it again
+            published_digests[countryiso] = digests[countryiso]
+            save_json(published_digests, published_digests_file, sortkeys=True)
+            if shard:
+                if countryiso not in processed:
+                    processed.append(countryiso)
+                save_report()
+
+        if pipelined:
+            with wheretostart_tempdir_batch(f"UNHCR_population{suffix}") as info:
+                folder = info["folder"]
+                progress_file = join(folder, "progress.txt")
+                remaining = get_remaining_countries(folder, countries)
+                buffers = None
+                if in_memory:
+                    buffers = ResourceBuffers(folder, spill_threshold << 20)
+
+                def get_countryfolder(country):
+                    # Each country gets its own folder as generation runs ahead of publishing
+                    # and all countries write a qc_data.csv
+                    if buffers:
+                        return buffers.folder(country["iso3"])
+                    countryfolder = join(folder, country["iso3"])
+                    makedirs(countryfolder, exist_ok=True)
+                    return countryfolder
+
+                def finish(country, dataset, showcase, bites_disabled):
+                    if dataset:
+                        update_metadata(dataset)
+                        generate_resource_view(dataset, country, bites_disabled)
+                    return dataset, showcase
+
+                def prepare(country):
+                    dataset, showcase, bites_disabled = profiler.run(
+                        country["iso3"],
+                        generate_dataset_and_showcase,
+                        get_countryfolder(country),
+                        country,
+                        countriesdata[country["id"]],
+                        qc_rows,
+                        headers,
+                        global_resources,
+                        fields,
+                        explain=country["iso3"].upper() in explained,
                     )
-                dataset.create_in_hdx(
-                    remove_additional_resources=True,
-                    hxl_update=False,
-                    updated_by_script="UNHCR population",
-                    batch=info["batch"],
-                )
+                    return finish(country, dataset, showcase, bites_disabled)
+
+                pool = None
+                if workers > 1:
+                    # The countries are generated largest first, but still published in order. At most
+                    # queue_size generated countries wait to be published besides those being generated.
+                    pool = LargestFirstPool(
+                        generate_country,
+                        get_countrycosts(remaining, countriesdata, qc_rows),
+                        workers,
+                        key=lambda item: item[0]["iso3"],
+                        initializer=init_generation_worker,
+                        initargs=(
+                            generation_configuration(configuration),
+                            {
+                                "countriesdata": countriesdata,
+                                "qc_rows": qc_rows,
+                                "headers": headers,
+                                "resources": global_resources,
+                                "fields": fields,
+                                "profiler": profiler,
+                                "explained": explained,
+                            },
+                        ),
+                        max_pending=workers + queue_size,
+                    )
+                    generated = (
+                        (country, finish(country, *from_bundle(bundle)))
+                        for (country, _), bundle in pool.map(
+                            (country, get_countryfolder(country))
+                            for country in remaining
+                        )
+                    )
+                else:
+                    generated = pipeline(remaining, prepare, queue_size)
+
+                try:
+                    for i, (country, (dataset, showcase)) in enumerate(generated):
+                        if dataset:
+                            publish(info, dataset, showcase, remote)
+                        # Free the temporary disk space as soon as the country is published
+                        if buffers:
+                            buffers.free(country["iso3"])
+                        else:
+                            rmtree(join(folder, country["iso3"]), ignore_errors=True)
+                        record_processed(country["iso3"])
+                        # The progress only advances once the country is fully published
+                        if i + 1 < len(remaining):
+                            save_text(f"iso3={remaining[i + 1]['iso3']}", progress_file)
+                    if pool:
+                        pool.report()
+                finally:
+                    if buffers:
+                        buffers.close()
+            if remote:
+                remote.log_calls()
+            return
 
-                resource_ids = []
-                resources = dataset.get_resources()
-                for name_start in desired_order:
-                    for direction in direction_order:
-                        for resource in resources:
-                            name = resource["name"]
-                            if name.startswith(name_start) and direction in name:
-                                resource_ids.append(resource["id"])
-                                break
-                for resource in resources:
-                    resource_id = resource["id"]
-                    name = resource["name"]
-                    if name == "qc_data.csv":
-                        resource_ids.append(resource_id)
-                        continue
-                    if resource_id not in resource_ids:
-                        name = resource["name"]
-                        logger.error(f"{name} is missing!")
-                        sys.exit(-1)
-                dataset.reorder_resources(resource_ids, False)
-
-                showcase.create_in_hdx()
-                showcase.add_dataset(dataset)
+        buffers = None
+
+        try:
+            for info, country in progress_storing_tempdir(
+                f"UNHCR_population{suffix}", countries, "iso3"
+            ):
+                folder = info["folder"]
+
+                countryiso = country["iso3"]
+                if stages:
+                    run_country_stages(
+                        runner,
+                        info,
+                        country,
+                        countriesdata[country["id"]],
+                        qc_rows,
+                        headers,
+                        global_resources,
+                        fields,
+                        digests[countryiso],
+                        remote,
+                        profiler,
+                        countryiso.upper() in explained,
+                    )
+                else:
+                    if in_memory and buffers is None:
+                        buffers = ResourceBuffers(folder, spill_threshold << 20)
+                    if buffers:
+                        folder = buffers.folder(countryiso)
+                    dataset, showcase, bites_disabled = profiler.run(
+                        countryiso,
+                        generate_dataset_and_showcase,
+                        folder,
+                        country,
+                        countriesdata[country["id"]],
+                        qc_rows,
+                        headers,
+                        global_resources,
+                        fields,
+                        explain=countryiso.upper() in explained,
+                    )
+                    if dataset:
+                        update_metadata(dataset)
+                        generate_resource_view(dataset, country, bites_disabled)
+                        publish(info, dataset, showcase, remote)
+                    if buffers:
+                        # Free the buffers as soon as the country is published
+                        buffers.free(countryiso)
+                record_processed(countryiso)
+        finally:
+            if buffers:
+                buffers.close()
+        if stages:
+            logger.info(
+                f"Stages run: {len(runner.executed)}, up to date: {len(runner.skipped)}"
+            )
+        if remote:
+            remote.log_calls()
 
 
 if __name__ == "__main__":
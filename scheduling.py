@@ -0,0 +1,318 @@
+"""
+Scheduling of the countries: expected cost of each country, splitting of the countries into shards that can be
+processed on different machines and pipelining of the generation and publishing of the countries.
+
+The cost of a country is estimated by the number of rows it has to process, i.e. the rows in its partitions of
+countriesdata and its QuickCharts rows. The shards are balanced on this cost, largest countries first, so that the
+world and the large hosting countries end up on different shards. For the same reason, the countries are generated
+largest first when generating in several processes (LargestFirstPool), while still being consumed in their order.
+"""
+
+import heapq
+import logging
+from concurrent.futures import ProcessPoolExecutor
+from os.path import exists, join
+from queue import Empty, Queue
+from threading import Event, Thread
+from time import perf_counter
+
+from hdx.utilities.loader import load_json
+from hdx.utilities.saver import save_json
+from stages import fingerprint
+
+logger = logging.getLogger(__name__)
+
+
+def get_countrycosts(countries, countriesdata, qc_rows):
+    """Expected cost of each country (dictionary iso3 -> number of rows to process)"""
+    qc_counts = dict()
+    for _, origin_id, asylum_id in qc_rows.keys():
+        qc_counts[origin_id] = qc_counts.get(origin_id, 0) + 1
+        if asylum_id != origin_id:
+            qc_counts[asylum_id] = qc_counts.get(asylum_id, 0) + 1
+    costs = dict()
+    for country in countries:
+        countrydata = countriesdata[country["id"]]
+        rows = sum(len(resource_rows) for resource_rows in countrydata.values())
+        costs[country["iso3"]] = rows + qc_counts.get(country["id"], 0)
+    return costs
+
+
+def parse_shard(shard):
+    """Parse shard given as i/N (shards numbered from 1), returns tuple (i, N)"""
+    try:
+        index, number_of_shards = (int(x) for x in shard.split("/"))
+    except ValueError:
+        raise ValueError(f"Shard {shard} should be given as i/N, e.g. 1/4")
+    if not 1 <= index <= number_of_shards:
+        raise ValueError(f"Shard {shard} is out of range")
+    return index, number_of_shards
+
+
+def split_into_shards(countries, costs, number_of_shards):
+    """Split countries into *number_of_shards* lists with balanced total cost.
+    Countries are assigned largest first to the shard with the lowest total so far, the split is deterministic.
+    Each shard keeps the countries in the order of *countries*.
+    """
+    loads = [0] * number_of_shards
+    assigned = dict()
+    for country in sorted(countries, key=lambda x: (-costs[x["iso3"]], x["iso3"])):
+        index = loads.index(min(loads))
+        loads[index] += costs[country["iso3"]]
+        assigned[country["iso3"]] = index
+    shards = [[] for _ in range(number_of_shards)]
+    for country in countries:
+        shards[assigned[country["iso3"]]].append(country)
+    for index, load in enumerate(loads):
+        logger.info(
+            f"Shard {index + 1}/{number_of_shards}: {len(shards[index])} countries, cost {load}"
+        )
+    return shards
+
+
+def shard_suffix(index, number_of_shards):
+    return f"_shard_{index}_of_{number_of_shards}"
+
+
+def shard_report_path(folder, index, number_of_shards):
+    return join(folder, f"report{shard_suffix(index, number_of_shards)}.json")
+
+
+def shard_batch(countries, digests):
+    """Batch of a sharded run over *countries*: the same in every shard run on the same data (each shard has its own
+    HDX batch), so that reports left by other runs can be told apart
+    """
+    return fingerprint(
+        [(country["iso3"], digests[country["iso3"]]) for country in countries]
+    )
+
+
+def load_shard_processed(folder, index, number_of_shards, batch):
+    """Countries already processed by shard *index* in this batch (i.e. when a run is resumed)"""
+    path = shard_report_path(folder, index, number_of_shards)
+    if not exists(path):
+        return list()
+    report = load_json(path)
+    if report.get("batch") != batch:
+        return list()
+    return report["processed"]
+
+
+def save_shard_report(
+    folder, index, number_of_shards, batch, countries, assigned, processed
+):
+    """Save report of shard *index*: all countries of the run, those assigned to the shard and those processed"""
+    save_json(
+        {
+            "shard": index,
+            "shards": number_of_shards,
+            "batch": batch,
+            "countries": [country["iso3"] for country in countries],
+            "assigned": [country["iso3"] for country in assigned],
+            "processed": processed,
+        },
+        shard_report_path(folder, index, number_of_shards),
+        pretty=True,
+    )
+
+
+def merge_shard_reports(folder, number_of_shards):
+    """Check the reports of all shards: every country must have been processed by exactly one shard.
+    Returns list of problems found (empty if all is well).
+    """
+    problems = list()
+    batch = None
+    all_countries = None
+    processed = dict()
+    for index in range(1, number_of_shards + 1):
+        path = shard_report_path(folder, index, number_of_shards)
+        if not exists(path):
+            problems.append(f"Shard {index}/{number_of_shards} has no report!")
+            continue
+        report = load_json(path)
+        if batch is None:
+            batch = report.get("batch")
+        elif report.get("batch") != batch:
+            problems.append(f"Shard {index}/{number_of_shards} is from another run!")
+            continue
+        if all_countries is None:
+            all_countries = report["countries"]
+        elif report["countries"] != all_countries:
+            problems.append(
+                f"Shard {index}/{number_of_shards} ran on different countries!"
+            )
+        for countryiso in report["processed"]:
+            processed[countryiso] = processed.get(countryiso, 0) + 1
+    all_countries = all_countries or []
+    for countryiso in all_countries:
+        count = processed.get(countryiso, 0)
+        if count != 1:
+            problems.append(f"{countryiso} processed {count} times!")
+    for countryiso in processed:
+        if countryiso not in all_countries:
+            problems.append(f"{countryiso} processed, but not in the countries!")
+    return problems
+
+
+def pipeline(items, function, queue_size=2):
+    """Call *function* on each of the *items* in a background thread while the results are being consumed.
+    Yields tuples (item, result) in the order of *items*. At most *queue_size* results wait to be consumed,
+    so the producer is held back when the consumer is slower. An exception raised by *function* is raised again
+    in the consumer.
+    """
+    queue = Queue(maxsize=queue_size)
+    stop = Event()
+    done = object()
+
+    def produce():
+        try:
+            for item in items:
+                if stop.is_set():
+                    return
+                queue.put((item, function(item), None))
+        except Exception as e:
+            queue.put((None, None, e))
+        queue.put(done)
+
+    thread = Thread(target=produce, daemon=True)
+    thread.start()
+    try:
+        while True:
+            entry = queue.get()
+            if entry is done:
+                break
+            item, result, exception = entry
+            if exception is not None:
+                raise exception
+            yield item, result
+    finally:
+        stop.set()
+        # Unblock the producer if it is waiting for space in the queue
+        while thread.is_alive():
+            try:
+                while True:
+                    queue.get_nowait()
+            except Empty:
+                pass
+            thread.join(0.1)
+
+
+def predict_makespan(costs, workers, largest_first=True):
+    """Total cost taken by *workers* workers to go through *costs*, each worker taking the next cost as soon as
+    it is free. The costs are taken largest first or in the given order.
+    """
+    if largest_first:
+        costs = sorted(costs, reverse=True)
+    # Heap of the loads of the workers, the least loaded one takes the next cost
+    loads = [0] * workers
+    for cost in costs:
+        heapq.heapreplace(loads, loads[0] + cost)
+    return max(loads)
+
+
+def timed_call(function, item):
+    """Returns tuple (function(item), seconds taken)"""
+    start = perf_counter()
+    result = function(item)
+    return result, perf_counter() - start
+
+
+class LargestFirstPool:
+    """Calls *function* on items in *workers* processes, submitting the items with the largest *costs* (dictionary
+    key(item) -> cost) first. The results are still yielded in the order of the items, so that they can be consumed
+    in order. At most *max_pending* items (all by default) are submitted and not yet consumed, so that the results
+    don't pile up when they are consumed slower than they are produced. The next item to consume is always submitted,
+    even beyond *max_pending*. *function*, *initializer* and *initargs* must be picklable when processes aren't forked.
+    """
+
+    def __init__(
+        self,
+        function,
+        costs,
+        workers,
+        key=lambda x: x,
+        initializer=None,
+        initargs=(),
+        max_pending=None,
+    ):
+        self.function = function
+        self.costs = costs
+        self.workers = workers
+        self.key = key
+        self.max_pending = max_pending
+        self.initializer = initializer
+        self.initargs = initargs
+        self.durations = dict()
+        self.started = None
+        self.finished = None
+
+    def predicted(self, items):
+        """Predicted makespans (in cost) of the items largest first and in their order"""
+        costs = [self.costs[self.key(item)] for item in items]
+        return (
+            predict_makespan(costs, self.workers),
+            predict_makespan(costs, self.workers, largest_first=False),
+        )
+
+    def map(self, items):
+        """Yields tuples (item, result) in the order of *items*"""
+        items = list(items)
+        largest_first, in_order = self.predicted(items)
+        logger.info(
+            f"Predicted makespan on {self.workers} workers: cost {largest_first} largest first, "
+            f"{in_order} in order"
+        )
+        order = sorted(range(len(items)), key=lambda i: -self.costs[self.key(items[i])])
+        executor = ProcessPoolExecutor(
+            self.workers, initializer=self.initializer, initargs=self.initargs
+        )
+        self.started = perf_counter()
+
+        def done(future):
+            self.finished = perf_counter()
+
+        def submit(i):
+            futures[i] = executor.submit(timed_call, self.function, items[i])
+            futures[i].add_done_callback(done)
+            submitted.add(i)
+
+        try:
+            # Submitted and not consumed yet
+            futures = dict()
+            submitted = set()
+            order = iter(order)
+            for i, item in enumerate(items):
+                while self.max_pending is None or len(futures) < self.max_pending:
+                    j = next(order, None)
+                    if j is None:
+                        break
+                    if j not in submitted:
+                        submit(j)
+                if i not in submitted:
+                    submit(i)
+                result, seconds = futures.pop(i).result()
+                self.durations[self.key(item)] = seconds
+                yield item, result
+        finally:
+            executor.shutdown(wait=True, cancel_futures=True)
+
+    def report(self):
+        """Predicted (calibrated with the measured seconds per cost) and actual makespan in seconds"""
+        keys = list(self.durations)
+        cost = sum(self.costs[key] for key in keys)
+        seconds_per_cost = sum(self.durations.values()) / cost if cost else 0.0
+        costs = [self.costs[key] for key in keys]
+        report = {
+            "workers": self.workers,
+            "predicted": predict_makespan(costs, self.workers) * seconds_per_cost,
+            "predicted_in_order": predict_makespan(
+                costs, self.workers, largest_first=False
+            )
+            * seconds_per_cost,
+            "actual": (self.finished - self.started) if self.finished else 0.0,
+        }
+        logger.info(
+            f"Generation makespan on {self.workers} workers: predicted {report['predicted']:.1f}s largest first "
+            f"({report['predicted_in_order']:.1f}s in order), actual {report['actual']:.1f}s"
+        )
+        return report
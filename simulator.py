@@ -0,0 +1,451 @@
+"""
+Local stand-in for the CKAN action API of HDX, used to benchmark the publishing half of run.py without touching HDX.
+
+It implements the actions that Dataset.create_in_hdx, Dataset.search_in_hdx, the resource views and the Showcase
+calls use (package_show, package_create, package_revise, package_search, resource_view_*, ckanext_showcase_* etc.)
+on an in-memory store, as well as group_list and vocabulary_show and the tags mapping and formats files that
+hdx-python-api downloads. Uploaded files are counted and discarded.
+
+Latency (with jitter), a rate of injected server errors and rate limiting (a token bucket answering 429 with a
+Retry-After header) can be configured. Errors and rate limiting happen before the action is applied, so a retried
+call has the same effect as a successful one. Every call is counted by action.
+"""
+
+import json
+import logging
+import random
+from collections import Counter
+from copy import deepcopy
+from datetime import datetime, timezone
+from email.parser import BytesParser
+from email.policy import HTTP
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+from math import ceil
+from threading import Lock, Thread
+from time import monotonic, sleep
+from uuid import uuid4
+
+from hdx.location.country import Country
+
+logger = logging.getLogger(__name__)
+
+default_approved_tags = (
+    "hxl",
+    "refugees",
+    "asylum seekers",
+    "internally displaced persons-idp",
+    "stateless persons",
+    "population",
+)
+
+
+class ActionError(Exception):
+    """Error returned by an action: CKAN error type, message and HTTP status"""
+
+    def __init__(self, error_type, message, status):
+        super().__init__(message)
+        self.error_type = error_type
+        self.message = message
+        self.status = status
+
+
+def not_found(what):
+    return ActionError("Not Found Error", f"Not found: {what}", 404)
+
+
+def now():
+    return datetime.now(timezone.utc).strftime("%Y-%m-%dT%H:%M:%S.%f")
+
+
+class CKANSimulator:
+    """Simulated CKAN server. *latency* and *jitter* are in seconds, *error_rate* is the probability of a call failing
+    with a 500 error and *rate_limit* the number of calls allowed per second (0 for no limit) with bursts of *burst*.
+    """
+
+    def __init__(
+        self,
+        latency=0.0,
+        jitter=0.0,
+        error_rate=0.0,
+        rate_limit=0.0,
+        burst=10,
+        seed=None,
+        approved_tags=default_approved_tags,
+    ):
+        self.latency = latency
+        self.jitter = jitter
+        self.error_rate = error_rate
+        self.rate_limit = rate_limit
+        self.burst = burst
+        self.random = random.Random(seed)
+        self.approved_tags = approved_tags
+        self.lock = Lock()
+        self.tokens = burst
+        self.last_refill = monotonic()
+        # Datasets and showcases (CKAN packages of type showcase) by id
+        self.packages = dict()
+        self.names = dict()
+        self.views = dict()
+        self.associations = dict()
+        self.reset_counters()
+        self.server = None
+        self.thread = None
+
+    def reset_counters(self):
+        self.calls = Counter()
+        self.errors = 0
+        self.rate_limited = 0
+        self.uploaded_bytes = 0
+
+    @property
+    def url(self):
+        host, port = self.server.server_address[:2]
+        return f"http://{host}:{port}"
+
+    def start(self, host="127.0.0.1", port=0):
+        simulator = self
+
+        class Handler(RequestHandler):
+            pass
+
+        Handler.simulator = simulator
+        self.server = ThreadingHTTPServer((host, port), Handler)
+        self.server.daemon_threads = True
+        self.thread = Thread(target=self.server.serve_forever, daemon=True)
+        self.thread.start()
+        logger.info(f"CKAN simulator listening on {self.url}")
+        return self.url
+
+    def stop(self):
+        if self.server:
+            self.server.shutdown()
+            self.server.server_close()
+            self.server = None
+
+    def __enter__(self):
+        self.start()
+        return self
+
+    def __exit__(self, *args):
+        self.stop()
+
+    def hdx_config(self):
+        """HDX configuration entries pointing the downloads of hdx-python-api to the simulator"""
+        return {
+            "tags_mapping_url": f"{self.url}/tags_mapping.csv",
+            "formats_mapping_url": f"{self.url}/resource_formats.json",
+        }
+
+    def wait_for_token(self):
+        """Take a token from the bucket, returns 0 or the number of seconds to wait if there is none"""
+        if not self.rate_limit:
+            return 0
+        with self.lock:
+            current = monotonic()
+            self.tokens = min(
+                self.burst, self.tokens + (current - self.last_refill) * self.rate_limit
+            )
+            self.last_refill = current
+            if self.tokens >= 1:
+                self.tokens -= 1
+                return 0
+            return (1 - self.tokens) / self.rate_limit
+
+    def call(self, action, data, files):
+        """Call *action*, returns tuple (HTTP status, response dictionary, headers)"""
+        if self.latency or self.jitter:
+            sleep(max(0.0, self.latency + self.random.uniform(-1, 1) * self.jitter))
+        wait = self.wait_for_token()
+        if wait:
+            with self.lock:
+                self.rate_limited += 1
+            error = {"__type": "Rate Limit", "message": "Too many requests"}
+            return 429, {"success": False, "error": error}, {"Retry-After": ceil(wait)}
+        with self.lock:
+            self.calls[action] += 1
+            if self.error_rate and self.random.random() < self.error_rate:
+                self.errors += 1
+                error = {"__type": "Internal Server Error", "message": "Injected"}
+                return 500, {"success": False, "error": error}, {}
+            function = getattr(self, f"action_{action}", None)
+            try:
+                if function is None:
+                    raise ActionError("Bad Request", f"Action {action} not known", 400)
+                result = deepcopy(function(data, files))
+            except ActionError as e:
+                error = {"__type": e.error_type, "message": e.message}
+                return e.status, {"success": False, "error": error}, {}
+        return 200, {"success": True, "result": result}, {}
+
+    # Store
+
+    def get_package(self, id_or_name, package_type=None):
+        package_id = self.names.get(id_or_name, id_or_name)
+        package = self.packages.get(package_id)
+        if package is None or (package_type and package["type"] != package_type):
+            raise not_found(id_or_name)
+        return package
+
+    def new_package(self, data, package_type):
+        name = data.get("name")
+        if not name:
+            raise ActionError("Validation Error", "Missing name", 409)
+        if name in self.names:
+            raise ActionError("Validation Error", f"{name} already exists", 409)
+        package = dict(data)
+        package["id"] = str(uuid4())
+        package["type"] = package_type
+        package["state"] = "active"
+        package["metadata_created"] = package["metadata_modified"] = now()
+        package["resources"] = []
+        self.update_resources(package, data.get("resources", []), dict())
+        self.packages[package["id"]] = package
+        self.names[name] = package["id"]
+        return package
+
+    def update_resources(self, package, resources, files):
+        """Merge *resources* into the resources of the package by position (as package_revise does)"""
+        existing = package["resources"]
+        for i, data in enumerate(resources):
+            if i < len(existing):
+                existing[i].update(data)
+            else:
+                existing.append(dict(data))
+            resource = existing[i]
+            resource.setdefault("id", str(uuid4()))
+            resource["package_id"] = package["id"]
+            upload = files.get(f"update__resources__{i}__upload")
+            if upload is not None:
+                filename, content = upload
+                self.uploaded_bytes += len(content)
+                resource["url_type"] = "upload"
+                resource["url"] = (
+                    f"{self.url}/dataset/{package['id']}/resource/{resource['id']}"
+                    f"/download/{filename}"
+                )
+        for i, resource in enumerate(existing):
+            resource["position"] = i
+
+    # Datasets
+
+    def action_package_show(self, data, files):
+        return self.get_package(data.get("id"))
+
+    def action_package_create(self, data, files):
+        return self.new_package(data, data.get("type", "dataset"))
+
+    def action_package_update(self, data, files):
+        package = self.get_package(data.get("id") or data.get("name"))
+        resources = data.pop("resources", [])
+        package.update(data)
+        package["resources"] = []
+        self.update_resources(package, resources, files)
+        package["metadata_modified"] = now()
+        return package
+
+    def action_package_revise(self, data, files):
+        match = json.loads(data["match"])
+        package = self.get_package(match.get("id") or match.get("name"))
+        for key in json.loads(data.get("filter", "[]")):
+            key = key.lstrip("-").split("__")
+            if len(key) == 2 and key[1].isdigit():
+                values = package.get(key[0], [])
+                if int(key[1]) < len(values):
+                    del values[int(key[1])]
+            else:
+                package.pop(key[0], None)
+        update = json.loads(data.get("update", "{}"))
+        resources = update.pop("resources", [])
+        package.update(update)
+        self.update_resources(package, resources, files)
+        package["metadata_modified"] = now()
+        return {"package": package}
+
+    def action_package_resource_reorder(self, data, files):
+        package = self.get_package(data["id"])
+        order = data["order"]
+        resources = package["resources"]
+        resources.sort(
+            key=lambda x: order.index(x["id"]) if x["id"] in order else len(order)
+        )
+        for i, resource in enumerate(resources):
+            resource["position"] = i
+        return {"id": package["id"], "order": [x["id"] for x in resources]}
+
+    def action_package_create_default_resource_views(self, data, files):
+        return []
+
+    def action_package_hxl_update(self, data, files):
+        return self.get_package(data.get("id"))
+
+    def action_package_search(self, data, files):
+        conditions = dict()
+        for term in (data.get("fq") or "").split(" AND "):
+            if ":" in term:
+                field, value = term.split(":", 1)
+                conditions[field.lstrip("+")] = value
+        package_type = conditions.pop("dataset_type", "dataset")
+        results = []
+        for package in self.packages.values():
+            if package["type"] != package_type:
+                continue
+            for field, value in conditions.items():
+                actual = str(package.get(field, ""))
+                if value.endswith("*"):
+                    if not actual.startswith(value[:-1]):
+                        break
+                elif actual != value:
+                    break
+            else:
+                results.append(package)
+        start = int(data.get("start", 0))
+        rows = int(data.get("rows", 1000))
+        return {
+            "count": len(results),
+            "results": results[start : start + rows],
+            "facets": {},
+            "search_facets": {},
+        }
+
+    # Resource views
+
+    def action_resource_view_list(self, data, files):
+        return self.views.get(data["id"], [])
+
+    def action_resource_view_show(self, data, files):
+        for views in self.views.values():
+            for view in views:
+                if view["id"] == data["id"]:
+                    return view
+        raise not_found(data["id"])
+
+    def action_resource_view_create(self, data, files):
+        view = dict(data)
+        view["id"] = str(uuid4())
+        self.views.setdefault(view["resource_id"], []).append(view)
+        return view
+
+    def action_resource_view_update(self, data, files):
+        view = self.action_resource_view_show(data, files)
+        view.update(data)
+        return view
+
+    # Showcases
+
+    def action_ckanext_showcase_show(self, data, files):
+        return self.get_package(data.get("id"), "showcase")
+
+    def action_ckanext_showcase_create(self, data, files):
+        return self.new_package(data, "showcase")
+
+    def action_ckanext_showcase_update(self, data, files):
+        showcase = self.get_package(data.get("id") or data.get("name"), "showcase")
+        showcase.update(data)
+        showcase["metadata_modified"] = now()
+        return showcase
+
+    def action_ckanext_showcase_package_list(self, data, files):
+        showcase = self.get_package(data["showcase_id"], "showcase")
+        return [
+            self.packages[package_id]
+            for package_id in self.associations.get(showcase["id"], [])
+        ]
+
+    def action_ckanext_showcase_package_association_create(self, data, files):
+        showcase = self.get_package(data["showcase_id"], "showcase")
+        package = self.get_package(data["package_id"])
+        packages = self.associations.setdefault(showcase["id"], [])
+        if package["id"] not in packages:
+            packages.append(package["id"])
+        return {"showcase_id": showcase["id"], "package_id": package["id"]}
+
+    # Reference data
+
+    def action_group_list(self, data, files):
+        locations = [
+            {"name": countryiso.lower(), "title": country["#country+name+preferred"]}
+            for countryiso, country in Country.countriesdata(use_live=False)[
+                "countries"
+            ].items()
+        ]
+        locations.append({"name": "world", "title": "World"})
+        return locations
+
+    def action_vocabulary_show(self, data, files):
+        return {
+            "id": "approved-tags",
+            "name": data.get("id"),
+            "tags": [{"name": tag} for tag in self.approved_tags],
+        }
+
+    def static_file(self, path):
+        """Content of the files that hdx-python-api downloads (None if *path* is unknown)"""
+        if path == "/tags_mapping.csv":
+            rows = ["Current Tag,Action to Take,New Tag(s)"]
+            rows.extend(f"{tag},ok," for tag in self.approved_tags)
+            return "text/csv", "\r\n".join(rows).encode("utf-8")
+        if path == "/resource_formats.json":
+            formats = [["CSV", "Comma Separated Values", "text/csv", ["csv"]]]
+            return "application/json", json.dumps(formats).encode("utf-8")
+        return None
+
+
+class RequestHandler(BaseHTTPRequestHandler):
+    """Translates HTTP requests to calls of the simulator"""
+
+    protocol_version = "HTTP/1.1"
+    simulator = None
+
+    def log_message(self, format, *args):
+        logger.debug(format % args)
+
+    def send(self, status, body, content_type="application/json", headers=None):
+        self.send_response(status)
+        self.send_header("Content-Type", content_type)
+        self.send_header("Content-Length", str(len(body)))
+        for key, value in (headers or {}).items():
+            self.send_header(key, str(value))
+        self.end_headers()
+        self.wfile.write(body)
+
+    def read_request(self):
+        """Data dictionary and uploaded files {field: (filename, content)} of the request"""
+        length = int(self.headers.get("Content-Length", 0))
+        body = self.rfile.read(length)
+        content_type = self.headers.get("Content-Type", "")
+        if not content_type.startswith("multipart/form-data"):
+            return (json.loads(body) if body else dict()), dict()
+        message = BytesParser(policy=HTTP).parsebytes(
+            f"Content-Type: {content_type}\r\n\r\n".encode("utf-8") + body
+        )
+        data = dict()
+        files = dict()
+        for part in message.iter_parts():
+            name = part.get_param("name", header="content-disposition")
+            filename = part.get_filename()
+            content = part.get_payload(decode=True)
+            if filename:
+                files[name] = (filename, content)
+            else:
+                data[name] = content.decode("utf-8")
+        return data, files
+
+    def do_GET(self):
+        static = self.simulator.static_file(self.path.split("?")[0])
+        if static is None:
+            self.send(404, b"Not found", "text/plain")
+            return
+        content_type, body = static
+        self.send(200, body, content_type)
+
+    def do_POST(self):
+        path = self.path.split("?")[0].rstrip("/")
+        prefix = "/api/action/"
+        if not path.startswith(prefix):
+            self.send(404, b"Not found", "text/plain")
+            return
+        data, files = self.read_request()
+        status, response, headers = self.simulator.call(
+            path[len(prefix) :], data, files
+        )
+        self.send(status, json.dumps(response).encode("utf-8"), headers=headers)
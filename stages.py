@@ -0,0 +1,126 @@
+"""
+Pipeline stages with persisted intermediate artifacts.
+
+Each stage is identified by a name (e.g. "ingest" or "metadata/AFG") and a fingerprint of its inputs: configuration,
+input digests, fingerprints of the stages it depends on etc.  When a stage is run and its fingerprint matches the one
+recorded in the manifest by a previous run, the artifact persisted by that run is loaded instead of running the stage
+again.  As the fingerprints of the dependencies are part of the fingerprint, a change only reruns the stages
+downstream of it - e.g. a change to hdx_resource_view_static.yml reruns the resource view and upload stages, but not
+the generation of the files.
+
+HDX objects keep a reference to the configuration (including the HDX key), so they are persisted as plain
+dictionaries - see to_bundle and from_bundle.
+"""
+
+import hashlib
+import json
+import logging
+import pickle
+from os import makedirs
+from os.path import dirname, exists, join
+
+from hdx.utilities.loader import load_json
+from hdx.utilities.saver import save_json
+
+logger = logging.getLogger(__name__)
+
+
+def fingerprint(*parts):
+    """Fingerprint of json serialisable *parts*"""
+    text = json.dumps(parts, sort_keys=True, default=str)
+    return hashlib.sha1(text.encode("utf-8")).hexdigest()
+
+
+def file_fingerprint(path):
+    """Fingerprint of the content of a file (None if the file doesn't exist)"""
+    if not exists(path):
+        return None
+    digest = hashlib.sha1()
+    with open(path, "rb") as f:
+        while chunk := f.read(1 << 20):
+            digest.update(chunk)
+    return digest.hexdigest()
+
+
+class StageRunner:
+    """Runs stages, skipping those whose fingerprint didn't change since the previous run.
+    Artifacts and the manifest with the fingerprints are kept in *folder*.
+    """
+
+    def __init__(self, folder):
+        self.folder = folder
+        self.manifest_path = join(folder, "manifest.json")
+        if exists(self.manifest_path):
+            self.manifest = load_json(self.manifest_path)
+        else:
+            self.manifest = dict()
+        self.executed = []
+        self.skipped = []
+
+    def artifact_path(self, name):
+        return join(self.folder, *name.split("/")) + ".pickle"
+
+    def run(self, name, function, inputs=None, dependencies=None):
+        """Run stage *name* by calling *function* without arguments, unless the fingerprint of *inputs*
+        and *dependencies* (fingerprints of upstream stages) is the same as in the previous run.
+        Returns a tuple (artifact, fingerprint).
+        """
+        stage_fingerprint = fingerprint(name, inputs, dependencies or [])
+        path = self.artifact_path(name)
+        if self.manifest.get(name) == stage_fingerprint and exists(path):
+            with open(path, "rb") as f:
+                artifact = pickle.load(f)
+            self.skipped.append(name)
+            logger.info(f"Stage {name} is up to date")
+            return artifact, stage_fingerprint
+
+        logger.info(f"Running stage {name}")
+        artifact = function()
+        makedirs(dirname(path), exist_ok=True)
+        with open(path, "wb") as f:
+            pickle.dump(artifact, f, protocol=pickle.HIGHEST_PROTOCOL)
+        self.manifest[name] = stage_fingerprint
+        save_json(self.manifest, self.manifest_path, pretty=True, sortkeys=True)
+        self.executed.append(name)
+        return artifact, stage_fingerprint
+
+
+def to_bundle(dataset, showcase, bites_disabled):
+    """Convert the objects returned by generate_dataset_and_showcase (with the resource view generated
+    by the dataset, if any) to plain data that can be persisted. Returns None if there is no dataset.
+    """
+    if dataset is None:
+        return None
+    resourceview = dataset._preview_resourceview
+    return {
+        "dataset": dict(dataset.data),
+        "resources": [
+            (dict(resource.data), resource.get_file_to_upload())
+            for resource in dataset.get_resources()
+        ],
+        "resourceview": dict(resourceview.data) if resourceview else None,
+        "showcase": dict(showcase.data),
+        "bites_disabled": bites_disabled,
+    }
+
+
+def from_bundle(bundle):
+    """Recreate dataset, showcase and bites_disabled from data created by to_bundle"""
+    if bundle is None:
+        return None, None, None
+    from hdx.data.dataset import Dataset
+    from hdx.data.resource import Resource
+    from hdx.data.resource_view import ResourceView
+    from hdx.data.showcase import Showcase
+
+    dataset = Dataset(dict(bundle["dataset"]))
+    for data, file_to_upload in bundle["resources"]:
+        resource = Resource(dict(data))
+        if file_to_upload:
+            resource.set_file_to_upload(file_to_upload)
+        dataset.add_update_resource(resource)
+    if bundle["resourceview"]:
+        # The dataset creates the resource view itself once the resource ids are known
+        dataset._preview_resourceview = ResourceView(dict(bundle["resourceview"]))
+    showcase = Showcase(dict(bundle["showcase"]))
+    return dataset, showcase, bundle["bites_disabled"]
@@ -0,0 +1,15 @@
+from os.path import join
+
+import pytest
+from hdx.api.configuration import Configuration
+
+
+@pytest.fixture(scope="session")
+def configuration():
+    """HDX configuration of the tests, with the project configuration in tests/config"""
+    Configuration._create(
+        user_agent="test",
+        hdx_key="12345",
+        project_config_yaml=join("tests", "config", "project_configuration.yml"),
+    )
+    return Configuration.read()
@@ -0,0 +1,33 @@
+import sys
+from os.path import dirname, join
+
+import pandas as pd
+
+sys.path.append(join(dirname(dirname(__file__)), "doc"))
+
+from aggregates import build_aggregates, lookup_totals  # noqa: E402
+
+
+class TestAggregates:
+    def test_build_aggregates_categorical(self):
+        df = pd.DataFrame(
+            {
+                "Year": [2019, 2019, 2020, 2020, 2020],
+                "ISO3CoO": ["AFG", "AFG", "AFG", "SYR", "SYR"],
+                "ISO3CoA": ["PAK", "PAK", "IRN", "TUR", None],
+                "Refugees": [1, 2, 3, 4, 5],
+            }
+        )
+        plain = build_aggregates(df, "ISO3CoO", "ISO3CoA")
+        categorical = df.astype({"ISO3CoO": "category", "ISO3CoA": "category"})
+        aggregates = build_aggregates(categorical, "ISO3CoO", "ISO3CoA")
+        # Only the combinations in the data, not all the countries x years x counterparts
+        assert len(plain) == 4
+        assert len(aggregates) == len(plain)
+        assert aggregates["Refugees"].tolist() == plain["Refugees"].tolist()
+        country_map = {"PAK": "Pakistan", "IRN": "Iran", "TUR": "Türkiye"}
+        totals = lookup_totals(aggregates, "AFG", "Country", False, country_map)
+        assert totals.to_dict("list") == {
+            "Country": ["Iran", "Pakistan"],
+            "Refugees": [3, 3],
+        }
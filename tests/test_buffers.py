@@ -0,0 +1,106 @@
+import pickle
+from errno import ENOSPC
+from os.path import exists, getsize, join
+
+from hdx.data.dataset import Dataset
+from hdx.data.resource import Resource
+from hdx.utilities.path import temp_dir
+from buffers import (
+    BufferFolder,
+    ResourceBuffers,
+    generate_resource,
+    open_resource_file,
+)
+
+
+class TestBuffers:
+    def test_resource_buffers(self, configuration):
+        with temp_dir("buffers_memory") as root, temp_dir("buffers_disk") as disk:
+            with ResourceBuffers(disk, threshold=10, root=root) as buffers:
+                folder = buffers.folder("AFG")
+                assert isinstance(folder, BufferFolder)
+                assert folder.startswith(root)
+                assert pickle.loads(pickle.dumps(folder)).spill_folder == join(
+                    disk, "AFG"
+                )
+                dataset = Dataset({"name": "test"})
+
+                def generate(filename, text):
+                    def write(folder):
+                        path = join(folder, filename)
+                        with open(path, "w") as f:
+                            f.write(text)
+                        resource = Resource({"name": filename})
+                        resource.set_format("csv")
+                        resource.set_file_to_upload(path)
+                        dataset.add_update_resource(resource)
+                        return True, {"resource": resource}
+
+                    return generate_resource(folder, filename, write)
+
+                generate("small.csv", "a,b\n")
+                generate("big.csv", "a,b\n" * 5)
+                small, big = (r.get_file_to_upload() for r in dataset.get_resources())
+                assert small == join(folder, "small.csv")
+                assert big == join(disk, "AFG", "big.csv")
+                assert exists(big)
+                assert not exists(join(folder, "big.csv"))
+
+                buffers.free("AFG")
+                assert not exists(small)
+                assert not exists(big)
+                memory_folder = buffers.memory_folder
+            assert not exists(memory_folder)
+
+    def test_spilling_file(self):
+        with temp_dir("buffers_memory") as root, temp_dir("buffers_disk") as disk:
+            with ResourceBuffers(disk, threshold=10, root=root) as buffers:
+                folder = buffers.folder("AFG")
+                with open_resource_file(folder, "small.csv") as f:
+                    f.write("a,b\n")
+                assert f.name == join(folder, "small.csv")
+                # Moved to disk once above the threshold while being written
+                with open_resource_file(folder, "big.csv") as f:
+                    f.buffer_size = 4
+                    f.write("a,b\n" * 3)
+                    assert f.name == join(disk, "AFG", "big.csv")
+                    f.write("é\n")
+                assert not exists(join(folder, "big.csv"))
+                with open(f.name, encoding="utf-8") as g:
+                    assert g.read() == "a,b\n" * 3 + "é\n"
+
+    def test_short_of_memory(self):
+        with temp_dir("buffers_memory") as root, temp_dir("buffers_disk") as disk:
+            # More than the free space, every file goes to disk
+            with ResourceBuffers(disk, threshold=1 << 60, root=root) as buffers:
+                folder = buffers.folder("AFG")
+                with open_resource_file(folder, "world.csv") as f:
+                    f.write("a,b\n")
+                assert f.name == join(disk, "AFG", "world.csv")
+                assert getsize(f.name) == 4
+                assert generate_resource(folder, "x.csv", lambda x: x) == join(
+                    disk, "AFG"
+                )
+            # Out of memory while writing
+            with ResourceBuffers(disk, threshold=10, root=root) as buffers:
+                folder = buffers.folder("AFG")
+                folders = []
+
+                def generate(folder):
+                    folders.append(folder)
+                    with open(join(folder, "x.csv"), "w") as f:
+                        f.write("a")
+                    if len(folders) == 1:
+                        raise OSError(ENOSPC, "No space left on device")
+                    return False, dict()
+
+                assert generate_resource(folder, "x.csv", generate) == (False, dict())
+                assert folders == [folder, join(disk, "AFG")]
+                assert not exists(join(folder, "x.csv"))
+
+    def test_resource_buffers_fallback(self):
+        with temp_dir("buffers_disk") as disk:
+            buffers = ResourceBuffers(disk, root=join(disk, "missing"))
+            assert buffers.memory_folder is None
+            assert buffers.folder("AFG") == join(disk, "AFG")
+            buffers.close()
@@ -0,0 +1,72 @@
+import json
+import subprocess
+import sys
+from os.path import join
+
+from countrynames import (
+    compile_country_names,
+    get_country_name,
+    load_country_names,
+    table_path,
+    table_version,
+)
+from hdx.location.country import Country
+from hdx.utilities.path import temp_dir
+
+# Seconds allowed for importing run.py and looking up a first country name
+startup_target = 2.0
+
+heavy_modules = [
+    "hdx.location.country",
+    "hdx.data.dataset",
+    "hdx.data.showcase",
+    "hdx.api.utilities.size_hash",
+]
+
+
+class TestCountryNames:
+    def test_table(self):
+        names = load_country_names(table_path)
+        countries = Country.countriesdata(use_live=False)["countries"]
+        assert len(names) == len(countries)
+        for countryiso in ("AFG", "BGD", "CIV", "PSE", "TUR"):
+            assert names[countryiso] == Country.get_country_name_from_iso3(
+                countryiso, use_live=False
+            )
+        assert get_country_name("bgd") == "Bangladesh"
+        assert get_country_name("UKN") is None
+
+    def test_compile(self):
+        with temp_dir("countrynames") as folder:
+            path = join(folder, "country_names.json")
+            names = load_country_names(path)
+            assert names["BGD"] == "Bangladesh"
+            with open(path) as f:
+                table = json.load(f)
+            assert table["version"] == table_version
+            assert table["source"].startswith("hdx-python-country")
+
+            table["version"] = table_version - 1
+            table["names"] = {"BGD": "Outdated"}
+            with open(path, "w") as f:
+                json.dump(table, f)
+            assert load_country_names(path)["BGD"] == "Bangladesh"
+            assert compile_country_names(path, use_live=False) == names
+
+    def test_startup(self):
+        code = f"""
+import sys
+from time import perf_counter
+start = perf_counter()
+import run
+from unhcr import Get_Country_Name_From_ISO3_Extended
+assert Get_Country_Name_From_ISO3_Extended("BGD") == "Bangladesh"
+print(perf_counter() - start)
+print(",".join(module for module in {heavy_modules!r} if module in sys.modules))
+"""
+        output = subprocess.run(
+            [sys.executable, "-c", code], capture_output=True, check=True, text=True
+        ).stdout.splitlines()
+        seconds, loaded = float(output[-2]), output[-1]
+        assert loaded == ""
+        assert seconds < startup_target
@@ -1,5 +1,12 @@
+import csv
+from os import listdir
+from os.path import join
+
 import pytest
+from hdx.data.dataset import Dataset
+from hdx.utilities.path import temp_dir
 from fields import (
+    ListIterator,
     RowIterator,
     add_decoded_fields_in_iterator,
     convert_fields_in_iterator,
@@ -7,6 +14,7 @@ from fields import (
     encoding,
     hxltags_mapping,
     rename_fields_in_iterator,
+    write_converted_csv,
 )
 from ruamel.yaml import YAML
 
@@ -158,3 +166,105 @@ fields:
         rowit = RowIterator(["a", "b"], data).with_sum_field("c", sum_fields=["a", "b"])
         assert rowit.headers() == ["a", "b", "c"]
         assert list(rowit) == [dict(a=1, b=10, c=11), dict(a=2, b=20, c=22)]
+
+    def test_trace(self, iterator, fields):
+        data = [dict(a=1, b=10), dict(a=2, b=20, x=1), dict(a=3, b=30)]
+        rowit = (
+            ListIterator(data, headers=["a"])
+            .trace("data")
+            .auto_headers()
+            .to_list_iterator()
+        )
+        assert rowit.column("a") == [1, 2, 3]
+        rowit = (
+            rowit.select(lambda row: row["a"] > 1)
+            .with_sum_field("c", sum_fields=["a", "b"])
+            .with_fields(fields)
+        )
+        assert rowit.headers() == ["a", "b", "x", "c"]
+        assert list(rowit) == [dict(a=2, b=20, x=1, c=22), dict(a=3, b=30, c=33)]
+        rowit.reset()
+        assert len(list(rowit)) == 2
+
+        plan = rowit.plan()
+        assert plan["operator"] == "with_fields"
+        assert plan["rows_out"] == 4
+        assert plan["passes"] == 2
+        sum_field = plan["children"][0]
+        assert sum_field["operator"] == "with_sum_field"
+        assert sum_field["detail"] == "c"
+        select = sum_field["children"][0]
+        assert select["operator"] == "select"
+        assert (select["rows_in"], select["rows_out"]) == (3, 4)
+        assert select["materialized"] == 2
+        to_list = select["children"][0]
+        assert to_list["operator"] == "to_list_iterator"
+        assert to_list["materialized"] == 3
+        source = to_list["children"][0]
+        assert source["operator"] == "data"
+        assert source["rows_out"] == 3
+        assert "auto_headers" in source["calls"]
+        assert source["children"] == []
+
+        lines = rowit.explain().splitlines()
+        assert len(lines) == 5
+        assert lines[0].startswith(
+            "with_fields [2 fields]: 4 rows in, 4 rows out in 2 passes"
+        )
+        assert lines[4].startswith("        data: 0 rows in, 3 rows out")
+
+        rowit = RowIterator(["a"], data).trace(enabled=False)
+        assert isinstance(rowit, RowIterator)
+
+    @staticmethod
+    def hdx_csv(folder, headers, rows, fields):
+        """Bytes of the csv file hdx-python-api writes for *rows* converted with *fields*"""
+        rowit = RowIterator(headers, rows).with_fields(fields)
+        success, _ = Dataset({"name": "test"}).generate_resource_from_iterable(
+            rowit.headers(),
+            rowit,
+            rowit.hxltags_mapping(),
+            folder,
+            "hdx.csv",
+            {"name": "hdx", "description": "HDX"},
+            encoding="utf-8",
+        )
+        assert success
+        with open(join(folder, "hdx.csv"), "rb") as f:
+            return f.read()
+
+    @staticmethod
+    def converted_csv(folder, headers, rows, fields, block_size=65536):
+        """Bytes of the csv file written by write_converted_csv, and the number of rows"""
+        path = join(folder, "converted.csv")
+        with open(path, "w", encoding="utf-8", newline="") as f:
+            number_of_rows = write_converted_csv(f, headers, rows, fields, block_size)
+        with open(path, "rb") as f:
+            return f.read(), number_of_rows
+
+    def test_write_converted_csv(self, configuration, iterator, fields):
+        headers = ["field1", "field2", "unspecified_field"]
+        with temp_dir("converted_csv") as folder:
+            converted, number_of_rows = self.converted_csv(
+                folder, headers, iterator, fields, block_size=1
+            )
+            assert number_of_rows == 2
+            assert converted == self.hdx_csv(folder, headers, iterator, fields)
+        assert converted.splitlines()[3] == b"f1val2,f2val2,,X2"
+
+    def test_write_converted_csv_fixtures(self, configuration):
+        fields = configuration["fields"]
+        fixtures = join("tests", "fixtures")
+        with temp_dir("converted_csv") as folder:
+            for filename in sorted(listdir(fixtures)):
+                with open(join(fixtures, filename), newline="") as f:
+                    reader = csv.DictReader(f)
+                    headers = reader.fieldnames
+                    rows = list(reader)
+                converted, number_of_rows = self.converted_csv(
+                    folder, headers, rows, fields
+                )
+                assert number_of_rows == len(rows)
+                assert converted == self.hdx_csv(
+                    folder, headers, rows, fields
+                ), filename
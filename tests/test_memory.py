@@ -0,0 +1,122 @@
+"""
+Memory budgets of reading the data and generating the largest dataset (the world), on the fixtures scaled up by
+repeating their rows with shifted years.
+
+The peak is measured at two scales and the growth between them, in MB per million input rows, is checked against
+the budgets, so that fixed costs (e.g. the encoding detection) don't count. Run with -s to see the source lines
+allocating the most.
+"""
+
+import csv
+from os import listdir
+from os.path import join
+from pathlib import Path
+
+import pytest
+from hdx.api.locations import Locations
+from hdx.data.vocabulary import Vocabulary
+from hdx.location.country import Country
+from hdx.utilities.downloader import Download
+from hdx.utilities.path import temp_dir
+from profiling import measure_memory
+from unhcr import WORLD, generate_dataset_and_showcase, get_countriesdata
+
+# Peak traced memory in MB per million input rows
+budgets = {"get_countriesdata": 1600, "generate_dataset_and_showcase": 200}
+scales = (1, 4)
+
+fixtures_folder = join("tests", "fixtures")
+
+
+def write_scaled_fixtures(folder, scale):
+    """Write the fixtures with their rows repeated *scale* times, returns the number of rows"""
+    rows = 0
+    for filename in listdir(fixtures_folder):
+        with open(join(fixtures_folder, filename), newline="") as input_file:
+            reader = csv.reader(input_file)
+            headers = next(reader)
+            data = list(reader)
+        with open(join(folder, filename), "w", newline="") as output_file:
+            writer = csv.writer(output_file, quoting=csv.QUOTE_NONNUMERIC)
+            writer.writerow(headers)
+            for i in range(scale):
+                for row in data:
+                    writer.writerow([str(int(row[0]) + 100 * i)] + row[1:])
+                    rows += 1
+    return rows
+
+
+@pytest.fixture(scope="module")
+def world_configuration(configuration):
+    """The test configuration, with the world as valid location and the approved tags"""
+    Locations.set_validlocations([{"name": "world", "title": "World"}])
+    Country.countriesdata(use_live=False)
+    Vocabulary._tags_dict = {}
+    Vocabulary._approved_vocabulary = {
+        "tags": [
+            {"name": "hxl"},
+            {"name": "refugees"},
+            {"name": "asylum seekers"},
+            {"name": "internally displaced persons-idp"},
+            {"name": "stateless persons"},
+            {"name": "population"},
+        ],
+        "id": "4e61d464-4943-4e97-973a-84673c1aaa87",
+        "name": "approved",
+    }
+    return configuration
+
+
+@pytest.fixture(scope="module")
+def reports(world_configuration):
+    """Rows and memory reports of each step at each scale"""
+    resources = world_configuration["resources"]
+    fields = world_configuration["fields"]
+    downloader = Download(user_agent="test")
+    # Warm up so that the imports and caches filled by the first call aren't measured
+    get_countriesdata(Path(fixtures_folder).resolve().as_uri(), resources, downloader)
+    reports = []
+    for scale in scales:
+        with temp_dir(f"memory{scale}") as folder:
+            rows = write_scaled_fixtures(folder, scale)
+            data, ingest = measure_memory(
+                get_countriesdata,
+                Path(folder).resolve().as_uri(),
+                resources,
+                downloader,
+            )
+            countries, headers, countriesdata, qc_rows = data
+            world = countries[0]
+            assert world["iso3"] == WORLD
+            _, generate = measure_memory(
+                generate_dataset_and_showcase,
+                folder,
+                world,
+                countriesdata[world["id"]],
+                qc_rows,
+                headers,
+                resources,
+                fields,
+            )
+            del data, countriesdata, qc_rows
+        reports.append(
+            (
+                rows,
+                {
+                    "get_countriesdata": ingest,
+                    "generate_dataset_and_showcase": generate,
+                },
+            )
+        )
+    return reports
+
+
+class TestMemory:
+    @pytest.mark.parametrize("step", list(budgets))
+    def test_memory_budget(self, reports, step):
+        (small_rows, small), (large_rows, large) = reports
+        growth = large[step].peak - small[step].peak
+        per_million = growth / (1 << 20) / (large_rows - small_rows) * 1000000
+        print(f"{step}: {per_million:.0f}MB per million rows")
+        print(large[step])
+        assert per_million <= budgets[step], str(large[step])
@@ -0,0 +1,57 @@
+import pstats
+from os import listdir
+from os.path import join
+from time import perf_counter
+
+from hdx.utilities.path import temp_dir
+from profiling import Profiler, measure_memory
+
+
+def allocate(size):
+    data = bytearray(size)
+    return len(data)
+
+
+def busy(seconds):
+    start = perf_counter()
+    total = 0
+    while perf_counter() - start < seconds:
+        total += sum(range(100))
+    return total
+
+
+class TestProfiling:
+    def test_profiler(self):
+        with temp_dir("profiling") as folder:
+            profiler = Profiler.from_option(folder, "world, bgd")
+            assert profiler.selected("countriesdata")
+            assert profiler.selected("BGD")
+            assert not profiler.selected("AFG")
+            assert profiler.run("AFG", busy, 0.01) > 0
+            assert listdir(folder) == []
+
+            profiler = Profiler(folder, ["world"], interval=0.001)
+            assert profiler.run("world", busy, 0.1) > 0
+            assert sorted(listdir(folder)) == ["WORLD.collapsed", "WORLD.pstats"]
+            stats = pstats.Stats(join(folder, "WORLD.pstats"))
+            assert any(function[2] == "busy" for function in stats.stats)
+            with open(join(folder, "WORLD.collapsed")) as f:
+                lines = f.read().splitlines()
+            assert lines
+            for line in lines:
+                stack, count = line.rsplit(" ", 1)
+                assert stack.startswith("busy (test_profiling.py:")
+                assert int(count) > 0
+
+    def test_no_profiling(self):
+        profiler = Profiler.from_option("profiles", "")
+        assert not profiler.selected("countriesdata")
+        assert profiler.run("countriesdata", busy, 0) == 0
+
+    def test_measure_memory(self):
+        result, report = measure_memory(allocate, 8 << 20, top=3)
+        assert result == 8 << 20
+        assert report.peak >= 8 << 20
+        assert report.per_million(1000000) >= 8
+        assert len(report.top_lines) <= 3
+        assert str(report).startswith("Peak traced memory")
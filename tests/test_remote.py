@@ -0,0 +1,97 @@
+from os.path import exists, join
+
+from hdx.api.utilities.size_hash import get_size_and_hash
+from hdx.data.dataset import Dataset
+from hdx.data.resource import Resource
+from hdx.data.showcase import Showcase
+from hdx.utilities.path import temp_dir
+from remote import RemoteState, matches
+
+
+class TestRemote:
+    def test_matches(self):
+        assert matches({"a": "x"}, {"a": "x", "id": "1"})
+        assert not matches({"a": "x", "b": "y"}, {"a": "x"})
+        assert matches(
+            [{"name": "hxl"}, {"name": "refugees"}],
+            [{"name": "refugees", "id": "2"}, {"name": "hxl", "id": "1"}],
+        )
+        assert not matches([{"name": "hxl"}], [{"name": "hxl"}, {"name": "x"}])
+        assert matches(True, "true")
+        assert matches(1, "1")
+        assert not matches("Notes", "notes")
+
+    def test_remote_state(self, configuration):
+        with temp_dir("remote") as folder:
+            path = join(folder, "data_AFG.csv")
+            with open(path, "w") as f:
+                f.write("a,b\n1,2\n")
+            size, hash = get_size_and_hash(path, "csv")
+
+            dataset = Dataset({"name": "unhcr-population-data-for-afg", "title": "AFG"})
+            dataset["tags"] = [
+                {"name": "hxl", "vocabulary_id": "vocabulary-id"},
+                {"name": "refugees", "vocabulary_id": "vocabulary-id"},
+            ]
+            resource = Resource({"name": "Data", "description": "Some data"})
+            resource.set_format("csv")
+            resource.set_file_to_upload(path)
+            dataset.add_update_resource(resource)
+            showcase = Showcase(
+                {"name": "unhcr-population-data-for-afg-showcase", "title": "AFG"}
+            )
+
+            remote_dataset = Dataset(
+                {
+                    "id": "dataset-id",
+                    "name": "unhcr-population-data-for-afg",
+                    "title": "AFG",
+                    "tags": [
+                        {
+                            "id": "2",
+                            "name": "refugees",
+                            "vocabulary_id": "vocabulary-id",
+                        },
+                        {"id": "1", "name": "hxl", "vocabulary_id": "vocabulary-id"},
+                    ],
+                    "resources": [
+                        {
+                            "id": "resource-id",
+                            "name": "Data",
+                            "description": "Some data",
+                            "format": "CSV",
+                            "size": size,
+                            "hash": hash,
+                        }
+                    ],
+                }
+            )
+            remote_showcase = Showcase(
+                {
+                    "id": "showcase-id",
+                    "name": "unhcr-population-data-for-afg-showcase",
+                    "title": "AFG",
+                }
+            )
+            state_path = join(folder, "remote.json")
+            remote = RemoteState(
+                {remote_dataset["name"]: remote_dataset},
+                {remote_showcase["name"]: remote_showcase},
+                state_path,
+            )
+            assert remote.unchanged_dataset(dataset) is remote_dataset
+            assert remote.unchanged_showcase(showcase) is remote_showcase
+            assert not remote.is_associated(remote_dataset, remote_showcase)
+
+            remote.record(remote_dataset, remote_showcase, None)
+            assert exists(state_path)
+            remote = RemoteState(remote.datasets, remote.showcases, state_path)
+            assert remote.is_associated(remote_dataset, remote_showcase)
+
+            with open(path, "a") as f:
+                f.write("3,4\n")
+            assert remote.unchanged_dataset(dataset) is None
+            showcase["title"] = "Afghanistan"
+            assert remote.unchanged_showcase(showcase) is None
+            dataset["name"] = "unhcr-population-data-for-col"
+            assert remote.unchanged_dataset(dataset) is None
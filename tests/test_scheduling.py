@@ -0,0 +1,173 @@
+from threading import Lock
+
+import pytest
+from hdx.utilities.path import temp_dir
+from scheduling import (
+    LargestFirstPool,
+    get_countrycosts,
+    load_shard_processed,
+    merge_shard_reports,
+    parse_shard,
+    pipeline,
+    predict_makespan,
+    save_shard_report,
+    shard_batch,
+    split_into_shards,
+)
+
+
+class TestScheduling:
+    @pytest.fixture
+    def countries(self):
+        return [
+            {"iso3": "world", "countryname": "World", "id": 0},
+            {"iso3": "AFG", "countryname": "Afghanistan", "id": 1},
+            {"iso3": "BGD", "countryname": "Bangladesh", "id": 2},
+            {"iso3": "COL", "countryname": "Colombia", "id": 3},
+            {"iso3": "TUR", "countryname": "Turkey", "id": 4},
+        ]
+
+    @pytest.fixture
+    def costs(self, countries):
+        countriesdata = {
+            0: {"a_residing": [{}] * 10, "a_originating": [{}] * 10},
+            1: {"a_originating": [{}] * 4},
+            2: {"a_residing": [{}] * 1},
+            3: {"a_residing": [{}] * 2},
+            4: {"a_residing": [{}] * 4},
+        }
+        qc_rows = {(2020, 1, 4): {}, (2020, 3, 3): {}}
+        return get_countrycosts(countries, countriesdata, qc_rows)
+
+    def test_get_countrycosts(self, costs):
+        assert costs == {"world": 20, "AFG": 5, "BGD": 1, "COL": 3, "TUR": 5}
+
+    def test_parse_shard(self):
+        assert parse_shard("2/4") == (2, 4)
+        with pytest.raises(ValueError):
+            parse_shard("5/4")
+        with pytest.raises(ValueError):
+            parse_shard("2")
+
+    def test_split_into_shards(self, countries, costs):
+        shards = split_into_shards(countries, costs, 2)
+        assert [[c["iso3"] for c in shard] for shard in shards] == [
+            ["world"],
+            ["AFG", "BGD", "COL", "TUR"],
+        ]
+        shards = split_into_shards(countries, costs, 3)
+        assert [[c["iso3"] for c in shard] for shard in shards] == [
+            ["world"],
+            ["AFG", "COL"],
+            ["BGD", "TUR"],
+        ]
+        assert split_into_shards(countries, costs, 3) == shards
+
+    def test_merge_shard_reports(self, countries, costs):
+        shards = split_into_shards(countries, costs, 2)
+        with temp_dir("shards") as folder:
+            assert merge_shard_reports(folder, 2) == [
+                "Shard 1/2 has no report!",
+                "Shard 2/2 has no report!",
+            ]
+            for index, shard in enumerate(shards, 1):
+                processed = [country["iso3"] for country in shard]
+                save_shard_report(
+                    folder, index, 2, "batch1", countries, shard, processed
+                )
+            assert merge_shard_reports(folder, 2) == []
+            assert load_shard_processed(folder, 1, 2, "batch1") == ["world"]
+            assert load_shard_processed(folder, 1, 2, "batch2") == []
+
+            save_shard_report(folder, 1, 2, "batch1", countries, shards[0], [])
+            assert merge_shard_reports(folder, 2) == ["world processed 0 times!"]
+            save_shard_report(
+                folder, 1, 2, "batch1", countries, shards[0], ["world", "AFG"]
+            )
+            assert merge_shard_reports(folder, 2) == ["AFG processed 2 times!"]
+            # Left by an earlier run
+            save_shard_report(folder, 2, 2, "batch0", countries, shards[1], [])
+            assert merge_shard_reports(folder, 2) == [
+                "Shard 2/2 is from another run!",
+                "BGD processed 0 times!",
+                "COL processed 0 times!",
+                "TUR processed 0 times!",
+            ]
+
+    def test_merge_empty_shards(self, countries, costs):
+        # e.g. a delta run where only the world and AFG changed
+        countries = countries[:2]
+        shards = split_into_shards(countries, costs, 4)
+        assert [[c["iso3"] for c in shard] for shard in shards] == [
+            ["world"],
+            ["AFG"],
+            [],
+            [],
+        ]
+        digests = {"world": "digest1", "AFG": "digest2"}
+        batch = shard_batch(countries, digests)
+        assert shard_batch(countries, {"world": "digest1", "AFG": "digest3"}) != batch
+        with temp_dir("shards") as folder:
+            for index, shard in enumerate(shards, 1):
+                processed = [country["iso3"] for country in shard]
+                save_shard_report(folder, index, 4, batch, countries, shard, processed)
+            assert merge_shard_reports(folder, 4) == []
+
+    def test_pipeline(self):
+        lock = Lock()
+        produced = []
+
+        def function(item):
+            with lock:
+                produced.append(item)
+            return item * 10
+
+        results = []
+        for item, result in pipeline(range(10), function, queue_size=2):
+            # The producer can't get more than queue_size + 1 items ahead of the consumer
+            with lock:
+                assert len(produced) <= item + 4
+            results.append((item, result))
+        assert results == [(i, i * 10) for i in range(10)]
+
+        def failing(item):
+            if item == 3:
+                raise ValueError("failed")
+            return item
+
+        consumed = []
+        with pytest.raises(ValueError):
+            for item, result in pipeline(range(10), failing):
+                consumed.append(item)
+        assert consumed == [0, 1, 2]
+
+        for item, result in pipeline(range(100), function, queue_size=1):
+            break
+
+    def test_predict_makespan(self):
+        assert predict_makespan([1, 1, 1, 1, 10], 2) == 10
+        assert predict_makespan([1, 1, 1, 1, 10], 2, largest_first=False) == 12
+        assert predict_makespan([3, 3, 2, 2, 2], 2) == 7
+        assert predict_makespan([], 3) == 0
+
+    def test_largest_first_pool(self, countries, costs):
+        items = [country["iso3"] for country in countries]
+        pool = LargestFirstPool(len, costs, 2)
+        assert pool.predicted(items) == (20, 20)
+        results = list(pool.map(items))
+        # Consumed in order even though the world and AFG are submitted first
+        assert results == [(iso3, len(iso3)) for iso3 in items]
+        assert list(pool.durations) == items
+        report = pool.report()
+        assert report["workers"] == 2
+        assert report["actual"] > 0
+        assert report["predicted"] <= report["predicted_in_order"]
+
+        # Submitted lazily, largest first, but the next item to consume always goes
+        for max_pending in (1, 3):
+            pool = LargestFirstPool(len, costs, 2, max_pending=max_pending)
+            assert list(pool.map(items)) == [(iso3, len(iso3)) for iso3 in items]
+
+        pool = LargestFirstPool(int, {"1": 1, "x": 2}, 2)
+        with pytest.raises(ValueError):
+            list(pool.map(["1", "x"]))
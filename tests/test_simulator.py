@@ -0,0 +1,70 @@
+import json
+
+import requests
+from simulator import CKANSimulator
+
+
+def post(simulator, action, **kwargs):
+    response = requests.post(f"{simulator.url}/api/action/{action}", **kwargs)
+    return response.status_code, response.json(), response.headers
+
+
+class TestSimulator:
+    def test_packages(self):
+        with CKANSimulator() as simulator:
+            status, result, _ = post(
+                simulator,
+                "package_create",
+                json={"name": "unhcr-population-data-for-afg", "title": "AFG"},
+            )
+            assert status == 200
+            package_id = result["result"]["id"]
+            status, result, _ = post(
+                simulator,
+                "package_revise",
+                data={
+                    "match": json.dumps({"id": package_id}),
+                    "update": json.dumps(
+                        {"title": "Afghanistan", "resources": [{"name": "Data"}]}
+                    ),
+                },
+                files={"update__resources__0__upload": ("data.csv", b"a,b\n1,2\n")},
+            )
+            assert status == 200
+            package = result["result"]["package"]
+            assert package["title"] == "Afghanistan"
+            assert package["resources"][0]["name"] == "Data"
+            assert package["resources"][0]["url"].endswith("/download/data.csv")
+            assert simulator.uploaded_bytes == 8
+
+            post(simulator, "package_create", json={"name": "other", "title": "Other"})
+            status, result, _ = post(
+                simulator,
+                "package_search",
+                json={"fq": "name:unhcr-population-data-for-*"},
+            )
+            assert result["result"]["count"] == 1
+            status, result, _ = post(simulator, "package_show", json={"id": "missing"})
+            assert status == 404
+            assert simulator.calls["package_create"] == 2
+
+    def test_failures(self):
+        with CKANSimulator(error_rate=1.0) as simulator:
+            status, result, _ = post(
+                simulator, "package_create", json={"name": "afg", "title": "AFG"}
+            )
+            assert status == 500
+            assert simulator.errors == 1
+            # Nothing is applied by a failing call
+            assert simulator.packages == {}
+        with CKANSimulator(rate_limit=0.1, burst=1) as simulator:
+            status, _, _ = post(simulator, "package_show", json={"id": "afg"})
+            assert status == 404
+            status, _, headers = post(simulator, "package_show", json={"id": "afg"})
+            assert status == 429
+            assert int(headers["Retry-After"]) > 0
+            assert simulator.rate_limited == 1
+            assert simulator.calls["package_show"] == 1
+        with CKANSimulator() as simulator:
+            response = requests.get(f"{simulator.url}/tags_mapping.csv")
+            assert response.text.startswith("Current Tag,Action to Take,New Tag(s)")
@@ -0,0 +1,81 @@
+from os.path import join
+
+from hdx.data.dataset import Dataset
+from hdx.data.resource import Resource
+from hdx.data.showcase import Showcase
+from hdx.utilities.path import temp_dir
+from stages import StageRunner, fingerprint, from_bundle, to_bundle
+
+
+class TestStages:
+    def test_fingerprint(self):
+        assert fingerprint({"a": 1, "b": 2}) == fingerprint({"b": 2, "a": 1})
+        assert fingerprint({"a": 1}) != fingerprint({"a": 2})
+
+    def test_stage_runner(self):
+        calls = []
+
+        def stage(name, value):
+            def function():
+                calls.append(name)
+                return value
+
+            return function
+
+        def pipeline(folder, fields, view):
+            runner = StageRunner(folder)
+            generated, generated_fingerprint = runner.run(
+                "generate/AFG", stage("generate", [1, 2]), inputs={"fields": fields}
+            )
+            view, view_fingerprint = runner.run(
+                "resource_view/AFG",
+                stage("resource_view", {"view": view}),
+                inputs={"yaml": view},
+                dependencies=[generated_fingerprint],
+            )
+            runner.run(
+                "upload/AFG", stage("upload", True), dependencies=[view_fingerprint]
+            )
+            return runner, generated, view
+
+        with temp_dir("stages") as folder:
+            runner, generated, view = pipeline(folder, "f1", "v1")
+            assert calls == ["generate", "resource_view", "upload"]
+            assert runner.skipped == []
+
+            calls.clear()
+            runner, generated, view = pipeline(folder, "f1", "v1")
+            assert calls == []
+            assert generated == [1, 2]
+            assert view == {"view": "v1"}
+            assert len(runner.skipped) == 3
+
+            calls.clear()
+            pipeline(folder, "f1", "v2")
+            assert calls == ["resource_view", "upload"]
+
+            calls.clear()
+            pipeline(folder, "f2", "v2")
+            assert calls == ["generate", "resource_view", "upload"]
+
+    def test_bundle(self, configuration):
+        dataset = Dataset({"name": "unhcr-population-data-for-bgd", "title": "BGD"})
+        resource = Resource({"name": "qc_data.csv", "description": "QC"})
+        resource.set_format("csv")
+        resource.set_file_to_upload(join("tests", "fixtures", "HDX_Solutions.csv"))
+        dataset.add_update_resource(resource)
+        showcase = Showcase({"name": "unhcr-population-data-for-bgd-showcase"})
+
+        assert to_bundle(None, None, None) is None
+        assert from_bundle(None) == (None, None, None)
+        bundle = to_bundle(dataset, showcase, [False, True, True])
+        dataset, showcase, bites_disabled = from_bundle(bundle)
+        assert dataset["name"] == "unhcr-population-data-for-bgd"
+        resources = dataset.get_resources()
+        assert len(resources) == 1
+        assert resources[0]["name"] == "qc_data.csv"
+        assert resources[0].get_file_to_upload() == join(
+            "tests", "fixtures", "HDX_Solutions.csv"
+        )
+        assert showcase["name"] == "unhcr-population-data-for-bgd-showcase"
+        assert bites_disabled == [False, True, True]
@@ -4,6 +4,7 @@ Unit tests for UCDP
 
 """
 
+from datetime import datetime
 from os.path import join
 from pathlib import Path
 
@@ -14,7 +15,16 @@ from hdx.data.vocabulary import Vocabulary
 from hdx.location.country import Country
 from hdx.utilities.downloader import Download
 from hdx.utilities.path import temp_dir
-from unhcr import generate_dataset_and_showcase, get_countriesdata
+from unhcr import (
+    WORLD,
+    CountryDimension,
+    check_resource_order,
+    generate_dataset_and_showcase,
+    generate_world_resource,
+    get_affected_countries,
+    get_countriesdata,
+    get_countriesdigests,
+)
 
 
 class TestUNHCR:
@@ -65,8 +75,9 @@ class TestUNHCR:
             "ApplicationAveragePersonsPerCase",
             "Applications",
         ]
+        ids = {country["iso3"]: country["id"] for country in countries}
         assert len(countriesdata) == 73
-        assert countriesdata["BGD"]["asylum_applications_originating"][1] == {
+        assert countriesdata[ids["BGD"]]["asylum_applications_originating"][1] == {
             "Year": "2008",
             "ISO3CoO": "BGD",
             "ISO3CoA": "IRN",
@@ -79,7 +90,7 @@ class TestUNHCR:
             "Applications": "5",
         }
         assert len(qc_rows) == 1067
-        assert qc_rows["2019_AFG_PAK"] == {
+        assert qc_rows[(2019, ids["AFG"], ids["PAK"])] == {
             "Year": "2019",
             "ISO3CoO": "AFG",
             "ISO3CoA": "PAK",
@@ -101,6 +112,44 @@ class TestUNHCR:
             "OIP_outgoing": "0",
         }
 
+    def test_country_dimension(self, configuration):
+        dimension = CountryDimension()
+        assert dimension.id(WORLD) == 0
+        assert dimension.id("BGD") == 1
+        assert dimension.id(None) == 2
+        assert dimension.id("BGD") == 1
+        assert len(dimension) == 3
+        assert dimension.iso3(1) == "BGD"
+        assert dimension.name(0) == "World"
+        assert dimension.name(1) == "Bangladesh"
+        assert dimension.name(2) == "Various / unknown"
+        assert dimension.name(dimension.id("STA")) == "Stateless"
+
+    def test_get_affected_countries(self, data):
+        countries, headers, countriesdata, qc_rows = data
+        digests = get_countriesdigests(countries, headers, countriesdata, qc_rows)
+        assert len(digests) == len(countries)
+        assert sorted(digests["BGD"].keys()) == [
+            "asylum_applications_originating",
+            "asylum_decisions_originating",
+            "demographics_originating",
+            "end_year_population_totals_originating",
+            "qc_data",
+        ]
+        assert "qc_data" not in digests[WORLD]
+        assert get_affected_countries(countries, digests, digests) == countries[:1]
+
+        ids = {country["iso3"]: country["id"] for country in countries}
+        changed = dict(countriesdata)
+        changed[ids["BGD"]] = {
+            resource_name: rows[:-1]
+            for resource_name, rows in countriesdata[ids["BGD"]].items()
+        }
+        new_digests = get_countriesdigests(countries, headers, changed, qc_rows)
+        affected = get_affected_countries(countries, new_digests, digests)
+        assert [country["iso3"] for country in affected] == [WORLD, "BGD"]
+        assert len(get_affected_countries(countries, digests, {})) == len(countries)
+
     def test_generate_dataset_and_showcase(self, configuration, data):
         with temp_dir("ucdp") as folder:
             resources = configuration["resources"]
@@ -110,7 +159,7 @@ class TestUNHCR:
             dataset, showcase, bites_disabled = generate_dataset_and_showcase(
                 folder,
                 countries[index],
-                countriesdata["BGD"],
+                countriesdata[countries[index]["id"]],
                 qc_rows,
                 headers,
                 resources,
@@ -124,7 +173,43 @@ class TestUNHCR:
 
             resources = dataset.get_resources()
             assert len(resources) == 5  # should be 10 if all data is available
+            assert [resource["name"] for resource in resources] == [
+                "End-year stock population figures for forcibly displaced persons originating from Bangladesh",
+                "Demographics and locations of forcibly displaced persons originating from Bangladesh",
+                "Asylum applications by asylum-seekers originating from Bangladesh",
+                "Asylum decisions taken on asylum claims of asylum-seekers originating from Bangladesh",
+                "qc_data.csv",
+            ]
+            assert check_resource_order(dataset) == []
+            resources[0], resources[1] = resources[1], resources[0]
+            assert check_resource_order(dataset) == [
+                "End-year stock population figures for forcibly displaced persons originating from Bangladesh"
+            ]
 
             assert showcase["name"] == "unhcr-population-data-for-bgd-showcase"
 
             assert bites_disabled == [False, True, True]
+
+    def test_generate_world_resource_explain(self, configuration):
+        from hdx.data.dataset import Dataset
+
+        with temp_dir("ucdp") as folder:
+            rows = [dict(Year="2019", ISO3CoO="AFG"), dict(Year="2020", ISO3CoO="BGD")]
+            success, results = generate_world_resource(
+                Dataset({"name": "test"}),
+                folder,
+                "test_world.csv",
+                {"name": "test"},
+                ["Year", "ISO3CoO"],
+                rows,
+                configuration["fields"],
+                lambda row: {
+                    "startdate": datetime(row["Year"], 1, 1),
+                    "enddate": datetime(row["Year"], 12, 31),
+                },
+                explain=True,
+            )
+            assert success
+            lines = results["plan"].splitlines()
+            assert lines[0].startswith("write_converted_csv")
+            assert lines[1].startswith("  test_world.csv: 0 rows in, 2 rows out")
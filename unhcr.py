@@ -15,21 +15,32 @@ Anguilla: https://feature.data-humdata-org.ahconu.org/dataset/unhcr-population-d
 
 """
 
+import hashlib
 import logging
 from datetime import datetime, timezone
+from time import perf_counter
 from urllib.parse import urljoin
 
-from fields import ListIterator, RowIterator
-from hdx.data.dataset import Dataset
-from hdx.data.hdxobject import HDXError
-from hdx.data.showcase import Showcase
-from hdx.location.country import Country
+from buffers import generate_resource, open_resource_file
+from countrynames import get_country_name
+from fields import ListIterator, OperatorStats, RowIterator, write_converted_csv
 from slugify import slugify
 
 logger = logging.getLogger(__name__)
 
 WORLD = "world"
 
+# Order in which the resources are displayed in HDX: by the start of their name, then by direction.
+# The QuickCharts data (qc_data.csv) comes last.
+desired_order = (
+    "End-year stock",
+    "Demographics",
+    "Asylum applications",
+    "Asylum decisions",
+    "Solutions",
+)
+direction_order = ("originating", "residing", "(Global)")
+
 # Dec-2020 - add a switch for the latest year and if the data is ASR or MYSR
 # If MYSR, then the date in the latest year should be 30-June not 31-Dec
 LATEST_YEAR = 2025
@@ -55,9 +66,47 @@ IS_ASR = False
 # The data is sourced from....
 
 
+# -----------------------------------------------------------------------------------------------------------------------------------------------------
+class CountryDimension:
+    """
+    Country dimension table.  Every country code met in the data (including the non-standard UKN, STA and TIB
+    codes and missing codes) is given a small integer id the first time it is seen, and its name is resolved
+    only once.  Partitions and QuickChart keys work on these ids - ISO3 codes and names are looked up again only
+    when the output is written.
+    """
+
+    def __init__(self):
+        self._ids = dict()
+        self._iso3s = list()
+        self._names = list()
+
+    def __len__(self):
+        return len(self._iso3s)
+
+    def id(self, countryiso):
+        country_id = self._ids.get(countryiso)
+        if country_id is None:
+            country_id = len(self._iso3s)
+            self._ids[countryiso] = country_id
+            self._iso3s.append(countryiso)
+            if countryiso == WORLD:
+                self._names.append("World")
+            else:
+                self._names.append(Get_Country_Name_From_ISO3_Extended(countryiso))
+        return country_id
+
+    def iso3(self, country_id):
+        return self._iso3s[country_id]
+
+    def name(self, country_id):
+        return self._names[country_id]
+
+
 # -----------------------------------------------------------------------------------------------------------------------------------------------------
 def get_countriesdata(download_url, resources, downloader):
-    countriesdata = {WORLD: {}}
+    dimension = CountryDimension()
+    world_id = dimension.id(WORLD)
+    countriesdata = {world_id: {}}
     qc_rows = dict()
     countries = set()
     if not download_url.endswith("/"):
@@ -84,43 +133,49 @@ def get_countriesdata(download_url, resources, downloader):
             )
             for country_column in country_columns
         ]
+        world_partitions = [
+            countriesdata[world_id].setdefault(resource_name, [])
+            for resource_name in resource_names
+        ]
 
         for row in iterator:
-            for country_column, country_name_column, resource_name in zip(
-                country_columns, country_name_columns, resource_names
+            year = int(row["Year"])
+            origin_id = dimension.id(row["ISO3CoO"])
+            asylum_id = dimension.id(row["ISO3CoA"])
+            row_key = (year, origin_id, asylum_id)
+            qc_row = qc_rows.get(row_key)
+            if qc_row is None:
+                qc_row = {
+                    "Year": row["Year"],
+                    "ISO3CoO": dimension.iso3(origin_id),
+                    "ISO3CoA": dimension.iso3(asylum_id),
+                    "CoO_name": dimension.name(origin_id),
+                    "CoA_name": dimension.name(asylum_id),
+                }
+                qc_rows[row_key] = qc_row
+            for (
+                country_column,
+                country_name_column,
+                resource_name,
+                world_partition,
+            ) in zip(
+                country_columns, country_name_columns, resource_names, world_partitions
             ):
-                countryiso = row[country_column]
-                #                countryname = Country.get_country_name_from_iso3(countryiso)
-                countryname = Get_Country_Name_From_ISO3_Extended(countryiso)
+                country_id = origin_id if country_column == "ISO3CoO" else asylum_id
+                countryiso = dimension.iso3(country_id)
+                countryname = dimension.name(country_id)
                 logger.info(
                     f"Processing {countryiso} - {countryname}, resource {resource_name}"
                 )
-                countries.add((countryiso, countryname))
+                countries.add(country_id)
                 row[country_name_column] = countryname
-                if countryiso not in countriesdata:
-                    countriesdata[countryiso] = {}
-                if resource_name not in countriesdata[countryiso]:
-                    countriesdata[countryiso][resource_name] = []
-                if resource_name not in countriesdata[WORLD]:
-                    countriesdata[WORLD][resource_name] = []
-                countriesdata[countryiso][resource_name].append(row)
-                countriesdata[WORLD][resource_name].append(row)
-                year = row["Year"]
-                origin = row["ISO3CoO"]
-                asylum = row["ISO3CoA"]
-                row_key = f"{year}_{origin}_{asylum}"
-                qc_row = qc_rows.get(row_key, dict())
-                qc_row["Year"] = year
-                qc_row["ISO3CoO"] = origin
-                qc_row["ISO3CoA"] = asylum
-                qc_row["CoO_name"] = Get_Country_Name_From_ISO3_Extended(origin)
-                qc_row["CoA_name"] = Get_Country_Name_From_ISO3_Extended(asylum)
-                # qc_row['CoO_name'] = Country.get_country_name_from_iso3(origin)
-                # qc_row['CoA_name'] = Country.get_country_name_from_iso3(asylum)
+                countrydata = countriesdata.setdefault(country_id, {})
+                countrydata.setdefault(resource_name, []).append(row)
+                world_partition.append(row)
                 attributes = list()
-                if countryiso == origin:
+                if country_id == origin_id:
                     attributes.append("outgoing")
-                if countryiso == asylum:
+                if country_id == asylum_id:
                     attributes.append("incoming")
                 # Added HST June 2022
                 for attribute in attributes:
@@ -139,7 +194,6 @@ def get_countriesdata(download_url, resources, downloader):
                             continue
                         qc_field = f"{field}_{attribute}"
                         qc_row[qc_field] = value
-                qc_rows[row_key] = qc_row
         for country_name_column in country_name_columns:
             headers.insert(3, country_name_column)
         for resource_name in resource_names:
@@ -149,21 +203,79 @@ def get_countriesdata(download_url, resources, downloader):
     # This line should remove them
     print("Removing NULL countries")
     print(len(countries))
-    countries = {x for x in countries if x[0] is not None}
+    countries = {x for x in countries if dimension.iso3(x) is not None}
     print(len(countries))
 
     # Then produce a sorted list...
-    countries = [{"iso3": WORLD, "countryname": "World"}] + [
-        {"iso3": x[0], "countryname": x[1]} for x in sorted(list(countries))
+    countries = [{"iso3": WORLD, "countryname": "World", "id": world_id}] + [
+        {"iso3": dimension.iso3(x), "countryname": dimension.name(x), "id": x}
+        for x in sorted(countries, key=dimension.iso3)
     ]
     return countries, all_headers, countriesdata, qc_rows
 
 
+# -----------------------------------------------------------------------------------------------------------------------------------------------------
+def get_countriesdigests(countries, headers, countriesdata, qc_rows):
+    """
+    Digests of the input rows for every country (including the world) and resource, plus a "qc_data" digest of the
+    QuickCharts rows the country takes part in.  Returned as a dictionary {iso3: {resource_name: digest}} which can be
+    saved and compared with the digests of the next drop of the data.
+    """
+    digests = dict()
+    for country in countries:
+        countrydigests = dict()
+        for resource_name, resource_rows in countriesdata[country["id"]].items():
+            resource_headers = headers[resource_name]
+            digest = hashlib.sha1("\x1f".join(resource_headers).encode("utf-8"))
+            for row in resource_rows:
+                line = "\x1f".join(
+                    str(row.get(header, "")) for header in resource_headers
+                )
+                digest.update(f"\n{line}".encode("utf-8"))
+            countrydigests[resource_name] = digest.hexdigest()
+        digests[country["iso3"]] = countrydigests
+
+    # One pass over the QuickCharts rows, each row counts for both its origin and its asylum country
+    qc_digests = {country["id"]: hashlib.sha1() for country in countries}
+    for key, qc_row in qc_rows.items():
+        _, origin_id, asylum_id = key
+        line = repr(sorted(qc_row.items())).encode("utf-8")
+        for country_id in {origin_id, asylum_id}:
+            if country_id in qc_digests:
+                qc_digests[country_id].update(line)
+    for country in countries:
+        if country["iso3"] != WORLD:
+            digests[country["iso3"]]["qc_data"] = qc_digests[country["id"]].hexdigest()
+    return digests
+
+
+# -----------------------------------------------------------------------------------------------------------------------------------------------------
+def get_affected_countries(countries, digests, previous_digests):
+    """
+    Works out which countries need to be generated again, comparing the digests from get_countriesdigests with the
+    ones saved by the previous run.  Every input row is part of the partitions (and QuickCharts rows) of both its
+    origin and its asylum country, so a changed, added or removed row shows in the digests of both sides of the
+    relation.  The world is always included.  Returns the affected countries in the order of *countries*.
+    """
+    affected = list()
+    for country in countries:
+        countryiso = country["iso3"]
+        if countryiso == WORLD or digests[countryiso] != previous_digests.get(countryiso):
+            affected.append(country)
+    print("Affected countries: ", len(affected), " of ", len(countries))
+    return affected
+
+
 # -----------------------------------------------------------------------------------------------------------------------------------------------------
 def generate_dataset_and_showcase(
-    folder, country, countrydata, qc_rows, headers, resources, fields
+    folder, country, countrydata, qc_rows, headers, resources, fields, explain=False
 ):
-    """ """
+    """If *explain* is True, the row iterator chains are traced and their plans logged"""
+    # The HDX objects are slow to import and only needed from here on
+    from hdx.data.dataset import Dataset
+    from hdx.data.hdxobject import HDXError
+    from hdx.data.showcase import Showcase
+
     countryiso = country["iso3"]
     countryname = country["countryname"]
     title_text = "Data on forcibly displaced populations and stateless persons"
@@ -214,6 +326,7 @@ def generate_dataset_and_showcase(
 
     earliest_startdate = None
     latest_enddate = None
+    entries = []
     for resource_name, resource_rows in countrydata.items():
         resource_id = "_".join(resource_name.split("_")[:-1])
         originating_residing = resource_name.split("_")[-1]  # originating or residing
@@ -238,17 +351,50 @@ def generate_dataset_and_showcase(
         resourcedata["name"] = resourcedata["name"].replace(
             "residing in World", "(Global)"
         )
-        rowit = RowIterator(headers[resource_name], resource_rows).with_fields(fields)
-        success, results = dataset.generate_resource_from_iterable(
-            rowit.headers(),
-            rowit,
-            rowit.hxltags_mapping(),
-            folder,
-            filename,
-            resourcedata,
-            date_function=process_dates,
-            encoding="utf-8",
-        )
+        entries.append((resource_name, resource_rows, filename, resourcedata))
+
+    # Add the resources in the order in which they are displayed, so that they don't need to be reordered in HDX
+    entries.sort(
+        key=lambda x: resource_position(x[3]["name"]) or (len(desired_order), 0)
+    )
+    for resource_name, resource_rows, filename, resourcedata in entries:
+        if countryiso == WORLD:
+            success, results = generate_world_resource(
+                dataset,
+                folder,
+                filename,
+                resourcedata,
+                headers[resource_name],
+                resource_rows,
+                fields,
+                process_dates,
+                explain,
+            )
+            if explain and success:
+                logger.info(f"{countryname} - {filename} plan:\n{results['plan']}")
+        else:
+
+            def generate(folder):
+                rowit = (
+                    RowIterator(headers[resource_name], resource_rows)
+                    .trace(resource_name, explain)
+                    .with_fields(fields)
+                )
+                result = dataset.generate_resource_from_iterable(
+                    rowit.headers(),
+                    rowit,
+                    rowit.hxltags_mapping(),
+                    folder,
+                    filename,
+                    resourcedata,
+                    date_function=process_dates,
+                    encoding="utf-8",
+                )
+                if explain:
+                    logger.info(f"{countryname} - {filename} plan:\n{rowit.explain()}")
+                return result
+
+            success, results = generate_resource(folder, filename, generate)
 
         if success is False:
             logger.warning(f"{countryname} - {resource_name}  has no data!")
@@ -285,6 +431,7 @@ def generate_dataset_and_showcase(
                     "Displaced Stateless From",
                 ],
             )
+            .trace("qc_rows", explain)
             .auto_headers()
             .to_list_iterator()
         )
@@ -345,19 +492,24 @@ def generate_dataset_and_showcase(
             ):
                 bites_disabled[2] = False
 
-        rowit.reset()
-        success, results = dataset.generate_resource_from_iterable(
-            rowit.headers(),
-            rowit,
-            rowit.hxltags_mapping(),
-            folder,
-            filename,
-            resourcedata,
-            date_function=process_dates,
-            encoding="utf-8",
-        )
+        def generate_qc(folder):
+            rowit.reset()
+            return dataset.generate_resource_from_iterable(
+                rowit.headers(),
+                rowit,
+                rowit.hxltags_mapping(),
+                folder,
+                filename,
+                resourcedata,
+                date_function=process_dates,
+                encoding="utf-8",
+            )
+
+        success, results = generate_resource(folder, filename, generate_qc)
         if success is False:
             logger.warning(f"QuickCharts {countryname} - {filename}  has no data!")
+        if explain:
+            logger.info(f"{countryname} - {filename} plan:\n{rowit.explain()}")
     dataset.set_time_period(earliest_startdate, latest_enddate)
     showcase = Showcase(
         {
@@ -372,6 +524,95 @@ def generate_dataset_and_showcase(
     return dataset, showcase, bites_disabled
 
 
+# -------------------------------------------------------------------------------------------------------------------------------------------------------------------
+def resource_position(name):
+    """Position of a resource in the display order as a tuple (index in desired_order, index in direction_order),
+    None if the name doesn't match desired_order and direction_order
+    """
+    for i, name_start in enumerate(desired_order):
+        if name.startswith(name_start):
+            for j, direction in enumerate(direction_order):
+                if direction in name:
+                    return i, j
+    return None
+
+
+def check_resource_order(dataset):
+    """Check that the resources of the dataset are in the display order with the QuickCharts data last.
+    Returns the names of the resources that are missing from the display order or out of place.
+    """
+    misplaced = []
+    resources = dataset.get_resources()
+    previous = None
+    for i, resource in enumerate(resources):
+        name = resource["name"]
+        if name == "qc_data.csv":
+            if i != len(resources) - 1:
+                misplaced.append(name)
+            continue
+        position = resource_position(name)
+        if position is None or (previous is not None and position <= previous):
+            misplaced.append(name)
+        else:
+            previous = position
+    return misplaced
+
+
+# -------------------------------------------------------------------------------------------------------------------------------------------------------------------
+def generate_world_resource(
+    dataset,
+    folder,
+    filename,
+    resourcedata,
+    headers,
+    rows,
+    fields,
+    date_function,
+    explain=False,
+):
+    """
+    Fast path for the resources of the global dataset, which holds every input row.  Instead of converting the rows
+    one dictionary at a time and handing them over to generate_resource_from_iterable, the rows are written straight
+    to the csv file in large blocks with write_converted_csv.  The file, the resource and the returned results are
+    the same as generate_resource_from_iterable would produce.  If *explain* is True, the rows and the writing are
+    traced and the plan (as text) is added to the results.
+    """
+    from hdx.data.resource import Resource
+
+    if len(rows) == 0:
+        logger.error(f"No data rows in {filename}!")
+        return False, dict()
+    # The dates only depend on the year and grow with it, so only the first and last years are needed
+    years = sorted({int(row["Year"]) for row in rows})
+    startdate = date_function({"Year": years[0]})["startdate"]
+    enddate = date_function({"Year": years[-1]})["enddate"]
+
+    if explain:
+        rows = RowIterator(headers, rows).trace(filename)
+    start = perf_counter()
+    # Written straight to disk once large if the folder is an in memory buffer
+    with open_resource_file(folder, filename) as f:
+        number_of_rows = write_converted_csv(f, headers, rows, fields)
+    filepath = f.name
+    plan = None
+    if explain:
+        stats = OperatorStats(
+            "write_converted_csv", f"{len(fields)} fields", [rows.stats]
+        )
+        stats.rows = number_of_rows
+        stats.seconds = perf_counter() - start
+        plan = stats.explain()
+    dataset.set_time_period(startdate, enddate)
+    resource = Resource(resourcedata)
+    resource.set_format("csv")
+    resource.set_file_to_upload(filepath)
+    dataset.add_update_resource(resource)
+    results = {"startdate": startdate, "enddate": enddate, "resource": resource}
+    if explain:
+        results["plan"] = plan
+    return True, results
+
+
 # -------------------------------------------------------------------------------------------------------------------------------------------------------------------
 def SubsetQuickChartData(country, qc_rows):
     """
@@ -379,7 +620,7 @@ def SubsetQuickChartData(country, qc_rows):
     the given country either as the origin or as the country of asylum.
     """
     countryISO = country["iso3"]
-    country["countryname"]
+    country_id = country["id"]
 
     # The new dictionary to store the subset of the data
     qcRowSubset = dict()
@@ -392,7 +633,8 @@ def SubsetQuickChartData(country, qc_rows):
     else:
         # filter the data by iterating though the values
         for key, value in qc_rows.items():
-            if value["ISO3CoO"] == countryISO or value["ISO3CoA"] == countryISO:
+            _, origin_id, asylum_id = key
+            if origin_id == country_id or asylum_id == country_id:
                 qcRowSubset[key] = value
 
     print("Filtered ", countryISO, " to ", len(qcRowSubset), " rows")
@@ -412,7 +654,7 @@ def Get_Country_Name_From_ISO3_Extended(countryISO):
     # June-22 - This function has been updated to include a to upper without a check on if the data is null or not
     # So we need to wrap it in a try catch
     try:
-        countryName = Country.get_country_name_from_iso3(countryISO)
+        countryName = get_country_name(countryISO)
     except:
         print("Failed to get the country from get_country_name_from_iso3.")
 